@@ -0,0 +1,1118 @@
+# IFS benchmarks
+# Copyright (C) 2025 ghzserg https://github.com/ghzserg/zmod
+#
+# Запуск на обычном Linux, без Klipper:
+#   python3 ifs_benchmark.py parser [--count 200000]
+#   python3 ifs_benchmark.py toolchange [--runs 3] [--hotend-temp 250] [--save base.json] [--baseline base.json]
+#   python3 ifs_benchmark.py lookahead [--size 50]
+#   python3 ifs_benchmark.py sensors [--seconds 10]
+#   python3 ifs_benchmark.py state [--count 1000]
+import argparse
+import collections
+import heapq
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import zmod_ifs
+from ifs_simulator import IfsSimulator
+
+# Ответы F13 в том виде, в каком их разбирает IfsData: простой, вставка
+# прутка, подача в порт 2 с миганием stall, ошибка драйвера
+F13_LINES = [
+    "FFS_state: 5 silk_state: 15 chan: 1 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 5 silk_state: 15 chan: 1 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 5 silk_state: 15 chan: 1 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 5 silk_state: 11 chan: 1 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 5 silk_state: 15 chan: 1 ffs_channels_insert: 4 stall_state: 0",
+    "FFS_state: 29 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 22 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 2",
+    "FFS_state: 22 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 2",
+    "FFS_state: 22 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 22 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 2",
+    "FFS_state: 127 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 0",
+    "FFS_state: 5 silk_state: 15 chan: 2 ffs_channels_insert: 0 stall_state: 0",
+]
+
+# Разбор F13 до перехода на однопроходный парсер, для сравнения
+_legacy_lock = threading.Lock()
+_legacy_values = {}
+
+def legacy_parse(data_str):
+    silk_state = chan = insert = stall_state = state = 0
+    state_match = re.search(r'FFS_state:\s*(\d+)', data_str)
+    if state_match:
+        state = int(state_match.group(1))
+    silk_match = re.search(r'silk_state:\s*(\d+)', data_str)
+    if silk_match:
+        silk_state = int(silk_match.group(1))
+    ports = [(silk_state >> i) & 1 == 1 for i in range(4)]
+    chan_match = re.search(r'chan:\s*(\d+)', data_str)
+    if chan_match:
+        chan = int(chan_match.group(1))
+    insert_match = re.search(r'ffs_channels_insert:\s*(\d+)', data_str)
+    if insert_match:
+        insert = int(insert_match.group(1)).bit_length()
+    stall_match = re.search(r'stall_state:\s*(\d+)', data_str)
+    if stall_match:
+        stall_state = int(stall_match.group(1))
+    stalls = [(stall_state >> i) & 1 == 1 for i in range(4)]
+    with _legacy_lock:
+        _legacy_values.update(State=state, Ports=ports, Chan=chan,
+                              Insert=insert, Stalls=stalls)
+    return state, ports, chan, insert, stalls
+
+def _time_per_line(func, lines, count):
+    n = len(lines)
+    start = time.perf_counter()
+    for i in range(count):
+        func(lines[i % n])
+    return (time.perf_counter() - start) / count * 1e6
+
+def bench_parser(args):
+    lines = F13_LINES
+    data = zmod_ifs.IfsData()
+    # Сверка: новый парсер дает те же значения, что и старый
+    for line in lines:
+        data.update_from_string(line)
+        values = data.get_values()
+        state, ports, chan, insert, stalls = legacy_parse(line)
+        assert values['State'] == state and values['Chan'] == chan
+        assert values['Insert'] == insert
+        assert [values['Port%d' % (i + 1)] for i in range(4)] == ports
+        assert [data.get_stall(i + 1) for i in range(4)] == stalls
+
+    legacy = _time_per_line(legacy_parse, lines, args.count)
+    data = zmod_ifs.IfsData()
+    current = _time_per_line(data.update_from_string, lines, args.count)
+    distinct = sorted(set(lines), key=lines.index)
+    data = zmod_ifs.IfsData()
+    changed = _time_per_line(data.update_from_string, distinct, args.count)
+    data = zmod_ifs.IfsData()
+    idle = _time_per_line(data.update_from_string, lines[:1], args.count)
+    print(f"F13 parser, {args.count} lines:")
+    print(f"  legacy, 5x re.search          {legacy:6.2f} us/line")
+    print(f"  single pass, sample mix       {current:6.2f} us/line")
+    print(f"  single pass, every line new   {changed:6.2f} us/line")
+    print(f"  single pass, idle (same line) {idle:6.2f} us/line")
+    # Чтение снимка: словарь для вывода против аксессоров горячих путей
+    data.update_from_string(lines[6])
+    readers = (('get_values() dict', data.get_values),
+               ('get_masks()', data.get_masks),
+               ('get_port(2)', lambda: data.get_port(2)))
+    print(f"IfsData reads, {args.count} calls, {sys.getsizeof(data)} bytes per object:")
+    for name, func in readers:
+        start = time.perf_counter()
+        for i in range(args.count):
+            func()
+        print(f"  {name:29} {(time.perf_counter() - start) / args.count * 1e6:6.2f} us/call")
+    return 0
+
+# ---- Смена инструмента: заглушки Klipper поверх симулятора IFS ----
+#
+# Реактор, G-код и АЦП датчика экструдера заменены минимальными заглушками,
+# IFS - симулятором на pty. Макросы zmod (_INSERT_PRUTOK_IFS, _IFS_REMOVE_PRUTOK,
+# _REMOVE_PRUTOK_IFS) и MMU_CHANGE_TOOL из mmu_ad5x.cfg повторены на Python
+# с теми же командами и фазами. Движения, нагрев и подача прутка моделируются
+# и ускоряются в time_scale раз, последовательный канал и опрос идут в реальном
+# времени - именно их накладные расходы и видны в отчете.
+
+PHASES = ('unload', 'cut', 'select', 'feed', 'heat', 'verify')
+MOVE_TIME = 0.1             # Время одного перемещения без экструзии, с (до масштабирования)
+HEAT_RATE = 3.              # Скорость нагрева/остывания сопла, °C/с
+EXTRUDER_EMPTY_ADC = 0.5    # Значения АЦП датчика экструдера, см. get_extruder_sensor
+EXTRUDER_FULL_ADC = 0.1
+EXTRUDE_RATE = 2.           # Подача экструдера во время печати, мм/с
+ADC_REPORT_TIME = 0.3       # Период отсчетов АЦП датчика температуры в Klipper, с
+# Фазы IFS_CHANGE_TOOL -> фазы отчета
+CHANGE_PHASES = {'cut': 'cut', 'unload': 'unload', 'load': 'select', 'feed': 'feed',
+                 'heat': 'heat', 'verify': 'verify'}
+
+class BenchCompletion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = None
+        self.done = False
+
+    def test(self):
+        return self.done
+
+    def complete(self, result):
+        self.result = result
+        self.done = True
+
+    def wait(self, waketime=None, waketime_result=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        while not self.done:
+            now = self.reactor.monotonic()
+            if now >= waketime:
+                return waketime_result
+            self.reactor.pause(min(waketime, now + 0.001))
+        return self.result
+
+class BenchReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.async_queue = collections.deque()
+        self.timers = []
+        self.in_timer = set()
+        self.busy = 0.                  # Время в обработчиках таймеров и async, с
+        self._depth = 0
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def completion(self):
+        return BenchCompletion(self)
+
+    def register_async_callback(self, callback, waketime=NOW):
+        with self.lock:
+            self.async_queue.append(callback)
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = [callback, waketime]
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer[1] = waketime
+
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def _run_once(self):
+        while True:
+            with self.lock:
+                if not self.async_queue:
+                    break
+                callback = self.async_queue.popleft()
+            self._call(callback, self.monotonic())
+        now = self.monotonic()
+        for timer in list(self.timers):
+            if timer[1] <= now and id(timer) not in self.in_timer:
+                self.in_timer.add(id(timer))
+                try:
+                    timer[1] = self._call(timer[0], now)
+                finally:
+                    self.in_timer.discard(id(timer))
+
+    # Вложенные вызовы (pause внутри обработчика) не считаются дважды
+    def _call(self, callback, eventtime):
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            return callback(eventtime)
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self.busy += time.perf_counter() - start
+
+    def pause(self, waketime):
+        while True:
+            self._run_once()
+            now = self.monotonic()
+            if now >= waketime:
+                return now
+            time.sleep(min(0.0005, waketime - now))
+
+class BenchError(Exception):
+    pass
+
+class BenchGCodeCommand:
+    error = BenchError
+
+    def __init__(self, gcode, command, params):
+        self.gcode = gcode
+        self.command = command
+        self.params = {k.upper(): str(v) for k, v in params.items()}
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def get_int(self, name, default=None, minval=None, maxval=None):
+        value = self.params.get(name)
+        return default if value is None else int(float(value))
+
+    def get_float(self, name, default=None, minval=None, maxval=None, above=None, below=None):
+        value = self.params.get(name)
+        return default if value is None else float(value)
+
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg)
+
+class BenchGCode:
+    error = BenchError
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.commands = {}
+        self.macros = {}
+        self.phase = None
+        self.phase_start = 0.
+        self.phase_times = collections.defaultdict(float)
+
+    def register_command(self, name, func, desc=None):
+        self.commands[name] = func
+
+    def respond_info(self, msg, log=True):
+        pass
+
+    def respond_raw(self, msg):
+        pass
+
+    def create_gcode_command(self, command, commandline, params):
+        return BenchGCodeCommand(self, command, params)
+
+    def set_phase(self, phase):
+        now = time.monotonic()
+        if self.phase is not None:
+            self.phase_times[self.phase] += now - self.phase_start
+        self.phase = phase
+        self.phase_start = now
+
+    def run_script_from_command(self, script):
+        for line in script.strip().split('\n'):
+            parts = line.split('#', 1)[0].split()
+            if not parts:
+                continue
+            name = parts[0].upper()
+            params = {}
+            for part in parts[1:]:
+                if '=' in part:
+                    key, value = part.split('=', 1)
+                    params[key.upper()] = value
+                else:
+                    params[part[0].upper()] = part[1:]
+            if name in self.commands:
+                self.commands[name](BenchGCodeCommand(self, name, params))
+            elif name in self.macros:
+                self.macros[name](params)
+            # Прочие команды (M118, _PRINT_*, SDCARD_*...) на время не влияют
+    run_script = run_script_from_command
+
+# АЦП датчика экструдера как MCU_adc: отсчет раз в ADC_REPORT_TIME (с учетом
+# ускорения), обработчик вызывается из отдельного потока, как из потока mcu
+class SimulatedExtruderADC:
+    def __init__(self, sim):
+        self.sim = sim
+        self.report_time = ADC_REPORT_TIME / sim.time_scale
+        self._callback = lambda read_time, read_value: None    # Обработчик датчика температуры
+        self._last_state = (self._read(), time.monotonic())
+        self.stop = False
+        self.thread = threading.Thread(target=self._report, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        return EXTRUDER_FULL_ADC if self.sim.extruder_triggered() else EXTRUDER_EMPTY_ADC
+
+    def _report(self):
+        while not self.stop:
+            time.sleep(self.report_time)
+            self._last_state = (self._read(), time.monotonic())
+            self._callback(self._last_state[1], self._last_state[0])
+
+    def get_last_value(self):
+        return self._last_state
+
+class BenchQueryADC:
+    def __init__(self, sim):
+        self.adc = {"temperature_sensor filamentValue": SimulatedExtruderADC(sim)}
+
+class BenchColor:
+    valid_types = []
+
+    def get_display(self):
+        return False
+
+class BenchHeater:
+    # Сопло: температура идет к заданной со скоростью HEAT_RATE (с учетом time_scale)
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self.temperature = self.target = 25.
+        self.last_update = time.monotonic()
+
+    def reset(self, temp):
+        self.temperature = self.target = temp
+        self.last_update = time.monotonic()
+
+    def _update(self, eventtime):
+        step = HEAT_RATE * self.time_scale * max(0., eventtime - self.last_update)
+        self.last_update = max(self.last_update, eventtime)
+        if self.temperature < self.target:
+            self.temperature = min(self.target, self.temperature + step)
+        else:
+            self.temperature = max(self.target, self.temperature - step)
+
+    def set_temp(self, temp):
+        self._update(time.monotonic())
+        self.target = temp
+
+    def get_temp(self, eventtime):
+        self._update(eventtime)
+        return self.temperature, self.target
+
+class BenchExtruder:
+    def __init__(self, heater):
+        self.heater = heater
+
+    def get_heater(self):
+        return self.heater
+
+    # Печать идет с постоянной подачей EXTRUDE_RATE
+    def find_past_position(self, print_time):
+        return print_time * EXTRUDE_RATE
+
+class BenchMCU:
+    def estimated_print_time(self, eventtime):
+        return eventtime
+
+class BenchPrintStats:
+    def __init__(self):
+        self.state = 'standby'
+
+    def get_status(self, eventtime):
+        return {'state': self.state}
+
+# RunoutHelper из klippy/extras/filament_switch_sensor.py: только счетчик вызовов
+class BenchRunoutHelper:
+    notes = 0
+
+    def __init__(self, config):
+        self.runout_gcode = None
+        self.filament_present = False
+
+    def get_status(self, eventtime):
+        return {'filament_detected': self.filament_present}
+
+    def note_filament_present(self, eventtime, is_filament_present):
+        BenchRunoutHelper.notes += 1
+        self.filament_present = is_filament_present
+
+    def _exec_gcode(self, prefix, template):
+        pass
+
+class BenchPrinter:
+    def __init__(self, sim):
+        self.reactor = BenchReactor()
+        self.gcode = BenchGCode(self.reactor)
+        self.objects = {
+            'gcode': self.gcode,
+            'query_adc': BenchQueryADC(sim),
+            'temperature_sensor filamentValue': object(),
+            'zmod_color': BenchColor(),
+            'print_stats': BenchPrintStats(),
+            'mcu': BenchMCU(),
+        }
+        self.handlers = collections.defaultdict(list)
+
+    def get_reactor(self):
+        return self.reactor
+
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def register_event_handler(self, event, callback):
+        self.handlers[event].append(callback)
+
+    def send_event(self, event, *params):
+        for callback in self.handlers[event]:
+            callback(*params)
+
+    def get_start_args(self):
+        return {}
+
+    def is_shutdown(self):
+        return False
+
+class BenchConfig:
+    def __init__(self, printer, options, name='zmod_ifs'):
+        self.printer = printer
+        self.options = options
+        self.name = name
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get(self, option, default=None):
+        return self.options.get(option, default)
+
+    def getint(self, option, default=None, minval=None, maxval=None):
+        return int(self.options.get(option, default))
+
+    def getfloat(self, option, default=None, minval=None, maxval=None, above=None, below=None):
+        return float(self.options.get(option, default))
+
+    def getboolean(self, option, default=None):
+        return bool(self.options.get(option, default))
+
+    def get_prefix_options(self, prefix):
+        return [o for o in self.options if o.startswith(prefix)]
+
+class ToolChangeBench:
+    def __init__(self, args, workdir):
+        self.args = args
+        self.time_scale = args.time_scale
+        self.sim = IfsSimulator(reply_delay=args.reply_delay, time_scale=self.time_scale,
+                                path_length=args.path_length)
+        # Конфиги zmod во временном каталоге
+        zmod_ifs.FFCONFIG = os.path.join(workdir, 'Adventurer5M.json')
+        zmod_ifs.TYPECONFIG = os.path.join(workdir, 'filament.json')
+        zmod_ifs.FILE_CONFIG = os.path.join(workdir, 'file.json')
+        self.ff_info = {"channel": 0}
+        for i in range(1, 5):
+            self.ff_info[f"ffmType{i}"] = "PLA"
+            self.ff_info[f"ffmColor{i}"] = "#161616"
+        self._write_ff()
+        with open(zmod_ifs.FILE_CONFIG, 'w') as f:
+            json.dump([1, 2, 3, 4], f)
+        with open(zmod_ifs.TYPECONFIG, 'w') as f:
+            json.dump({"PLA": {"filament_tube_length": int(args.path_length)}}, f)
+
+        self.printer = BenchPrinter(self.sim)
+        self.gcode = self.printer.gcode
+        self.reactor = self.printer.reactor
+        self.ifs = zmod_ifs.zmod_ifs(BenchConfig(self.printer, {
+            'port': self.sim.path,
+            'prestage_length': args.prestage_length,
+            'prestage_time': 0.,
+            'state_file': os.path.join(workdir, 'mmu_state.json'),
+        }))
+        self.printer.objects['zmod_ifs'] = self.ifs
+        self.save_variables = {}
+        self.heater = BenchHeater(self.time_scale)
+        self.printer.objects['extruder'] = BenchExtruder(self.heater)
+        self.serial = collections.defaultdict(list)
+        self._instrument()
+        for name, func in (('_INSERT_PRUTOK_IFS', self.macro_insert_prutok),
+                           ('_REMOVE_PRUTOK_IFS', self.macro_remove_prutok),
+                           ('_IFS_REMOVE_PRUTOK', self.macro_remove_prutok),
+                           ('MMU_CHANGE_TOOL', self.macro_change_tool),
+                           ('MMU_CHANGE_TOOL_SEQUENTIAL', self.macro_change_tool_sequential),
+                           ('_MMU_INSERT_BY_SLOT', self.macro_insert_by_slot),
+                           ('_MMU_CUT', self.macro_cut),
+                           ('_MMU_VERIFY_LOAD', self.macro_verify_load),
+                           ('_MMU_VERIFY_UNLOAD', self.macro_verify_unload),
+                           ('_IFS_OFF', self.macro_ifs_off),
+                           ('SAVE_VARIABLE', self.macro_save_variable),
+                           ('G0', self.gcode_move), ('G1', self.gcode_move),
+                           ('G4', self.gcode_dwell),
+                           ('M104', self.gcode_set_temp),
+                           ('M109', self.gcode_wait_temp),
+                           ('TEMPERATURE_WAIT', self.gcode_temperature_wait)):
+            self.gcode.macros[name] = func
+
+        self.printer.send_event("klippy:ready")
+        start = time.monotonic()
+        while not self.ifs.ifs:
+            if time.monotonic() - start > 5.:
+                raise RuntimeError("IFS simulator did not answer")
+            self.reactor.pause(self.reactor.monotonic() + 0.01)
+
+    def close(self):
+        self.ifs._close()
+        self.printer.objects['query_adc'].adc[zmod_ifs.EXTRUDER_ADC].stop = True
+        self.sim.close()
+
+    def _write_ff(self):
+        with open(zmod_ifs.FFCONFIG, 'w') as f:
+            json.dump({"FFMInfo": self.ff_info}, f)
+
+    def _instrument(self):
+        # Фазы IFS_CHANGE_TOOL - в те же фазы отчета
+        change_phase = self.ifs._change_phase
+        def timed_phase(phases, name, start_time):
+            self.gcode.set_phase(CHANGE_PHASES.get(name))
+            return change_phase(phases, name, start_time)
+        self.ifs._change_phase = timed_phase
+        # Подача в симуляторе ускорена, модель кончика прутка должна знать об этом
+        self.ifs.tips.speed_scale = self.time_scale
+        # Время каждой команды последовательного канала до получения ответа
+        send = self.ifs.send_command_and_wait
+        def timed_send(command, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                return send(command, *args, **kwargs)
+            finally:
+                self.serial[command.split()[0]].append(time.monotonic() - start)
+        self.ifs.send_command_and_wait = timed_send
+
+    def _sleep(self, seconds):
+        self.reactor.pause(self.reactor.monotonic() + seconds / self.time_scale)
+
+    def load_tool(self, prutok):
+        # Исходное состояние: пруток prutok заправлен в экструдер
+        eventtime = self.reactor.monotonic()
+        for i in range(1, 5):
+            self.sim.set_position(i, 0.)
+            self.ifs.tips.set_position(i, 0., eventtime)
+        if prutok:
+            self.sim.set_position(prutok, self.args.path_length + 10.)
+            self.ifs.tips.set_position(prutok, self.args.path_length + 10., eventtime, at_sensor=True)
+        self.ff_info["channel"] = prutok
+        self._write_ff()
+        self.save_variables['mmu_current_tool'] = prutok if prutok else -1
+        self.ifs.set_state('mmu_current_tool', prutok if prutok else -1)
+        self.ifs._prestaged = [0] * self.ifs.slot_count
+        # С заправленным прутком сопло горячее (смена во время печати)
+        self.heater.reset(220. if prutok else 25.)
+        # Дождаться отсчета АЦП с новым положением прутка
+        adc = self.printer.objects['query_adc'].adc[zmod_ifs.EXTRUDER_ADC]
+        self.reactor.pause(self.reactor.monotonic() + 2. * adc.report_time)
+
+    # ---- модель принтера ----
+    def gcode_move(self, params):
+        if 'E' in params:
+            speed = float(params.get('F', 300)) / 60.
+            self._sleep(abs(float(params['E'])) / speed)
+        else:
+            self._sleep(MOVE_TIME)
+
+    def gcode_dwell(self, params):
+        self._sleep(float(params.get('P', 0)) / 1000.)
+
+    def _wait_heater(self, done):
+        eventtime = self.reactor.monotonic()
+        while not done(*self.heater.get_temp(eventtime)):
+            eventtime = self.reactor.pause(eventtime + 0.01)
+
+    def gcode_set_temp(self, params):
+        self.heater.set_temp(float(params.get('S', 0)))
+
+    def gcode_wait_temp(self, params):
+        # Как M109 в Klipper: ждем попадания в заданную температуру с обеих сторон
+        if 'S' in params:
+            self.heater.set_temp(float(params['S']))
+        self._wait_heater(lambda temp, target: abs(temp - target) <= 1.)
+
+    def gcode_temperature_wait(self, params):
+        minimum = float(params.get('MINIMUM', 0))
+        self._wait_heater(lambda temp, target: temp >= minimum)
+
+    def macro_save_variable(self, params):
+        self.save_variables[params['VARIABLE'].lower()] = params['VALUE']
+
+    def macro_ifs_off(self, params):
+        raise BenchError("IFS is off")
+
+    # ---- модель макросов zmod и mmu_ad5x.cfg ----
+    def macro_cut(self, params):
+        self.gcode.set_phase('cut')
+        self.gcode.run_script_from_command("G0 X-2.5 Y-7.5 F3000\nG4 P200")
+        for i in range(3):
+            self.gcode.run_script_from_command("G0 Z-5 F600\nG4 P100\nG0 Z-2 F600\nG4 P100")
+
+    def macro_remove_prutok(self, params):
+        prutok = int(params.get('PRUTOK', 1))
+        tube_length = int(params.get('FILAMENT_TUBE_LENGTH', self.args.path_length))
+        unload_speed = int(params.get('FILAMENT_UNLOAD_SPEED', 600))
+        self.gcode.set_phase('heat')
+        self.gcode.run_script_from_command(f"M109 S{params.get('TEMP', 220)}")
+        self.macro_cut(params)
+        self.gcode.set_phase('unload')
+        self.gcode.run_script_from_command(
+            f"G1 E-{params.get('FILAMENT_UNLOAD_AFTER_CUTTING', 5)} F{unload_speed}\n"
+            f"IFS_F24 PRUTOK={prutok}\n"
+            f"IFS_F11 PRUTOK={prutok} LEN={tube_length} SPEED={unload_speed * 2}\n"
+            f"IFS_F39 PRUTOK={prutok}")
+        self.ff_info["channel"] = 0
+        self._write_ff()
+
+    def macro_insert_prutok(self, params):
+        prutok = int(params.get('PRUTOK', 1))
+        if self.ifs.get_extruder_sensor():
+            current = self.ff_info["channel"]
+            if current == prutok:
+                return
+            self.macro_remove_prutok({'PRUTOK': current, 'TEMP': params.get('TEMP', 220)})
+        tube_length = int(params.get('FILAMENT_TUBE_LENGTH', self.args.path_length))
+        unload_speed = int(params.get('FILAMENT_UNLOAD_SPEED', 600))
+        drop = int(params.get('FILAMENT_DROP_LENGTH', 90)) + int(params.get('FILAMENT_DROP_LENGTH_ADD', 0))
+        self.gcode.set_phase('select')
+        self.gcode.run_script_from_command(f"IFS_F24 PRUTOK={prutok}")
+        self.gcode.set_phase('feed')
+        self.gcode.run_script_from_command(
+            f"M104 S{params.get('TEMP', 220)}\n"
+            f"IFS_F10 PRUTOK={prutok} LEN={tube_length + 50} SPEED={unload_speed * 2} CHECK=1")
+        self.gcode.set_phase('heat')
+        self.gcode.run_script_from_command(f"M109 S{params.get('TEMP', 220)}")
+        self.gcode.set_phase('feed')
+        self.gcode.run_script_from_command(
+            f"G1 E{drop} F{params.get('FILAMENT_LOAD_SPEED', 300)}\n"
+            f"G1 E-{params.get('FILAMENT_UNLOAD_AFTER_DROP', 3)} F{unload_speed}")
+        self.gcode.set_phase('verify')
+        self.gcode.run_script_from_command(f"IFS_F23 PRUTOK={prutok}\nIFS_F39 PRUTOK={prutok}")
+        self.ff_info["channel"] = prutok
+        self._write_ff()
+
+    def macro_verify_load(self, params):
+        self.gcode.set_phase('verify')
+        self.gcode.run_script_from_command("G4 P500")
+        if not self.ifs.get_extruder_sensor():
+            raise BenchError("Load verification failed: no filament in head")
+
+    def macro_verify_unload(self, params):
+        self.gcode.set_phase('verify')
+        self.gcode.run_script_from_command("G4 P300")
+        if self.ifs.get_extruder_sensor():
+            raise BenchError("Unload verification failed: filament still in head")
+
+    def macro_insert_by_slot(self, params):
+        self.gcode.run_script_from_command(f"INSERT_PRUTOK_IFS PRUTOK={params.get('SLOT', 1)}")
+
+    def macro_change_tool(self, params):
+        # MMU_CHANGE_TOOL из mmu_ad5x.cfg: проверки и передача в IFS_CHANGE_TOOL
+        current = int(self.ifs.state.variables.get('mmu_current_tool', -1))
+        new = int(params.get('TOOL', 1))
+        temp = int(params.get('HOTEND_TEMP', 0)) or int(self.heater.target) or 220
+        self.gcode.run_script_from_command(
+            f"IFS_CHANGE_TOOL TOOL={new} CURRENT={current} HOTEND_TEMP={temp} INSERT_LEN=90 INSERT_SPEED=1200 "
+            f"REMOVE_LEN={int(self.args.path_length)} REMOVE_SPEED=1200 ANTI_OOZE=30")
+
+    def macro_change_tool_sequential(self, params):
+        # Прежний MMU_CHANGE_TOOL: фазы по очереди, паузы G4 и блокирующий M109
+        current = int(self.save_variables.get('mmu_current_tool', -1))
+        new = int(params.get('TOOL', 1))
+        temp = int(params.get('HOTEND_TEMP', 0)) or 220
+        if current == new:
+            return
+        if current >= 0:
+            self.gcode.set_phase('unload')
+            self.gcode.run_script_from_command(f"G91\nG0 E-20 F300\nG90\nM104 S{temp - 30}")
+            self.gcode.run_script_from_command("_MMU_CUT")
+            self.gcode.set_phase('unload')
+            self.gcode.run_script_from_command(
+                f"IFS_F11 PRUTOK={current} LEN={int(self.args.path_length)} SPEED=1200 WAIT=1 CHECK=0")
+            self.gcode.run_script_from_command("_MMU_VERIFY_UNLOAD")
+        self.gcode.set_phase('select')
+        self.gcode.run_script_from_command(f"INSERT_PRUTOK_IFS PRUTOK={new}")
+        self.gcode.set_phase('select')
+        self.gcode.run_script_from_command("G4 P500")
+        self.gcode.set_phase('heat')
+        self.gcode.run_script_from_command(f"M104 S{temp}")
+        self.gcode.set_phase('feed')
+        self.gcode.run_script_from_command(f"IFS_F10 PRUTOK={new} LEN=90 SPEED=1200 WAIT=1 CHECK=0")
+        self.gcode.set_phase('heat')
+        self.gcode.run_script_from_command(f"M109 S{temp}")
+        self.gcode.set_phase('verify')
+        self.gcode.run_script_from_command(
+            f"IFS_F23 PRUTOK={new} WAIT=1\nIFS_MOTION\n_MMU_VERIFY_LOAD\n"
+            f"SAVE_VARIABLE VARIABLE=mmu_current_tool VALUE={new}\n"
+            f"SAVE_VARIABLE VARIABLE=mmu_state VALUE=idle\nSET_CURRENT_PRUTOK")
+
+    # ---- сценарии ----
+    def run_scenario(self, name):
+        if name == 'insert':
+            self.load_tool(0)
+            phase, script = 'select', "INSERT_PRUTOK_IFS PRUTOK=2"
+        elif name == 'remove':
+            self.load_tool(2)
+            phase, script = 'unload', "REMOVE_PRUTOK_IFS PRUTOK=2"
+        elif name == 'autoinsert':
+            self.load_tool(0)
+            phase, script = 'feed', "IFS_AUTOINSERT PRUTOK=3"
+        elif name == 'sequential':
+            self.load_tool(1)
+            phase, script = 'select', f"MMU_CHANGE_TOOL_SEQUENTIAL TOOL=2 HOTEND_TEMP={self.args.hotend_temp}"
+        elif name == 'prestaged':
+            # Пруток 2 подведен заранее, пока печатал пруток 1
+            self.load_tool(1)
+            self.gcode.run_script_from_command("IFS_PRESTAGE PRUTOK=2")
+            phase, script = 'select', f"MMU_CHANGE_TOOL TOOL=2 HOTEND_TEMP={self.args.hotend_temp}"
+        else:
+            self.load_tool(1)
+            phase, script = 'select', f"MMU_CHANGE_TOOL TOOL=2 HOTEND_TEMP={self.args.hotend_temp}"
+        self.gcode.phase = None
+        self.gcode.phase_times.clear()
+        self.serial.clear()
+        rx_lines = self.sim.rx_lines
+        start = time.monotonic()
+        self.gcode.set_phase(phase)
+        self.gcode.run_script_from_command(script)
+        self.gcode.set_phase(None)
+        total = time.monotonic() - start
+        serial = {cmd: list(times) for cmd, times in self.serial.items()}
+        polls = self.sim.rx_lines - rx_lines - sum(len(t) for t in serial.values())
+        return {'total': total, 'phases': dict(self.gcode.phase_times),
+                'serial': serial, 'polls': polls}
+
+TOOLCHANGE_SCENARIOS = ('insert', 'remove', 'autoinsert', 'sequential', 'change', 'prestaged')
+
+def _summarize(runs):
+    # Медиана по прогонам для общего времени и каждой фазы
+    summary = {'total': statistics.median(r['total'] for r in runs), 'phases': {}}
+    for phase in PHASES:
+        summary['phases'][phase] = statistics.median(r['phases'].get(phase, 0.) for r in runs)
+    return summary
+
+def _check_regression(name, summary, baseline, threshold, slack):
+    failures = []
+    base = baseline.get(name)
+    if not base:
+        return failures
+    values = [('total', summary['total'], base['total'])]
+    values += [(phase, summary['phases'][phase], base['phases'].get(phase, 0.)) for phase in PHASES]
+    for key, value, ref in values:
+        if value > ref * (1. + threshold) + slack:
+            failures.append(f"{name}.{key}: {value:.3f}s > baseline {ref:.3f}s")
+    return failures
+
+def bench_toolchange(args):
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    scenarios = args.scenario or TOOLCHANGE_SCENARIOS
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = ToolChangeBench(args, workdir)
+        try:
+            for name in scenarios:
+                runs = [bench.run_scenario(name) for i in range(args.runs)]
+                summary = _summarize(runs)
+                results[name] = summary
+                print(f"{name}: {summary['total']:.3f}s (median of {args.runs})")
+                for phase in PHASES:
+                    print(f"  {phase:8s} {summary['phases'][phase]:7.3f}s")
+                serial = collections.defaultdict(list)
+                for run in runs:
+                    for cmd, times in run['serial'].items():
+                        serial[cmd] += times
+                for cmd in sorted(serial):
+                    times = serial[cmd]
+                    print(f"  {cmd:8s} x{len(times) / args.runs:<4.0f} "
+                          f"mean {statistics.mean(times) * 1000:7.1f} ms  max {max(times) * 1000:7.1f} ms")
+                print(f"  F13 polls {statistics.median(r['polls'] for r in runs):.0f}")
+                failures += _check_regression(name, summary, baseline, args.threshold, args.slack)
+        finally:
+            bench.close()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    if failures:
+        print("REGRESSION:")
+        for failure in failures:
+            print("  " + failure)
+        return 1
+    return 0
+
+# ---- Просмотр вперед G-кода ----
+
+class BenchSdcard:
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+
+    def get_status(self, eventtime):
+        return {'file_path': self.path, 'file_position': self.position}
+
+def _write_gcode(path, size, change_every):
+    # Слои из G1 с экструзией 0.05 мм на строку и сменой инструмента
+    # каждые change_every строк. Возвращает число строк и смен.
+    lines = changes = 0
+    written = 0
+    with open(path, 'w') as f:
+        f.write("G90\nM83\nG92 E0\n")
+        while written < size:
+            chunk = []
+            for i in range(1000):
+                lines += 1
+                if lines % change_every == 0:
+                    changes += 1
+                    if changes % 2:
+                        chunk.append(f"T{changes % 4}")
+                    else:
+                        chunk.append(f"MMU_CHANGE_TOOL TOOL={changes % 4 + 1} HOTEND_TEMP=220")
+                chunk.append(f"G1 X{100 + i % 50:.3f} Y{100 + i % 37:.3f} E0.05 F3000 ; perimeter")
+            data = "\n".join(chunk) + "\n"
+            f.write(data)
+            written += len(data)
+    return lines, changes
+
+def bench_lookahead(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'bench.gcode')
+        lines, changes = _write_gcode(path, args.size * 1024 * 1024, args.change_every)
+        size = os.path.getsize(path)
+        sdcard = BenchSdcard(path)
+        reactor = BenchReactor()
+        printer = types.SimpleNamespace(get_reactor=lambda: reactor,
+                                        lookup_object=lambda name, default=None: sdcard)
+        lookahead = zmod_ifs.ToolChangeLookahead(printer)
+        lookahead.start()
+
+        # Первая смена: change_every - 1 строк G1 по 0.05 мм
+        while not lookahead.changes and not lookahead.eof:
+            lookahead._scan_event(0.)
+        first = lookahead.get_schedule(0.)[0]
+        assert abs(first['distance'] - (args.change_every - 1) * 0.05) < 1e-6, first
+
+        # Печать идет следом за сканированием, окно всегда заполнено
+        lookahead._reset(None)
+        sdcard.position = 0
+        def follow():
+            found = ticks = 0
+            while not lookahead.eof:
+                lookahead._scan_event(0.)
+                ticks += 1
+                # Все найденное считаем и "печатаем"
+                found += len(lookahead.changes)
+                lookahead.changes.clear()
+                sdcard.position = lookahead.scan_pos - len(lookahead.partial)
+            lookahead._reset(None)
+            sdcard.position = 0
+            return found, ticks
+        start = time.process_time()
+        found, ticks = follow()
+        elapsed = time.process_time() - start
+        # Память отдельным проходом, tracemalloc сильно замедляет разбор
+        tracemalloc.start()
+        follow()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print(f"G-code look-ahead, {size / 1048576:.1f} MB, {lines} lines, {changes} tool changes:")
+    print(f"  found changes        {found}")
+    print(f"  scan CPU             {elapsed / (size / 1048576) * 1000:6.1f} ms/MB  "
+          f"{elapsed / lines * 1e6:5.2f} us/line")
+    print(f"  chunks of {zmod_ifs.LOOKAHEAD_CHUNK // 1024} KB      {ticks}, "
+          f"{elapsed / ticks * 1000:.2f} ms each")
+    print(f"  peak traced memory   {peak / 1024:.0f} KB")
+    if found != changes:
+        print("MISMATCH: not every tool change was found")
+        return 1
+    return 0
+
+# Датчики zmod_ifs_switch_sensor/zmod_ifs_motion_sensor грузятся как модули
+# klippy/extras: пакет extras из этого каталога, RunoutHelper - счетчик вызовов
+def _load_sensor_modules():
+    package = types.ModuleType('extras')
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    switch = types.ModuleType('extras.filament_switch_sensor')
+    switch.RunoutHelper = BenchRunoutHelper
+    package.filament_switch_sensor = switch
+    sys.modules['extras'] = package
+    sys.modules['extras.filament_switch_sensor'] = switch
+    import importlib
+    return (importlib.import_module('extras.zmod_ifs_switch_sensor'),
+            importlib.import_module('extras.zmod_ifs_motion_sensor'))
+
+def _reactor_load(bench, seconds):
+    # Доля времени реактора в обработчиках, мс на секунду
+    reactor = bench.reactor
+    busy = reactor.busy
+    notes = BenchRunoutHelper.notes
+    start = time.monotonic()
+    reactor.pause(start + seconds)
+    elapsed = time.monotonic() - start
+    return (reactor.busy - busy) * 1000. / elapsed, (BenchRunoutHelper.notes - notes) / elapsed
+
+def bench_sensors(args):
+    switch_module, motion_module = _load_sensor_modules()
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = ToolChangeBench(args, workdir)
+        try:
+            printer = bench.printer
+            results = [('IFS only', _reactor_load(bench, args.seconds))]
+            sensors = [switch_module.load_config_prefix(BenchConfig(printer, {}, 'zmod_ifs_switch_sensor head_switch_sensor'))]
+            for port in range(1, 5):
+                sensors.append(switch_module.load_config_prefix(BenchConfig(
+                    printer, {'type': 'port', 'port': port}, f'zmod_ifs_switch_sensor _ifs_port_sensor_{port}')))
+            for port in range(1, 5):
+                sensors.append(motion_module.load_config_prefix(BenchConfig(
+                    printer, {'port': port, 'detection_length': 10.}, f'zmod_ifs_motion_sensor _ifs_motion_sensor_{port}')))
+            for sensor in sensors:
+                sensor._handle_ready()
+            results.append(('9 sensors, idle', _reactor_load(bench, args.seconds)))
+            printer.objects['print_stats'].state = 'printing'
+            printer.send_event('idle_timeout:printing', 0.)
+            results.append(('9 sensors, printing', _reactor_load(bench, args.seconds)))
+        finally:
+            bench.close()
+    for name, (busy, notes) in results:
+        print(f"{name:20} reactor {busy:6.2f} ms/s  runout notes {notes:6.1f}/s")
+    return 0
+
+def _status_cost(bench, count, rebuild):
+    # Опрос get_status каждые 0.25 с (как Moonraker), время реактора не двигается
+    ifs = bench.ifs
+    eventtime = bench.reactor.monotonic()
+    status = None
+    built = 0
+    version = ifs._status_version
+    start = time.perf_counter()
+    for i in range(count):
+        eventtime += 0.25
+        if rebuild:
+            last = ifs._build_status_diag(eventtime)
+            last.update(ifs._build_status_core(eventtime))
+        else:
+            last = ifs.get_status(eventtime)
+        if last is not status:
+            status = last
+            built += 1
+    return (time.perf_counter() - start) * 1e6 / count, built, ifs._status_version - version
+
+def bench_status(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = ToolChangeBench(args, workdir)
+        try:
+            bench.load_tool(1)
+            results = [('rebuild every call', _status_cost(bench, args.count, True)),
+                       ('versioned snapshot', _status_cost(bench, args.count, False))]
+        finally:
+            bench.close()
+    print(f"get_status, {args.count} polls at 4 Hz:")
+    for name, (cost, built, versions) in results:
+        print(f"  {name:20} {cost:7.2f} us/poll  {built:6d} snapshots  {versions:4d} versions")
+    return 0
+
+# Сбои связи и драйвера во время F10: время восстановления и сколько прутка
+# прошло на самом деле (продолжение с остатка, а не повтор всей длины)
+RECOVERY_FAULTS = {
+    'none':          lambda sim: None,
+    'lost reply':    lambda sim: sim.fault_drop('F10'),
+    'lost command':  lambda sim: sim.fault_empty(1),
+    'driver error':  lambda sim: sim.fault_drv_error_at(150.),
+}
+
+def bench_recovery(args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = ToolChangeBench(args, workdir)
+        try:
+            stats = bench.ifs.units[0].stats
+            for name, fault in RECOVERY_FAULTS.items():
+                bench.load_tool(0)
+                before = stats.get_stats()
+                fault(bench.sim)
+                start = time.monotonic()
+                try:
+                    bench.gcode.run_script(f"IFS_F10 PRUTOK=1 LEN={args.length} SPEED={args.speed}")
+                    error = None
+                except BenchError as e:
+                    error = str(e)
+                elapsed = time.monotonic() - start
+                after = stats.get_stats()
+                steps = [f"{step}={count - before['recovery']['steps'][step]}"
+                         for step, count in after['recovery']['steps'].items()
+                         if count != before['recovery']['steps'][step]]
+                results.append((name, elapsed, bench.sim.get_position(1),
+                                after['recovery']['resumed_mm'] - before['recovery']['resumed_mm'],
+                                " ".join(steps), error))
+        finally:
+            bench.close()
+    print(f"IFS_F10 LEN={args.length} with a fault:")
+    for name, elapsed, position, resumed, steps, error in results:
+        print(f"  {name:14} {elapsed:6.2f}s  fed {position:6.1f} mm  resumed {resumed:6.1f} mm  {steps}"
+              + (f"  ERROR {error}" if error else ""))
+    return 0 if not any(r[5] for r in results) else 1
+
+# Пропадание питания посреди записи журнала состояния: что переживет restart.
+# Каждый сценарий портит хвост журнала, затем store загружается заново, пишет
+# новую переменную и загружается еще раз - оба значения должны сохраниться.
+STATE_TAILS = {
+    'clean':          b"",
+    'torn line':      b'{"seq": 2, "na',
+    'no newline':     b'{"seq": 2, "name": "x", "value": 1}',
+    'missing fields': b'{"seq": 2}\n',
+}
+
+def bench_state(args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, tail in STATE_TAILS.items():
+            path = os.path.join(workdir, name.replace(' ', '_') + '.json')
+            store = zmod_ifs.StateStore(path)
+            store.load()
+            store.set('a', 1)
+            store.flush()
+            with open(store.journal_path, 'ab') as f:
+                f.write(tail)
+            store = zmod_ifs.StateStore(path)
+            store.load()
+            store.set('b', 2)
+            store.flush()
+            store = zmod_ifs.StateStore(path)
+            store.load()
+            results.append((name, store.variables))
+        path = os.path.join(workdir, 'flush.json')
+        store = zmod_ifs.StateStore(path)
+        store.load()
+        start = time.perf_counter()
+        for i in range(args.count):
+            store.set('mmu_current_tool', i)
+            store.flush()
+        flush_cost = (time.perf_counter() - start) * 1e3 / args.count
+    print("State journal after power loss and restart:")
+    failed = False
+    for name, variables in results:
+        ok = variables == {'a': 1, 'b': 2}
+        failed = failed or not ok
+        print(f"  {name:16} {variables}" + ("" if ok else "  LOST"))
+    print(f"flush with fsync: {flush_cost:.2f} ms, {store.get_stats()['compactions']} compactions")
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="IFS benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('parser', help="F13 status line parser")
+    p.add_argument('--count', type=int, default=200000)
+    p.set_defaults(func=bench_parser)
+    p = sub.add_parser('toolchange', help="tool change latency against the IFS simulator")
+    p.add_argument('--scenario', action='append', choices=TOOLCHANGE_SCENARIOS,
+                   help="run only this scenario (repeatable)")
+    p.add_argument('--runs', type=int, default=3)
+    p.add_argument('--time-scale', type=float, default=20., help="speed up modeled moves, heating and feeding")
+    p.add_argument('--path-length', type=float, default=1000., help="IFS to extruder length, mm")
+    p.add_argument('--reply-delay', type=float, default=0.002, help="simulated IFS reply delay, s")
+    p.add_argument('--prestage-length', type=int, default=850, help="prestage_length for the prestaged scenario, mm")
+    p.add_argument('--hotend-temp', type=int, default=220,
+                   help="new tool temperature in change scenarios, °C (the old tool prints at 220)")
+    p.add_argument('--save', help="write the results as a baseline JSON")
+    p.add_argument('--baseline', help="fail if slower than this baseline JSON")
+    p.add_argument('--threshold', type=float, default=0.15, help="allowed relative slowdown")
+    p.add_argument('--slack', type=float, default=0.05, help="allowed absolute slowdown, s")
+    p.set_defaults(func=bench_toolchange)
+    p = sub.add_parser('lookahead', help="streaming G-code tool change scanner")
+    p.add_argument('--size', type=int, default=50, help="generated file size, MB")
+    p.add_argument('--change-every', type=int, default=5000, help="G1 lines between tool changes")
+    p.set_defaults(func=bench_lookahead)
+    p = sub.add_parser('sensors', help="reactor time of the switch/port/motion sensors")
+    p.add_argument('--seconds', type=float, default=10., help="measure each state for this long")
+    p.set_defaults(func=bench_sensors, time_scale=1., path_length=1000., reply_delay=0.002, prestage_length=0)
+    p = sub.add_parser('status', help="get_status cost when polled by Moonraker/UI")
+    p.add_argument('--count', type=int, default=20000, help="number of polls")
+    p.set_defaults(func=bench_status, time_scale=1., path_length=1000., reply_delay=0.002, prestage_length=0)
+    p = sub.add_parser('recovery', help="recovery time after a lost reply or a driver error")
+    p.add_argument('--length', type=int, default=400, help="feed length, mm")
+    p.add_argument('--speed', type=int, default=1200, help="feed speed, mm/min")
+    p.add_argument('--time-scale', type=float, default=20., help="speed up modeled moves")
+    p.set_defaults(func=bench_recovery, path_length=1000., reply_delay=0.002, prestage_length=0)
+    p = sub.add_parser('state', help="state journal recovery after power loss, flush cost")
+    p.add_argument('--count', type=int, default=1000, help="number of flushes")
+    p.set_defaults(func=bench_state)
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+# Симулятор IFS на псевдотерминале
+# Copyright (C) 2025 ghzserg https://github.com/ghzserg/zmod
+#
+# Позволяет запускать и измерять zmod_ifs без железа:
+#   python3 ifs_simulator.py --link /tmp/ifs_sim
+# и в printer.cfg:
+#   [zmod_ifs]
+#   port: /tmp/ifs_sim
+#
+# Команды в stdin симулятора (внесение сбоев на ходу):
+#   drv                 - ошибка драйвера (FFS_state 127) до F15
+#   empty N             - не отвечать на N следующих команд
+#   drop CMD [N]        - выполнить, но не отвечать на N следующих команд CMD
+#   drv_at MM           - ошибка драйвера, когда текущая подача пройдет MM мм
+#   delay S             - задержка ответа S секунд
+#   stall PORT          - пруток в порту перестает двигаться
+#   silk PORT 0|1       - убрать/вставить пруток в порт
+#   insert PORT         - пользователь вставил пруток (ffs_channels_insert)
+#   status              - вывести состояние
+import argparse
+import os
+import pty
+import re
+import sys
+import threading
+import time
+import tty
+
+FFS_STATUS_DELTA     = 11
+FFS_STATUS_READY     =  5
+FFS_STATUS_ZAGAT     =  7
+FFS_STATUS_ZAGRUZKA  = 11
+FFS_STATUS_VIGRUZKA  = 15
+FFS_STATUS_OTZGAT    = 12
+FFS_STATUS_DRV_ERROR = 127
+
+CLAMP_TIME = 0.3        # Сколько длится прижим/отжим катушки, с
+PORTS = 4
+
+class IfsSimulator:
+    def __init__(self, ports=PORTS, reply_delay=0.002, time_scale=1.,
+                 path_length=1000., link=None):
+        self.ports = ports
+        self.reply_delay = reply_delay          # Задержка ответа, с
+        self.time_scale = time_scale            # Ускорение времени подачи
+        self.path_length = path_length          # Длина пути от IFS до экструдера, мм
+        self.lock = threading.Lock()
+        self.silk = (1 << ports) - 1            # В каких портах есть пруток
+        self.insert = 0                         # ffs_channels_insert
+        self.chan = 0
+        self.clamped = 0                        # Прижатые порты
+        self.position = [0.] * ports            # Сколько прутка вытолкнуто из IFS по портам, мм
+        self.move = None                        # (порт, направление, скорость мм/с, остаток мм, время окончания прижима)
+        self.action = None                      # (состояние, время окончания) для прижима/отжима
+        self.drv_error = False
+        self.stalled = set()
+        self.empty_left = 0
+        self.garbage_left = 0
+        self.drv_error_on_feed = 0              # Через сколько F10 выдать ошибку драйвера
+        self.drv_error_at = None                # Ошибка драйвера после стольких мм подачи, движение встает
+        self.moved = 0.                         # Пройдено текущей подачей, мм
+        self.drop = {}                          # команда -> сколько ответов потерять
+        self.rx_lines = 0
+        self.last_update = time.monotonic()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+        self.stop = False
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stop = True
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+    # ---- модель ----
+    def _advance(self):
+        now = time.monotonic()
+        dt = (now - self.last_update) * self.time_scale
+        self.last_update = now
+        if self.action is not None and now >= self.action[1]:
+            self.action = None
+        if self.move is None:
+            return
+        port, direction, speed, left = self.move
+        if port in self.stalled:
+            return
+        step = min(left, speed * dt)
+        if direction > 0 and self.drv_error_at is not None and self.moved + step >= self.drv_error_at:
+            step = max(0., self.drv_error_at - self.moved)
+            self.drv_error_at = None
+            self.drv_error = True
+            left = step
+        self.moved += step
+        idx = port - 1
+        self.position[idx] = max(0., self.position[idx] + direction * step)
+        left -= step
+        if left <= 1e-6:
+            self.move = None
+        else:
+            self.move = (port, direction, speed, left)
+
+    def get_state(self):
+        if self.drv_error:
+            return FFS_STATUS_DRV_ERROR
+        if self.move is not None:
+            port, direction = self.move[0], self.move[1]
+            base = FFS_STATUS_ZAGRUZKA if direction > 0 else FFS_STATUS_VIGRUZKA
+            return base + (port - 1) * FFS_STATUS_DELTA
+        if self.action is not None:
+            return self.action[0]
+        return FFS_STATUS_READY
+
+    def get_stall_state(self):
+        if self.move is None or self.drv_error:
+            return 0
+        port = self.move[0]
+        if port in self.stalled:
+            return 0
+        return 1 << (port - 1)
+
+    def extruder_triggered(self):
+        with self.lock:
+            self._advance()
+            return any(pos >= self.path_length for pos in self.position)
+
+    def get_position(self, port):
+        with self.lock:
+            self._advance()
+            return self.position[port - 1]
+
+    def set_position(self, port, position):
+        with self.lock:
+            self._advance()
+            self.position[port - 1] = position
+
+    def status_line(self):
+        return (f"FFS_state: {self.get_state()} silk_state: {self.silk} chan: {self.chan} "
+                f"ffs_channels_insert: {self.insert} stall_state: {self.get_stall_state()}")
+
+    # ---- протокол ----
+    def handle(self, line):
+        with self.lock:
+            self._advance()
+            parts = line.split()
+            name = parts[0]
+            args = {}
+            for part in parts[1:]:
+                m = re.match(r'([A-Z])(\d*)', part)
+                if m:
+                    args[m.group(1)] = int(m.group(2)) if m.group(2) else None
+            chan = args.get('C')
+            if name == 'F13':
+                reply = self.status_line()
+                # Событие вставки отдается один раз
+                self.insert = 0
+                return reply
+            if name == 'F15':
+                self.drv_error = False
+                self.move = None
+                return "F15 ok."
+            if name == 'F112':
+                self.move = None
+                return "F112 ok."
+            if name == 'F18':
+                self.move = None
+                self.clamped = 0
+                self.action = (FFS_STATUS_OTZGAT, time.monotonic() + CLAMP_TIME / self.time_scale)
+                return "F18 ok"
+            if chan is None or not 1 <= chan <= self.ports:
+                return f"{name} error."
+            if name in ('F10', 'F11'):
+                length = args.get('L') or 0
+                speed = (args.get('S') or 1) / 60.
+                self.chan = chan
+                if name == 'F10':
+                    if self.drv_error_on_feed:
+                        self.drv_error_on_feed -= 1
+                        if not self.drv_error_on_feed:
+                            self.drv_error = True
+                    self.move = (chan, 1, speed, float(length))
+                    self.moved = 0.
+                    return f"F10 ok. FFS channel {chan} feeding."
+                self.move = (chan, -1, speed, float(length))
+                self.moved = 0.
+                return f"F11 ok. FFS channel {chan} exiting."
+            if name == 'F23':
+                self.chan = chan
+                return f"F23 ok. chan {chan}."
+            if name == 'F24':
+                self.clamped |= 1 << (chan - 1)
+                self.action = (FFS_STATUS_ZAGAT + (chan - 1) * FFS_STATUS_DELTA,
+                               time.monotonic() + CLAMP_TIME / self.time_scale)
+                return f"F24 ok. chan {chan}."
+            if name == 'F39':
+                self.clamped &= ~(1 << (chan - 1))
+                self.action = (FFS_STATUS_OTZGAT + (chan - 1) * FFS_STATUS_DELTA,
+                               time.monotonic() + CLAMP_TIME / self.time_scale)
+                return f"F39 ok. FFS channel {chan} release."
+            return f"{name} unknown."
+
+    def _serve(self):
+        buf = b''
+        while not self.stop:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            buf += data.replace(b'\xff', b'')
+            while b'\n' in buf:
+                raw, buf = buf.split(b'\n', 1)
+                line = raw.strip().decode('utf-8', errors='ignore')
+                if not line:
+                    continue
+                self.rx_lines += 1
+                if self.empty_left:
+                    self.empty_left -= 1
+                    continue
+                reply = self.handle(line)
+                name = line.split()[0]
+                if self.drop.get(name):
+                    # Команда выполнена, ответ потерян
+                    self.drop[name] -= 1
+                    continue
+                if self.reply_delay:
+                    time.sleep(self.reply_delay)
+                out = (reply + "\r\n").encode()
+                if self.garbage_left:
+                    self.garbage_left -= 1
+                    out = b'\x00\x13\xfe garbage' + out
+                try:
+                    os.write(self.master, out)
+                except OSError:
+                    return
+
+    # ---- внесение сбоев ----
+    def fault_drv_error(self):
+        with self.lock:
+            self.drv_error = True
+
+    def fault_empty(self, count=1):
+        self.empty_left = count
+
+    def fault_drop(self, name, count=1):
+        self.drop[name] = count
+
+    def fault_drv_error_at(self, length):
+        with self.lock:
+            self._advance()
+            self.drv_error_at = self.moved + length if self.move is not None else length
+
+    def fault_garbage(self, count=1):
+        self.garbage_left = count
+
+    def fault_stall(self, port, stalled=True):
+        with self.lock:
+            self._advance()
+            if stalled:
+                self.stalled.add(port)
+            else:
+                self.stalled.discard(port)
+
+    def set_silk(self, port, present):
+        with self.lock:
+            if present:
+                self.silk |= 1 << (port - 1)
+            else:
+                self.silk &= ~(1 << (port - 1))
+
+    def user_insert(self, port):
+        with self.lock:
+            self.silk |= 1 << (port - 1)
+            self.insert = 1 << (port - 1)
+
+    def console(self, line):
+        parts = line.split()
+        if not parts:
+            return ""
+        cmd = parts[0]
+        try:
+            if cmd == 'drv':
+                self.fault_drv_error()
+            elif cmd == 'empty':
+                self.fault_empty(int(parts[1]) if len(parts) > 1 else 1)
+            elif cmd == 'drop':
+                self.fault_drop(parts[1], int(parts[2]) if len(parts) > 2 else 1)
+            elif cmd == 'drv_at':
+                self.fault_drv_error_at(float(parts[1]))
+            elif cmd == 'garbage':
+                self.fault_garbage(int(parts[1]) if len(parts) > 1 else 1)
+            elif cmd == 'delay':
+                self.reply_delay = float(parts[1])
+            elif cmd == 'stall':
+                self.fault_stall(int(parts[1]), len(parts) < 3 or parts[2] != '0')
+            elif cmd == 'silk':
+                self.set_silk(int(parts[1]), parts[2] != '0')
+            elif cmd == 'insert':
+                self.user_insert(int(parts[1]))
+            elif cmd != 'status':
+                return f"unknown command {cmd}"
+        except (IndexError, ValueError):
+            return f"bad arguments: {line}"
+        with self.lock:
+            self._advance()
+            positions = " ".join(f"{p:.0f}" for p in self.position)
+            return f"{self.status_line()} pos: {positions} rx: {self.rx_lines}"
+
+def main():
+    parser = argparse.ArgumentParser(description="IFS simulator on a pseudo-terminal")
+    parser.add_argument('--link', help="symlink to create for the pty, e.g. /tmp/ifs_sim")
+    parser.add_argument('--delay', type=float, default=0.002, help="reply delay, s")
+    parser.add_argument('--time-scale', type=float, default=1., help="speed up feed/retract time")
+    parser.add_argument('--path-length', type=float, default=1000., help="IFS to extruder length, mm")
+    parser.add_argument('--drv-error-on-feed', type=int, default=0,
+                        help="report driver error 127 on the N-th F10")
+    args = parser.parse_args()
+    sim = IfsSimulator(reply_delay=args.delay, time_scale=args.time_scale,
+                       path_length=args.path_length, link=args.link)
+    sim.drv_error_on_feed = args.drv_error_on_feed
+    print(f"IFS simulator on {sim.path}" + (f" ({args.link})" if args.link else ""), flush=True)
+    try:
+        for line in sys.stdin:
+            reply = sim.console(line)
+            if reply:
+                print(reply, flush=True)
+        while True:
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,9 @@
 # (C) 2025 ghzserg https://github.com/ghzserg/zmod/
+import ast
+import bisect
+import collections
+import heapq
+import itertools
 import json
 import os
 import serial
@@ -6,6 +11,7 @@ import re
 import time
 import threading
 import logging
+import math
 
 # Параметры порта
 PORT = '/dev/ttyS4'
@@ -16,10 +22,56 @@ BYTESIZE = 8
 TIMEOUT = 0.2
 HOST_REPORT_TIME = 0.2
 OPROS_EXTRUDER = 0.1
+RESPONSE_TIMEOUT = 0.5      # Сколько ждать полную строку ответа
+STATUS_TIMEOUT = 5.0        # Сколько ждать очередной снимок статуса F13
+POLL_ACTIVE_HOLD = 2.0      # Сколько держать частый опрос после отправки команды
+MAX_LINE_LENGTH = 512       # Длина строки без перевода, после которой буфер считается мусором
+IFS_PORTS = 4               # Портов в одном IFS: пруток N - порт (N-1)%4+1 юнита (N-1)//4
 
 FFCONFIG='/usr/prog/config/Adventurer5M.json'
 TYPECONFIG='/usr/data/config/mod_data/filament.json'
 FILE_CONFIG='/usr/data/config/mod_data/file.json'
+CONFIG_FLUSH_DELAY = 1.0    # Через сколько секунд записывать отложенные изменения конфигов
+
+# Состояние MMU (текущий инструмент, стадия смены): снимок + журнал изменений
+STATE_FILE='/usr/data/config/mod_data/mmu_state.json'
+STATE_FLUSH_DELAY = 0.5     # Через сколько секунд дописывать изменения в журнал
+STATE_COMPACT_RECORDS = 256 # После скольких записей журнала переписать снимок
+STATE_VARIABLES = ('mmu_current_tool', 'mmu_state', 'mmu_detected_slot',
+                   'extruder_1_config', 'extruder_2_config', 'extruder_3_config', 'extruder_4_config')
+
+# Параметры типа филамента в filament.json по умолчанию
+FILAMENT_DEFAULTS = {
+    "filament_unload_before_cutting": 0,    # На сколько поднимать филамент ПЕРЕД тем  как отрезать (по умолчанию 0)
+    "filament_unload_after_cutting": 5,     # На сколько поднимать филамент ПОСЛЕ того как отрезали (по умолчанию 5)
+    "filament_unload_after_drop": 3,        # Ретракт после сброса филамента (немного вытащить пруток из сопла, для предотвращения протечки,
+                                            #   когда смена прутка уже прошла и сопло едет дальше печатать)
+    "filament_load_speed": 300,             # Скорость загрузки филамента (скорость вращения экструдера, 300 мм/м = 5 мм/c)
+    "filament_unload_speed": 600,           # Скорость подъема  филамента (скорость вращения экструдера, 600 мм/м = 10 мм/c)
+                                            #   IFS работает на скорости 2*filament_unload_speed
+    "filament_tube_length": 1000,           # Длина полной загрузки/выгрузки филамента (длинна тефлоновой трубки от IFS до головы, полезно дял тех у кого не стоковые трубки)
+    "filament_drop_length": 90,             # Длина сброса в какашник (дистанция прутка который будет выдавлен в какашник, то есть дистанция прочистки сопла
+                                            #   от преведущего филамената и смешения цветов, полезно когда не используется башня для сброса смешанных цветов)
+    "filament_drop_length_add": 90,         # Дополнительная длина сброса в какашник при смене типа филамента (смена разных материаалов, к примеру PETG на композитный PETG)
+    "nozzle_cleaning_length": 60,           # Длина прочистки сопла (дистанция на сколько вытаскивать пруток из экструдера
+                                            #   (то есть на сколько милиметров доставать пруток из фидера, когда текущая катушка больше не используется)
+    "filament_fan_speed": 102,              # Скорость работы вентилятора при сбросе через какашник (то есть сдувает подтеки из сопла, когда происходит очистка)
+    #"temp": 230,                           # Температура до которой необхоидмо разогреть сопло для смены филамента
+
+    "filament_autoinsert_empty_length": 600,# Сколько мм затягивать при автоматической вставке прутка, если экструдер пустой
+    "filament_autoinsert_full_length": 550, # Сколько мм затягивать при автоматической вставке прутка, если экструдер был занят
+    "filament_autoinsert_ret_length": 90,   # Сколько мм втягивать обратно, если сработал эдатчик экструдера (срабатывает только на пустом экструдере)
+    "filament_autoinsert_speed": 1200,      # Скорость вставки прутка, если feed_profile пустой
+
+    # Профили подачи: отрезки [длина мм, скорость мм/мин] по порядку, длина 0 - остаток пути.
+    # Скорость меняется на ходу, без остановки IFS между отрезками. По умолчанию пустые
+    # (одна скорость), включаются в filament.json, например [[0, 1800], [100, 600]].
+    "feed_profile": [],                     # Загрузка: быстро по трубке, последние мм медленно до датчика
+    "unload_profile": []                    # Выгрузка: медленно из экструдера, дальше быстро
+}
+
+# Отличия от FILAMENT_DEFAULTS для отдельных типов
+FILAMENT_TYPE_DEFAULTS = {}
 
 FFS_STATUS_DELTA     = 11  # Дельта от первой катушки
 FFS_STATUS_OPROS     =  3  # Опрос катушек
@@ -37,6 +89,220 @@ RET_STALL    = 3         # по сработке движения прутка
 RET_TIMEOUT  = 4         # Таймаут получения нужного статуса
 RET_EXIT     = 5         # По завершению программы
 RET_RETRY    = 6         # Надо повторить запрос
+RET_SEGMENT  = 7         # Закончился отрезок профиля подачи, движение продолжается
+RET_ACCEPTED = 8         # Ответа нет, но по F13 команда выполняется (ответ потерян)
+
+PRIO_STOP    = 0         # Остановка/сброс - вне очереди
+PRIO_NORMAL  = 1         # Обычные команды
+PRIO_STATUS  = 2         # Явный запрос статуса F13
+
+STOP_COMMANDS = ('F112', 'F18', 'F15')
+
+F13_FIELD_RE = re.compile(r'(\w+):\s*(\d+)')   # Поля ответа F13 "имя: число"
+
+POLL_IDLE   = 'idle'         # IFS простаивает
+POLL_ACTIVE = 'active'       # Подача/выгрузка прутка или ожидание статуса
+POLL_ERROR  = 'error'        # Ошибка драйвера, идет восстановление
+
+# Статистика обмена: верхние границы корзин гистограммы времени ответа, с
+RTT_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+STATS_COUNTERS = ('timeouts', 'status_timeouts', 'retries', 'empty_responses',
+                  'bad_responses', 'drv_errors', 'reconnects', 'recoveries', 'accepted', 'aborts')
+
+# Трассировка обмена
+TRACE_SIZE = 2048           # Сколько последних событий хранить
+TRACE_FILE = 'ifs_trace.log'
+TRACE_TX    = 'TX'          # Отправлена команда
+TRACE_RX    = 'RX'          # Получен ответ (F13 - только если изменился)
+TRACE_STATE = 'STATE'       # Смена FFS_state
+TRACE_INFO  = 'INFO'        # Отладочные сообщения info()
+TRACE_ERROR = 'ERROR'       # Таймауты, обрывы связи, ошибки
+
+# Просмотр вперед печатаемого файла в поисках смен инструмента
+LOOKAHEAD_INTERVAL = 0.25       # Период чтения, пока окно не заполнено, с
+LOOKAHEAD_IDLE_TIME = 1.0       # Период проверки, когда окно заполнено или печати нет, с
+LOOKAHEAD_CHUNK = 16384         # Сколько байт читать за один раз
+LOOKAHEAD_WINDOW = 2097152      # На сколько байт вперед от позиции печати сканировать
+LOOKAHEAD_CHECKPOINT = 16384    # Шаг контрольных точек для пересчета расстояний
+LOOKAHEAD_MAX_CHANGES = 32      # Сколько смен инструмента держать в расписании
+
+PRESTAGE_CHECK_TIME = 1.0       # Как часто проверять, не пора ли подвести следующий пруток, с
+
+# Положение кончика прутка и длина пути от IFS до датчика экструдера по портам
+TIP_IFS = 'ifs'                 # Пруток в IFS (до выхода из порта)
+TIP_TUBE = 'tube'               # Пруток в трубке
+TIP_EXTRUDER = 'extruder'       # Пруток дошел до датчика экструдера
+TIP_UNKNOWN = 'unknown'
+PATH_LEARN_SAMPLES = 5          # Среднее по первым N замерам, дальше скользящее с весом 1/N
+PATH_LEARN_MIN_SAMPLES = 2      # С какого числа замеров использовать выученную длину
+PATH_LEARN_TOLERANCE = 0.3      # Замеры дальше 30% от filament_tube_length отбрасываются
+PATH_APPROACH_MARGIN = 50       # Запас к выученной длине при загрузке до датчика экструдера, мм
+PATH_APPROACH_SPEED = 600       # Подход к датчику последние 2 * PATH_APPROACH_MARGIN мм, мм/мин
+
+# Датчик прутка в экструдере на АЦП
+EXTRUDER_ADC = 'temperature_sensor filamentValue'
+EXTRUDER_ADC_LOW = 0.3          # До этого значения пруток есть
+EXTRUDER_ADC_HIGH = 0.72        # Выше EXTRUDER_ADC_LOW пруток есть только от этого значения
+EXTRUDER_HYSTERESIS = 0.02      # Насколько надо перейти порог, чтобы сменить состояние
+EXTRUDER_DEBOUNCE = 1           # Сколько отсчетов АЦП подряд нужно для смены состояния
+
+# Общая проверка датчиков zmod_ifs_switch_sensor (type: port) и zmod_ifs_motion_sensor
+SENSOR_IDLE_TIME = 0.5          # Период проверки датчиков портов, с
+SENSOR_MOTION_TIME = 0.25       # Период проверки датчиков движения во время печати, с
+
+# Смена инструмента (IFS_CHANGE_TOOL)
+TEMP_TOLERANCE = 2.             # Допуск при ожидании температуры сопла, °C
+HEAT_TIMEOUT = 600.             # Максимальное ожидание нагрева, с
+HEAT_CHECK_TIME = 0.25          # Период проверки температуры, с
+SENSOR_SETTLE_TIME = 2.         # Сколько ждать подтверждения датчика экструдера, с
+CHANGE_PHASES = ('cut', 'unload', 'load', 'feed', 'heat', 'verify')
+
+# Фоновые задания IFS_F10/IFS_F11 WAIT=0
+JOB_TIMEOUT = 120.              # Сколько следить за движением, с (как при WAIT=1)
+JOB_HISTORY = 16                # Сколько завершенных заданий помнить для IFS_WAIT и статуса
+JOB_RUNNING = 'running'         # Движение идет, условия проверяются
+JOB_DONE    = 'done'            # IFS готов или сработал датчик экструдера
+JOB_FAILED  = 'failed'          # Нет прутка, пруток остановился, таймаут, сбой драйвера
+JOB_STOPPED = 'stopped'         # Прервано другой командой движения или остановки
+RET_NAMES = {RET_OK: 'ok', RET_EXTRUDER: 'extruder', RET_SILK: 'silk', RET_STALL: 'stall',
+             RET_TIMEOUT: 'timeout', RET_EXIT: 'exit', RET_RETRY: 'drv_error', RET_SEGMENT: 'segment',
+             RET_ACCEPTED: 'accepted'}
+
+# Снимок get_status
+STATUS_DIAG_TIME = 1.0          # Как часто обновлять диагностику (статистика, кончики, задания), с
+
+# Восстановление после сбоев: шаги по нарастающей, у каждого свой короткий срок
+COMMAND_DEADLINE = 1.5          # Сколько ждать ответа на команду до начала восстановления, с
+REC_REPOLL  = 'repoll'          # Свежий снимок F13: команда могла дойти, ошибка могла пройти сама
+REC_RESEND  = 'resend'          # Повтор команды
+REC_RESET   = 'reset'           # Сброс драйвера F15 и ожидание READY
+REC_RELEASE = 'release'         # Остановить и отжать прутки юнита F112/F18
+REC_ABORT   = 'abort'           # Ошибка G-code
+RECOVERY_STEPS = (REC_REPOLL, REC_RESEND, REC_RESET, REC_RELEASE, REC_ABORT)
+RECOVERY_DEADLINES = {REC_REPOLL: 0.5, REC_RESEND: COMMAND_DEADLINE, REC_RESET: 3.0,
+                      REC_RELEASE: 2.0, REC_ABORT: 0.}
+
+# Команда в очереди на отправку в IFS
+class IfsCommand:
+    def __init__(self, command, command_id, priority, completion):
+        self.command = command          # Текст команды без ID
+        self.command_id = command_id    # Уникальный ID команды
+        self.priority = priority        # Приоритет в очереди
+        self.completion = completion    # Завершается в реакторе при получении ответа
+        self.response = None            # Ответ IFS
+        self.cancelled = False          # Команда больше не нужна
+
+    def __lt__(self, other):
+        return (self.priority, self.command_id) < (other.priority, other.command_id)
+
+# Условия ожидания статуса IFS: общие для wait_for_state и фоновых заданий
+class StateCheck:
+    def __init__(self, Port=0, FFS_state=None, silk=None, stall=None, extruder=None):
+        self.port = Port
+        self.check_state = None
+        if FFS_state is not None:
+            self.check_state = FFS_state + (Port - 1) * FFS_STATUS_DELTA if Port != 0 else FFS_state
+        self.silk = silk
+        self.stall = stall
+        self.extruder = extruder
+        self.silk_count = self.stall_count = 0
+
+    def feed(self, state, silk, stall):
+        """
+        Проверяет очередной снимок статуса.
+        :param state: FFS_state.
+        :param silk: Маска портов с прутком.
+        :param stall: Маска портов, где пруток движется.
+        :return: Код завершения ожидания или None, если ждем дальше.
+        """
+        if state == FFS_STATUS_READY:
+            return RET_OK
+        if state == FFS_STATUS_DRV_ERROR:
+            return RET_RETRY
+        if state != self.check_state or self.port == 0:
+            return None
+        if self.silk:                   # проверяем наличие прутка
+            if ((silk >> (self.port - 1)) & 1 == 1) == self.silk['status']:
+                self.silk_count += 1
+                if self.silk_count >= self.silk['count']:
+                    return RET_SILK
+            else:
+                self.silk_count = 0
+        if self.stall:                  # проверяем движение прутка
+            if ((stall >> (self.port - 1)) & 1 == 1) == self.stall['status']:
+                self.stall_count += 1
+                if self.stall_count >= self.stall['count']:
+                    return RET_STALL
+            else:
+                self.stall_count = 0
+        return None
+
+# Движение IFS_F10/IFS_F11 WAIT=0, за которым следят в фоне
+class IfsJob:
+    def __init__(self, job_id, command, prutok, length, speed, check, start_time, unit):
+        self.job_id = job_id
+        self.command = command          # F10 или F11
+        self.prutok = prutok            # Общий номер прутка
+        self.unit = unit                # IfsUnit, в котором движется пруток
+        self.length = length
+        self.speed = speed
+        self.check = check              # StateCheck
+        self.start_time = start_time
+        self.deadline = start_time + JOB_TIMEOUT
+        self.version = unit.ifs_data.get_version()  # Последний учтенный снимок статуса
+        self.status_time = start_time   # Когда пришел последний снимок
+        self.state = JOB_RUNNING
+        self.ret_code = None
+        self.end_time = None
+        self.values = None
+
+    def finish(self, state, ret_code, eventtime, values=None):
+        self.state = state
+        self.ret_code = ret_code
+        self.end_time = eventtime
+        if values is not None:
+            self.values = values
+
+    def get_status(self, eventtime):
+        end_time = self.end_time if self.end_time is not None else eventtime
+        return {
+            'job': self.job_id,
+            'command': self.command,
+            'prutok': self.prutok,
+            'length': self.length,
+            'speed': self.speed,
+            'state': self.state,
+            'result': RET_NAMES.get(self.ret_code),
+            'elapsed': round(end_time - self.start_time, 3),
+        }
+
+# Одно восстановление после сбоя: пройденные шаги и срок текущего шага,
+# итог и затраченное время - в статистику юнита
+class IfsRecovery:
+    def __init__(self, unit, reason):
+        self.unit = unit
+        self.reactor = unit.reactor
+        self.reason = reason            # Что восстанавливаем, для трассировки
+        self.start_time = self.reactor.monotonic()
+        self.steps = []
+
+    def step(self, name):
+        """
+        Переходит к следующему шагу.
+        :param name: Шаг из RECOVERY_STEPS.
+        :return: Время реактора, до которого шаг должен завершиться.
+        """
+        self.steps.append(name)
+        self.unit.trace.add(TRACE_INFO, 0, f"recovery {self.reason}: {name}")
+        return self.reactor.monotonic() + RECOVERY_DEADLINES[name]
+
+    # accepted - ответа так и не было, команда выполняется только по статусу F13
+    def finish(self, ok, accepted=False):
+        elapsed = self.reactor.monotonic() - self.start_time
+        self.unit.stats.add_recovery(self.steps, ok, elapsed, accepted)
+        result = 'accepted' if accepted else 'ok' if ok else 'failed'
+        self.unit.trace.add(TRACE_INFO if ok else TRACE_ERROR, 0,
+                            f"recovery {self.reason}: {result} in {elapsed:.3f} s")
 
 class zmod_ifs:
     def __init__(self, config):
@@ -46,6 +312,13 @@ class zmod_ifs:
         self.stall_count = config.getint('stall_count', 3, minval=1)    # с какой попытки засчитывать что пруток остановилося
         self.silk_count = config.getint('silk_count', 1, minval=1)      # c какой попытки зачитывать что пруток в IFS
         self.retry_count = config.getint('retry_count', 3, minval=1)    # сколько раз повторять команду при ошибке
+        self.lookahead_window = config.getint('lookahead_window', LOOKAHEAD_WINDOW, minval=0) # на сколько байт вперед искать смены инструмента, 0 - выключено
+        self.prestage_length = config.getint('prestage_length', 0, minval=0)           # на сколько мм заранее подвести следующий пруток к точке слияния, 0 - выключено
+        self.prestage_speed = config.getint('prestage_speed', 1200, minval=1)           # скорость подвода, мм/мин
+        self.prestage_time = config.getfloat('prestage_time', 120., minval=0.)          # за сколько секунд до смены подводить автоматически, 0 - только командой
+        self.state_file = config.get('state_file', STATE_FILE)                          # снимок состояния MMU, рядом пишется журнал .journal
+        self.extruder_debounce = config.getint('extruder_debounce', EXTRUDER_DEBOUNCE, minval=1)            # сколько отсчетов АЦП подряд для смены состояния датчика экструдера
+        self.extruder_hysteresis = config.getfloat('extruder_hysteresis', EXTRUDER_HYSTERESIS, minval=0.)   # гистерезис порогов датчика экструдера
 
         self.debug = config.getboolean('debug', False)
         self.reactor = self.printer.get_reactor()
@@ -74,24 +347,55 @@ class zmod_ifs:
                 pass
 
         self.temp_defaults = temp_defaults
+        self.config_cache = JsonFileCache()
+        self._config_flush_timer = self.reactor.register_timer(self._config_flush_event)
+        self.state = StateStore(self.state_file)
+        try:
+            self.state.load()
+        except OSError as e:
+            logging.warning("IFS: Error reading state %s: %s", self.state_file, e)
+        self._state_flush_timer = self.reactor.register_timer(self._state_flush_event)
+        self._state_flush_pending = False
+        self._state_writer = None       # Поток записи журнала состояния
+        self.gcode.register_command('IFS_SET_STATE', self.cmd_IFS_SET_STATE, desc=self.cmd_IFS_SET_STATE_help)
+        self.units = []                 # Юниты IFS, каждый на своем последовательном порту
         if not self.zmod_color or self.zmod_color.get_display():
             return
-        self.ifs_data = IfsData()
+        self._link_lock = threading.Lock()
+        self.units.append(IfsUnit(config, self, 0))
+        self.slot_count = IFS_PORTS     # Прутков во всех юнитах
+        self.cur_prutok = 0             # Текущий активный пруток
+        self.sensors = IfsSensorScheduler(self.printer, self)    # Один таймер на все датчики портов и движения
 
         self.zmod_color.valid_types = list(self.temp_defaults.keys()) + ['?']
 
-        # Синхронизация потоков
-        self._command_lock = threading.Lock()
-        self._command = "F13"
-        self._command_id = 0
-
-        self._ret_command_lock = threading.Lock()
-        self._ret_command_data = ""
-        self._ret_command_id = 0
-
-        self.stop_thread = False
-        self.sensor_thread = threading.Thread(target=self._sensor_reader)
-        self.sensor_thread.daemon = True
+        self.extruder_sensor = ExtruderSensor(self.reactor, self.extruder_debounce, self.extruder_hysteresis)
+        self.extruder_sensor.on_edge = self._extruder_edge
+        self._extruder_callbacks = []   # Подписчики на изменение датчика экструдера
+        self._edge_time = 0.            # Время фронта, который сейчас рассылается подписчикам
+        self._extruder_timer = None     # Опрос АЦП, если подписаться на отсчеты не удалось
+
+        self.lookahead = None
+        if self.lookahead_window:
+            self.lookahead = ToolChangeLookahead(self.printer, self.lookahead_window)
+        self._prestaged = [0] * IFS_PORTS   # На сколько мм подведен пруток в каждом порту
+        self.tips = TipTracker(IFS_PORTS)   # Где кончик прутка каждого порта, выученная длина пути
+        self._jobs = collections.deque(maxlen=JOB_HISTORY)  # Фоновые задания WAIT=0, последние в конце
+        self._job_id = 0
+        self._jobs_timer = None
+        self._job_waiters = []          # IFS_WAIT, ждущие завершения заданий
+        self._change_state = 'idle'     # Фаза текущей смены инструмента
+        self._last_change = None        # Итог последней смены: инструмент и время фаз
+        self._prestage_prutok = 0       # Какой пруток сейчас подводится (F24/F10/F39)
+        self._prestage_cancel = False   # Подвод остановлен сменой на другой пруток этого юнита
+        self._prestage_waiters = []     # Загрузки, ждущие окончания подвода
+        self._prestage_timer = None
+        self._jobs_version = 0          # Растет при запуске и завершении заданий
+        self._status = None             # Снимок get_status, после выдачи не меняется
+        self._status_core = None        # Состояние IFS и MMU из снимка
+        self._status_key = None         # Версии частей, из которых собран _status_core
+        self._status_version = 0        # Номер снимка, растет при каждой смене _status_key
+        self._status_time = 0.          # Когда обновлялась диагностика
 
         # Регистрация событий
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
@@ -107,6 +411,13 @@ class zmod_ifs:
         self.gcode.register_command('ANALOG_PRUTOK', self.cmd_ANALOG_PRUTOK)            # Загрузить аналогичный пруток
         self.gcode.register_command('IFS_MOTION', self.cmd_IFS_MOTION)                  # Проверить, остановился или кончился филамент
         self.gcode.register_command('IFS_GET_COMAND', self.cmd_IFS_GET_COMMAND)         # Сообщить текущую команду
+        self.gcode.register_command('IFS_STATS', self.cmd_IFS_STATS, desc=self.cmd_IFS_STATS_help)
+        self.gcode.register_command('IFS_TRACE_DUMP', self.cmd_IFS_TRACE_DUMP, desc=self.cmd_IFS_TRACE_DUMP_help)
+        self.gcode.register_command('IFS_LOOKAHEAD', self.cmd_IFS_LOOKAHEAD, desc=self.cmd_IFS_LOOKAHEAD_help)
+        self.gcode.register_command('IFS_PRESTAGE', self.cmd_IFS_PRESTAGE, desc=self.cmd_IFS_PRESTAGE_help)
+        self.gcode.register_command('IFS_CHANGE_TOOL', self.cmd_IFS_CHANGE_TOOL, desc=self.cmd_IFS_CHANGE_TOOL_help)
+        self.gcode.register_command('IFS_TIP', self.cmd_IFS_TIP, desc=self.cmd_IFS_TIP_help)
+        self.gcode.register_command('IFS_WAIT', self.cmd_IFS_WAIT, desc=self.cmd_IFS_WAIT_help)
 
         # Внутренние конманды начинаются с IFS
         self.gcode.register_command('IFS_PRINT_DEFAULTS', self.cmd_IFS_PRINT_DEFAULTS)
@@ -131,26 +442,176 @@ class zmod_ifs:
         self.filament_sensor = self.printer.lookup_object('temperature_sensor filamentValue')
 
         self.get_lang()
-        self.get_prutok_config(1)
-        self.sensor_thread.start()
+        self.normalize_prutok_config()
+        self.migrate_state()
+        if not self.extruder_sensor.attach(self.query_adc.adc.get(EXTRUDER_ADC)):
+            logging.info("IFS: ADC callback unavailable, polling extruder sensor")
+            self._extruder_timer = self.reactor.register_timer(self._extruder_event)
+        self._init_tips()
+        self._jobs_timer = self.reactor.register_timer(self._jobs_event)
+        if self.lookahead is not None:
+            self.lookahead.start()
+            if self.prestage_length and self.prestage_time:
+                self._prestage_timer = self.reactor.register_timer(self._prestage_event, self.reactor.NOW)
+        for unit in self.units:
+            unit.start()
+
+    def add_unit(self, config):
+        """
+        Добавляет юнит IFS из секции [zmod_ifs NAME]. Его порты продолжают
+        общую нумерацию прутков после уже добавленных юнитов.
+        :return: IfsUnit или None, если IFS не используется.
+        """
+        if not self.units:
+            return None
+        unit = IfsUnit(config, self, len(self.units), self.units[0])
+        self.units.append(unit)
+        self.slot_count += IFS_PORTS
+        self._prestaged.extend([0] * IFS_PORTS)
+        self.tips.add_ports(IFS_PORTS)
+        return unit
+
+    def get_unit(self, prutok, online=False):
+        """
+        Юнит и его порт по общему номеру прутка.
+        :param prutok: Номер прутка 1..4*N.
+        :param online: Для команд - ошибка G-code, если юнит прутка не на связи.
+        :return: (IfsUnit, порт 1-4); для 0 и чужих номеров - основной юнит и порт 0.
+        """
+        if not 1 <= prutok <= self.slot_count:
+            unit, port = self.units[0], 0
+        else:
+            unit = self.units[(prutok - 1) // IFS_PORTS]
+            port = prutok - unit.first_slot
+        if online and not unit.online:
+            raise self.gcode.error(f"{unit.label} не на связи, пруток {prutok} недоступен" if self.lang == 'ru'
+                                   else f"{unit.label} is offline, filament {prutok} is unavailable")
+        return unit, port
+
+    # Связь с юнитом появилась или пропала (из потока чтения). IFS считается
+    # доступным, пока на связи хотя бы один юнит: прутки отключившегося юнита
+    # отклоняет get_unit(online=True), остальные юниты работают дальше.
+    def set_unit_online(self, unit, online):
+        with self._link_lock:
+            unit.online = online
+            ifs = any(u.online for u in self.units)
+            if ifs == self.ifs:
+                return
+            self.ifs = ifs
+        script = "_IFS_ON" if ifs else "_IFS_OFF"
+        self.reactor.register_async_callback(
+            lambda eventtime: self._safe_run_script(script)
+        )
 
     def get_ifs_status(self):
         return self.ifs
 
-    def send_command_and_wait(self, command, timeout=5.0, result=None, extruder=None):
+    # Снимок для Moonraker/UI и макросов без очереди G-code. Состояние IFS и MMU
+    # собирается заново только при смене версии (новый разобранный ответ F13, связь,
+    # текущий пруток, задания, переменные состояния), диагностика - не чаще
+    # STATUS_DIAG_TIME. Между сменами отдается тот же объект, выданный снимок не меняется.
+    # Без юнитов (режим экрана) - только признак, что IFS нет, переменные состояния
+    # (IFS_SET_STATE есть и в этом режиме) и пустой prestaged: макросы читают
+    # printer.zmod_ifs.state и printer.zmod_ifs.prestaged[slot - 1].
+    def get_status(self, eventtime):
+        if not self.units:
+            return {'online': False, 'state': self.state.variables, 'prestaged': (0,) * IFS_PORTS}
+        key = self._get_status_key(eventtime)
+        if key != self._status_key:
+            self._status_key = key
+            self._status_version += 1
+            self._status_core = self._build_status_core(eventtime)
+        elif eventtime < self._status_time + STATUS_DIAG_TIME:
+            return self._status
+        self._status_time = eventtime
+        status = self._build_status_diag(eventtime)
+        status.update(self._status_core)
+        self._status = status
+        return status
+
+    def _get_status_key(self, eventtime):
+        # state.variables и _last_change заменяются целиком, сравнение по ссылке
+        return (tuple((unit.ifs_data.get_changes(), unit.online, unit._poll_mode) for unit in self.units),
+                self.ifs, self.cur_prutok, self.extruder_sensor.get_state(eventtime),
+                self.state.variables, tuple(self._prestaged), self._change_state,
+                self._last_change, self._jobs_version)
+
+    def _build_status_core(self, eventtime):
+        cur_unit = self.get_unit(self.cur_prutok)[0]
+        ffs_state = chan = insert = 0
+        silk = []
+        stall = []
+        for unit in self.units:
+            state, silk_mask, stall_mask = unit.ifs_data.get_masks()
+            silk.extend((silk_mask >> i) & 1 == 1 for i in range(IFS_PORTS))
+            stall.extend((stall_mask >> i) & 1 == 1 for i in range(IFS_PORTS))
+            if unit is cur_unit:
+                ffs_state = state
+                unit_chan = unit.ifs_data.get_chan()
+                if unit_chan:
+                    chan = unit.first_slot + unit_chan
+            unit_insert = unit.ifs_data.get_insert()
+            if unit_insert and not insert:
+                insert = unit.first_slot + unit_insert
+        running = self.get_running_jobs()
+        main = self.units[0]
+        return {
+            'version': self._status_version,
+            'online': self.ifs,
+            'ffs_state': ffs_state,
+            'silk': tuple(silk),
+            'stall': tuple(stall),
+            'chan': chan,
+            'insert': insert,
+            'current': self.cur_prutok,
+            'extruder': self.extruder_sensor.get_state(eventtime),
+            'busy': running[-1].job_id if running else 0,
+            'poll_mode': main._poll_mode,
+            'poll_interval': main.poll_intervals[main._poll_mode],
+            'state': self.state.variables,
+            'prestaged': tuple(self._prestaged),
+            'change_state': self._change_state,
+            'last_change': self._last_change,
+            'last_job': self._job_id,
+        }
+
+    def _build_status_diag(self, eventtime):
+        return {
+            'config_cache': self.config_cache.get_stats(),
+            'state_store': self.state.get_stats(),
+            'stats': merge_stats([unit.stats.get_stats() for unit in self.units]),
+            'units': tuple(unit.get_status(eventtime) for unit in self.units),
+            'lookahead': self.lookahead.get_status(eventtime) if self.lookahead else None,
+            'tips': tuple(self.get_tips_status(eventtime)),
+            'extruder_sensor': self.extruder_sensor.get_stats(),
+            'sensors': self.sensors.get_stats(),
+            'jobs': tuple(job.get_status(eventtime) for job in self._jobs),
+        }
+
+    def send_command_and_wait(self, command, timeout=COMMAND_DEADLINE, result=None, extruder=None, priority=None, unit=None):
         """
-        Отправляет команду и возвращает ответ.
+        Отправляет команду и возвращает ответ. Если ответа нет, команда
+        восстанавливается (_recover_command), при неудаче - ошибка G-code.
         :param command: Команда для отправки (например, "H1").
-        :param timeout: Таймаут ожидания ответа.
+        :param timeout: Сколько ждать ответа до восстановления (и при повторе).
         :param result: Ожидаемый ответ
         :param extruder: Контролировать состояние экструдера
-        :return: Ответ от датчика или None при таймауте.
+        :param priority: Приоритет команды в очереди
+        :param unit: Юнит IFS, по умолчанию основной
+        :return: Ответ от датчика, None по датчику экструдера или RET_ACCEPTED:
+                 ответ потерян, но F10/F11 по статусу F13 выполняется.
         """
-        with self._command_lock:
-            self._command_id += 1
-            command_id = self._command_id  # Уникальный ID команды
-            self._command = f"{command}#{command_id}"
-        start_time = eventtime = self.reactor.monotonic()
+        if extruder: # Если нужно контролировать экструдер
+            if self.get_extruder_sensor() == extruder['status']:
+                #self.info("Extruder trigger 1")
+                return None
+        if unit is None:
+            unit = self.units[0]
+        if unit.index:
+            command_name = f"{unit.label} {command}"
+        else:
+            command_name = command
+        start_time = self.reactor.monotonic()
 
         if result is not None:
             if isinstance(result, str):
@@ -160,42 +621,202 @@ class zmod_ifs:
         else:
             expected_results = None
 
-        while not self.stop_thread:
-            if extruder: # Если нужно контролировать экструдер
-                if self.get_extruder_sensor() == extruder['status']:
-                    #self.info("Extruder trigger 1")
-                    return None
-
-            eventtime = self.reactor.pause(eventtime + HOST_REPORT_TIME)
-            with self._ret_command_lock:
-                ret_command_data = self._ret_command_data
-                ret_command_id = self._ret_command_id
-                self._ret_command_id = 0
-
-            #if ret_command_id != 0:
-            #    self.info(f"WAIT: {command}#{command_id} RET: #{ret_command_id} {ret_command_data}")
-            if command_id == ret_command_id:
-                if expected_results is not None:
-                    if ret_command_data in expected_results:
-                        return ret_command_data
-                    else:
-                        self.gcode.run_script_from_command("_ENABLE_SENSOR")
-                        raise self.gcode.error(f"{command}#{command_id} ret {ret_command_data} != {expected_results}")
-                        return None
-                else:
-                    return self._ret_command_data
-            if eventtime - start_time > timeout:
-                self.gcode.run_script_from_command("_ENABLE_SENSOR")
-                if self.lang == 'ru':
-                    error_msg = f"Таймаут ожидания ответа от команды {command}#{command_id}"
-                else:
-                    error_msg = f"Timeout waiting for response from command {command}#{command_id}"
-                self.info(error_msg)
-                self.gcode.run_script_from_command("IFS_F112")
-                self.gcode.run_script_from_command("IFS_F18")
-                raise self.gcode.error(error_msg)
+        cmd = self._send(unit, command, start_time + timeout, extruder, priority)
+        if cmd == RET_TIMEOUT:
+            if unit.stop_thread:
                 return None
-        return None
+            unit.stats.count('timeouts')
+            ret_command_data = self._recover_command(unit, command, command_name, expected_results,
+                                                     timeout, extruder, priority)
+        elif cmd is None:
+            return None
+        else:
+            ret_command_data = cmd.response
+            command_name = f"{command_name}#{cmd.command_id}"
+
+        if ret_command_data is not None and ret_command_data != RET_ACCEPTED and expected_results is not None:
+            if ret_command_data not in expected_results:
+                unit.stats.count('bad_responses')
+                unit.trace.add(TRACE_ERROR, 0, f"unexpected response {ret_command_data}")
+                self.dump_trace(f"unexpected response {command_name}")
+                self.gcode.run_script_from_command("_ENABLE_SENSOR")
+                raise self.gcode.error(f"{command_name} ret {ret_command_data} != {expected_results}")
+        return ret_command_data
+
+    def _send(self, unit, command, deadline, extruder=None, priority=None):
+        """
+        Одна отправка команды, без восстановления.
+        :param deadline: Время реактора, до которого ждать ответ.
+        :return: IfsCommand с ответом, None по датчику экструдера или
+                 RET_TIMEOUT (ответа нет, команда снята с очереди).
+        """
+        cmd = unit.queue_command(command, priority)
+        # Сработка датчика экструдера завершает ожидание с None
+        watch = None
+        if extruder:
+            status = extruder['status']
+            def watch(state):
+                if state == status:
+                    self._complete(cmd.completion, None)
+            self.add_extruder_callback(watch)
+        try:
+            ret = cmd.completion.wait(deadline, RET_TIMEOUT)
+        finally:
+            if watch is not None:
+                self.remove_extruder_callback(watch)
+        if ret is cmd:
+            return cmd
+        if ret == RET_TIMEOUT:
+            unit.cancel_command(cmd)
+            unit.trace.add(TRACE_ERROR, cmd.command_id, "response timeout")
+        return ret
+
+    # ---- восстановление после сбоев ----
+    # Нет ответа на команду. Шаги: свежий снимок F13 (F10/F11 могла дойти, потерян
+    # только ответ), повтор, сброс драйвера и повтор, отжать прутки юнита, ошибка.
+    def _recover_command(self, unit, command, command_name, expected_results, timeout=COMMAND_DEADLINE,
+                         extruder=None, priority=None):
+        recovery = IfsRecovery(unit, command_name)
+        if self._repoll(unit, recovery.step(REC_REPOLL)) and self._command_accepted(unit, command):
+            recovery.finish(True, accepted=True)
+            return RET_ACCEPTED
+        # Нет свежего снимка - юнит мог переподключаться, повтор все равно пробуем
+        for step in (REC_RESEND, REC_RESET):
+            deadline = recovery.step(step)
+            if step == REC_RESET:
+                if not self._reset_driver(unit, deadline):
+                    break
+                deadline = self.reactor.monotonic() + COMMAND_DEADLINE
+            # Медленной команде (F18) - ее собственный срок
+            deadline = max(deadline, self.reactor.monotonic() + timeout)
+            cmd = self._send(unit, command, deadline, extruder, priority)
+            if cmd != RET_TIMEOUT:
+                recovery.finish(True)
+                return cmd.response if cmd is not None else None
+        if self.lang == 'ru':
+            error_msg = f"Таймаут ожидания ответа от команды {command_name}"
+        else:
+            error_msg = f"Timeout waiting for response from command {command_name}"
+        self._recovery_abort(recovery, error_msg)
+
+    # F10/F11 уже выполняется, хотя ответа не было: порт команды грузится/выгружается
+    def _command_accepted(self, unit, command):
+        name, _, args = command.partition(' ')
+        base = {'F10': FFS_STATUS_ZAGRUZKA, 'F11': FFS_STATUS_VIGRUZKA}.get(name)
+        port = re.search(r'\bC(\d+)', args)
+        if base is None or port is None:
+            return False
+        return unit.ifs_data.get_state() == base + (int(port.group(1)) - 1) * FFS_STATUS_DELTA
+
+    # Свежий снимок F13 до deadline - связь с юнитом есть
+    def _repoll(self, unit, deadline):
+        return unit.wait_status(unit.ifs_data.get_version(), deadline) is not None
+
+    # Сброс драйвера F15 и ожидание READY до deadline
+    def _reset_driver(self, unit, deadline):
+        self._stop_tips(unit)
+        self._stop_jobs(unit)
+        cmd = self._send(unit, "F15 C", deadline)
+        if cmd == RET_TIMEOUT or cmd is None:
+            return False
+        version = unit.ifs_data.get_version()
+        while True:
+            version = unit.wait_status(version, deadline)
+            if version is None:
+                return False
+            if unit.ifs_data.get_state() == FFS_STATUS_READY:
+                return True
+
+    # FFS_state 127 во время ожидания. Шаги: свежие снимки F13 (ошибка могла пройти
+    # сама, движение идет дальше), сброс драйвера до READY, иначе - отжать и ошибка.
+    # Возвращает True, если движение продолжается, False - драйвер сброшен и
+    # вызывающий повторяет команду (движение - только остаток пути).
+    def _recover_drv_error(self, unit, check):
+        # Пруток стоит не позже последнего снимка без ошибки: по моменту, когда ошибку
+        # заметили, пройденный путь завышен и остаток недоподается
+        error_time = unit.ok_status_time
+        recovery = IfsRecovery(unit, "drv_error")
+        deadline = recovery.step(REC_REPOLL)
+        version = unit.ifs_data.get_version()
+        state = FFS_STATUS_DRV_ERROR
+        while state == FFS_STATUS_DRV_ERROR:
+            version = unit.wait_status(version, deadline)
+            if version is None:
+                break
+            state = unit.ifs_data.get_state()
+        if state == check.check_state or (check.check_state is None and is_moving_state(state)):
+            recovery.finish(True)
+            return True
+        self._stop_tips(unit, error_time)
+        if self._reset_driver(unit, recovery.step(REC_RESET)):
+            recovery.finish(True)
+            return False
+        self._recovery_abort(recovery, f"{unit.label}: сбой драйвера, сброс не помог" if self.lang == 'ru'
+                             else f"{unit.label}: driver failure, reset did not help")
+
+    # Последние шаги: остановить и отжать прутки юнита, ошибка G-code
+    def _recovery_abort(self, recovery, error_msg):
+        unit = recovery.unit
+        deadline = recovery.step(REC_RELEASE)
+        self._stop_tips(unit)
+        self._stop_jobs(unit)
+        for command in ("F112", "F18"):
+            if self._send(unit, command, deadline) == RET_TIMEOUT:
+                break
+        recovery.step(REC_ABORT)
+        recovery.finish(False)
+        self.info(error_msg)
+        self.dump_trace(f"{recovery.reason}: {error_msg}")
+        self.gcode.run_script_from_command("_ENABLE_SENSOR")
+        raise self.gcode.error(error_msg)
+
+    # Попытки выполнения команды, повторы учитываются в статистике. Цикл вызывающего
+    # прерывается break при любом исходе, кроме RET_RETRY; если он дошел до конца,
+    # все попытки со сбросом драйвера не помогли - отжать прутки юнита и ошибка.
+    def _attempts(self, unit=None):
+        unit = unit or self.units[0]
+        for attempt in range(self.retry_count):
+            if attempt:
+                unit.stats.count('retries')
+            yield attempt
+        self._recovery_abort(IfsRecovery(unit, "attempts"),
+                             f"{unit.label}: сбой драйвера после {self.retry_count} попыток" if self.lang == 'ru'
+                             else f"{unit.label}: driver failure after {self.retry_count} attempts")
+
+    def _complete(self, completion, result):
+        if not completion.test():
+            completion.complete(result)
+
+    def add_extruder_callback(self, callback):
+        """
+        Подписка на смену состояния датчика экструдера.
+        :param callback: Вызывается в реакторе с новым состоянием сразу после фронта.
+        """
+        self._extruder_callbacks.append(callback)
+        if self._extruder_timer is not None:
+            self.reactor.update_timer(self._extruder_timer, self.reactor.NOW)
+
+    def remove_extruder_callback(self, callback):
+        if callback in self._extruder_callbacks:
+            self._extruder_callbacks.remove(callback)
+
+    # Фронт датчика экструдера. Отсчеты АЦП приходят из фонового потока mcu,
+    # подписчики вызываются в реакторе. Время фронта передается с ним: к вызову
+    # extruder_sensor.edge_time мог уже перезаписать следующий фронт.
+    def _extruder_edge(self, state, edge_time):
+        self.reactor.register_async_callback(lambda e: self._extruder_dispatch(state, edge_time))
+
+    def _extruder_dispatch(self, state, edge_time):
+        self._edge_time = edge_time
+        for callback in list(self._extruder_callbacks):
+            callback(state)
+
+    # Опрос АЦП, пока есть подписчики (если не удалось подписаться на отсчеты)
+    def _extruder_event(self, eventtime):
+        if not self._extruder_callbacks:
+            return self.reactor.NEVER
+        self.extruder_sensor.update(eventtime)
+        return eventtime + OPROS_EXTRUDER
 
     # self.wait_for_state(
     #     Port=2,
@@ -205,69 +826,210 @@ class zmod_ifs:
     #     extruder={'status': True},
     #     timeout=15
     #     )
-    def wait_for_state(self, Port=0, FFS_state=None, silk=None, stall=None, extruder=None, timeout=10):
+    # Port - общий номер прутка, статус берется из его юнита. Без Port
+    # ждем готовности юнита unit (по умолчанию основного).
+    def wait_for_state(self, Port=0, FFS_state=None, silk=None, stall=None, extruder=None, timeout=10, until=None, unit=None):
         start_time = self.reactor.monotonic()
-        check_state = None
-        if FFS_state is not None:
-            if Port != 0:
-                check_state = (FFS_state + (Port-1)*FFS_STATUS_DELTA)
-            else:
-                check_state = FFS_state
-        silk_count = stall_count = 0
-
-        while not self.stop_thread:
-            # Запрос статуса
-            response = self.send_command_and_wait("F13", extruder=extruder)
-            self.ifs_data.update_from_string(response)
-            current_values = self.ifs_data.get_values()
-            if extruder:
-                if self.get_extruder_sensor() == extruder['status']: # Проверяем сработку датчика в экструдере
-                    self.info("Extruder trigger 2")
-                    return False, RET_EXTRUDER, current_values
-
-            state = current_values['State']
-            self.info(f"F13 need:{check_state}|{FFS_STATUS_READY} cur:{state} > {response}")
-
-            # Проверка что статус готов
-            if state == FFS_STATUS_READY:
-                return True, RET_OK, current_values
-
-            if state == FFS_STATUS_DRV_ERROR:
-                gcmd_tmp = self.gcode.create_gcode_command("IFS_F15", "IFS_F15", {})
-                self.cmd_IFS_F15(gcmd_tmp)
-                return False, RET_RETRY, current_values
-
-            if state == check_state:          # ждем сработки нужного статуса
-                if silk and Port != 0:        # проверяем наличие прутка
-                    current_silk = current_values['Silk']
-                    if ((current_silk >> (Port - 1)) & 1 == 1) == silk['status']:
-                        silk_count += 1
-                        if silk_count >= silk['count']:
-                            return False, RET_SILK, current_values
-                    else:
-                        silk_count = 0
-                if stall and Port != 0:        # проверяем движение прутка
-                    current_stall = current_values['stall_state']
-                    if ((current_stall >> (Port - 1)) & 1 == 1) == stall['status']:
-                        stall_count += 1
-                        if stall_count >= stall['count']:
-                            return False, RET_STALL, current_values
+        if until is None:
+            until = self.reactor.NEVER
+        if Port or unit is None:
+            unit, Port = self.get_unit(Port)
+        check = StateCheck(Port, FFS_state, silk, stall, extruder)
+        check_state = check.check_state
+        state = None
+        current_values = None
+
+        # Сработка датчика экструдера будит ожидание статуса
+        watch = None
+        if extruder:
+            status = extruder['status']
+            def watch(sensor_state):
+                if sensor_state == status:
+                    unit.notify_status()
+            self.add_extruder_callback(watch)
+        try:
+            # Снимки статуса берутся из фонового опроса F13
+            version = unit.ifs_data.get_version()
+            while not unit.stop_thread:
+                if extruder:
+                    if self.get_extruder_sensor() == extruder['status']: # Проверяем сработку датчика в экструдере
+                        self.info("Extruder trigger 2")
+                        return False, RET_EXTRUDER, unit.ifs_data.get_values()
+
+                eventtime = self.reactor.monotonic()
+                if eventtime >= until:
+                    return False, RET_SEGMENT, current_values
+                if eventtime - start_time > timeout:
+                    if self.lang == 'ru':
+                        error_msg = f"{unit.label}: Вышло время для получения статуса {check_state}|{FFS_STATUS_READY} получен {state}"
                     else:
-                        stall_count = 0
-            if self.reactor.monotonic() - start_time > timeout:
-                if self.lang == 'ru':
-                    error_msg = f"IFS: Вышло время для получения статуса {check_state}|{FFS_STATUS_READY} получен {state}"
-                else:
-                    error_msg = f"IFS: Timeout waiting for status {check_state}|{FFS_STATUS_READY}, received {state}"
-                self.info(error_msg)
-                self.gcode.run_script_from_command("IFS_F112")
-                self.gcode.run_script_from_command("IFS_F18")
-                raise self.gcode.error(error_msg)
-                return False, RET_TIMEOUT, current_values
-
-            self.reactor.pause(self.reactor.monotonic() + HOST_REPORT_TIME)
+                        error_msg = f"{unit.label}: Timeout waiting for status {check_state}|{FFS_STATUS_READY}, received {state}"
+                    unit.stats.count('timeouts')
+                    self._recovery_abort(IfsRecovery(unit, f"wait {check_state}"), error_msg)
+
+                new_version = unit.wait_status(version, min(start_time + timeout, eventtime + STATUS_TIMEOUT, until))
+                if new_version is None:
+                    if unit.ifs_data.get_version() == version and self.reactor.monotonic() - eventtime >= STATUS_TIMEOUT:
+                        unit.stats.count('status_timeouts')
+                        self.dump_trace("status timeout")
+                        self.gcode.run_script_from_command("_ENABLE_SENSOR")
+                        if self.lang == 'ru':
+                            error_msg = f"{unit.label}: Нет ответа на опрос состояния"
+                        else:
+                            error_msg = f"{unit.label}: No response to status polling"
+                        self.info(error_msg)
+                        raise self.gcode.error(error_msg)
+                    continue
+                version = new_version
+
+                state, silk, stall = unit.ifs_data.get_masks()
+                unit.trace.add(TRACE_STATE, version, f"need:{check_state}|{FFS_STATUS_READY} cur:{state}")
+
+                ret_code = check.feed(state, silk, stall)
+                if ret_code is None:
+                    continue
+                current_values = unit.ifs_data.get_values()
+                if ret_code == RET_OK:
+                    return True, RET_OK, current_values
+                if ret_code == RET_RETRY:
+                    unit.stats.count('drv_errors')
+                    if self._recover_drv_error(unit, check):
+                        version = unit.ifs_data.get_version()
+                        continue
+                    return False, RET_RETRY, unit.ifs_data.get_values()
+                return False, ret_code, current_values
+        finally:
+            if watch is not None:
+                self.remove_extruder_callback(watch)
         return False, RET_EXIT, None
 
+    # ---- фоновые задания WAIT=0 ----
+    def start_job(self, command, prutok, length, speed, checks):
+        """
+        Ставит отправленное движение под фоновый контроль.
+        :param command: F10 или F11.
+        :param checks: Условия как у wait_for_state (_feed_checks) или пустой словарь.
+        :return: IfsJob.
+        """
+        eventtime = self.reactor.monotonic()
+        unit, port = self.get_unit(prutok)
+        checks = dict(checks)
+        if checks.get('Port'):
+            checks['Port'] = port
+        self._job_id += 1
+        job = IfsJob(self._job_id, command, prutok, length, speed, StateCheck(**checks),
+                     eventtime, unit)
+        self._jobs.append(job)
+        self._jobs_version += 1
+        if job.check.extruder and self._job_extruder_event not in self._extruder_callbacks:
+            self.add_extruder_callback(self._job_extruder_event)
+        unit.trace.add(TRACE_INFO, job.job_id, f"job {command} C{port} L{length} S{speed}")
+        self._wake_jobs()
+        return job
+
+    def _respond_job(self, gcmd, job):
+        gcmd.respond_info(f"Задание IFS {job.job_id}, дождаться: IFS_WAIT JOB={job.job_id}" if self.lang == 'ru'
+                          else f"IFS job {job.job_id}, join with IFS_WAIT JOB={job.job_id}")
+
+    def get_running_jobs(self, prutok=0):
+        return [job for job in self._jobs
+                if job.state == JOB_RUNNING and (not prutok or job.prutok == prutok)]
+
+    def _wake_jobs(self):
+        if self._jobs_timer is not None and self.get_running_jobs():
+            self.reactor.update_timer(self._jobs_timer, self.reactor.NOW)
+
+    def _job_extruder_event(self, state):
+        self._wake_jobs()
+
+    def _jobs_event(self, eventtime):
+        waketime = self.reactor.NEVER
+        for job in self.get_running_jobs():
+            ret_code = values = None
+            version = job.unit.ifs_data.get_version()
+            if job.check.extruder and self.get_extruder_sensor() == job.check.extruder['status']:
+                ret_code = RET_EXTRUDER
+            elif version > job.version:
+                job.version = version
+                job.status_time = eventtime
+                ret_code = job.check.feed(*job.unit.ifs_data.get_masks())
+                if ret_code is not None:
+                    values = job.unit.ifs_data.get_values()
+            if ret_code is None and (eventtime >= job.deadline or eventtime - job.status_time >= STATUS_TIMEOUT):
+                ret_code = RET_TIMEOUT
+            if ret_code is None:
+                waketime = min(waketime, job.deadline, job.status_time + STATUS_TIMEOUT)
+                continue
+            self._finish_job(job, ret_code, eventtime, values)
+        return waketime
+
+    def _finish_job(self, job, ret_code, eventtime, values=None):
+        if ret_code in (RET_OK, RET_EXTRUDER):
+            job.finish(JOB_DONE, ret_code, eventtime, values)
+        else:
+            job.finish(JOB_FAILED, ret_code, eventtime, values)
+        unit = job.unit
+        if ret_code == RET_RETRY:
+            unit.stats.count('drv_errors')
+            unit.queue_command("F15 C")
+        elif ret_code == RET_TIMEOUT:
+            unit.stats.count('timeouts')
+        if ret_code != RET_OK:
+            # Как при WAIT=1 CHECK=1: движение останавливается, другие юниты не трогаем
+            self._stop_tips(unit)
+            if ret_code != RET_RETRY:
+                unit.queue_command("F112")
+        unit.trace.add(TRACE_INFO if job.state == JOB_DONE else TRACE_ERROR, job.job_id,
+                       f"job {job.command} C{job.prutok} {job.state} {RET_NAMES.get(ret_code)}")
+        self._job_finished()
+
+    def _job_finished(self):
+        self._jobs_version += 1
+        if not any(job.check.extruder for job in self.get_running_jobs()):
+            self.remove_extruder_callback(self._job_extruder_event)
+        waiters = self._job_waiters
+        self._job_waiters = []
+        for completion in waiters:
+            self._complete(completion, None)
+
+    # Новая команда движения или остановки прерывает фоновые задания своего юнита
+    def _stop_jobs(self, unit=None):
+        running = [job for job in self.get_running_jobs() if unit is None or job.unit is unit]
+        if not running:
+            return
+        eventtime = self.reactor.monotonic()
+        for job in running:
+            job.finish(JOB_STOPPED, None, eventtime)
+            job.unit.trace.add(TRACE_INFO, job.job_id, f"job {job.command} C{job.prutok} stopped")
+        self._job_finished()
+
+    cmd_IFS_WAIT_help = "Wait for background IFS_F10/IFS_F11 WAIT=0 jobs"
+    def cmd_IFS_WAIT(self, gcmd):
+        job_id = gcmd.get_int('JOB', 0, minval=0)
+        prutok = gcmd.get_int('PRUTOK', 0, minval=0, maxval=self.slot_count)
+        timeout = gcmd.get_float('TIMEOUT', JOB_TIMEOUT, minval=0.)
+        if job_id:
+            jobs = [job for job in self._jobs if job.job_id == job_id]
+            if not jobs:
+                raise gcmd.error(f"Задание IFS {job_id} не найдено" if self.lang == 'ru' else f"IFS job {job_id} not found")
+        else:
+            jobs = self.get_running_jobs(prutok)
+        end_time = self.reactor.monotonic() + timeout
+        while any(job.state == JOB_RUNNING for job in jobs):
+            if self.reactor.monotonic() >= end_time:
+                running = ", ".join(str(job.job_id) for job in jobs if job.state == JOB_RUNNING)
+                raise gcmd.error(f"Задание IFS {running} не завершилось за {timeout:g} с" if self.lang == 'ru'
+                                 else f"IFS job {running} not finished in {timeout:g} s")
+            completion = self.reactor.completion()
+            self._job_waiters.append(completion)
+            completion.wait(end_time)
+        for job in jobs:
+            if job.state == JOB_STOPPED:
+                gcmd.respond_info(f"Задание IFS {job.job_id} прервано" if self.lang == 'ru' else f"IFS job {job.job_id} stopped")
+                continue
+            gcmd.respond_info(f"Задание IFS {job.job_id}: {job.command} пруток {job.prutok} {job.state}" if self.lang == 'ru'
+                              else f"IFS job {job.job_id}: {job.command} filament {job.prutok} {job.state}")
+            self.print_result(job.ret_code, job.values, job.prutok, info=job.state == JOB_DONE)
 
     def _handle_disconnect(self):
         logging.info("IFS: Printer disconnected. Stopping IFS thread.")
@@ -278,9 +1040,16 @@ class zmod_ifs:
         self._close()
 
     def _close(self):
-        self.stop_thread = True
-        if self.sensor_thread.is_alive():
-            self.sensor_thread.join(timeout=2.0)
+        try:
+            self.config_cache.flush()
+        except OSError as e:
+            logging.warning("IFS: Error writing config: %s", e)
+        try:
+            self.state.flush()
+        except OSError as e:
+            logging.warning("IFS: Error writing state: %s", e)
+        for unit in self.units:
+            unit.close()
 
     def _respond_info(self, msg):
         self.reactor.register_async_callback(
@@ -291,9 +1060,35 @@ class zmod_ifs:
             lambda e: self.gcode.respond_raw(msg))
 
     def info(self, msg):
+        self.units[0].trace.add(TRACE_INFO, 0, msg)
         if self.debug:
             self.gcode.respond_info(msg)
 
+    def get_trace_path(self, unit=None):
+        log_file = self.printer.get_start_args().get('log_file')
+        log_dir = os.path.dirname(log_file) if log_file else '/tmp'
+        if unit is None or not unit.index:
+            return os.path.join(log_dir, TRACE_FILE)
+        name, ext = os.path.splitext(TRACE_FILE)
+        return os.path.join(log_dir, f"{name}_{unit.name}{ext}")
+
+    def dump_trace(self, reason):
+        """
+        Записывает трассировку обмена каждого юнита в файл рядом с klippy.log.
+        :param reason: Причина, пишется в заголовок.
+        :return: Список записанных файлов, пустой при ошибке записи.
+        """
+        paths = []
+        for unit in self.units:
+            path = self.get_trace_path(unit)
+            try:
+                unit.trace.dump(path, reason)
+            except OSError as e:
+                logging.warning("IFS: Error writing trace %s: %s", path, e)
+                continue
+            paths.append(path)
+        return paths
+
     def get_lang(self):
         if self.zmod is None:
             self.lang = 'en'
@@ -302,116 +1097,266 @@ class zmod_ifs:
             self.lang = self.zmod.get_lang()
 
     def get_extruder_sensor(self):
-        value, timestamp = self.query_adc.adc["temperature_sensor filamentValue"].get_last_value()
-        result = True
-        if value > 0.3:
-            result = (value >= 0.72)
-        return result
+        return self.extruder_sensor.get_state(self.reactor.monotonic())
 
+    # Движение прутка port, для 0 - текущего прутка
     def get_ifs_sensor(self, port):
-        return self.ifs_data.get_stall(port)
+        unit, port = self.get_unit(port or self.cur_prutok)
+        return unit.ifs_data.get_stall(port)
 
     def set_cur_port(self, port):
-        return self.ifs_data.set_cur_port(port)
+        self.cur_prutok = port
+        cur_unit, cur_port = self.get_unit(port)
+        for unit in self.units:
+            unit.ifs_data.set_cur_port(cur_port if unit is cur_unit else 0)
 
     def get_port(self, port=0):
-        if not self.ifs:
+        unit, port = self.get_unit(port)
+        if not unit.online:
             return False
-        return self.ifs_data.get_port(port)
+        return unit.ifs_data.get_port(port)
 
     def print_str(self, string, info=True):
         if info:
             self.gcode.respond_info(string)
         else:
             self.info(string)
+            self.dump_trace(string)
             self.gcode.run_script_from_command("IFS_F112")
             self.gcode.run_script_from_command("IFS_F18")
             raise self.gcode.error(string)
 
     # Получить текущий активный пруток из конфига
     def get_current_channel_from_config(self):
-        with open(FFCONFIG, 'r') as file:
-            config = json.load(file)
-            prutok = int(config["FFMInfo"].get("channel", 0))
-            self.set_cur_port(prutok)
-            return prutok
-        return 0
+        config = self.config_cache.load(FFCONFIG)
+        prutok = int(config["FFMInfo"].get("channel", 0))
+        self.set_cur_port(prutok)
+        return prutok
 
-    # Получить тип прутка из конфига
+    # Получить тип прутка из конфига. Прошивка знает только порты 1-4,
+    # тип прутков дополнительных юнитов хранится в состоянии MMU (slot_types)
     def get_prutok_type_from_config(self, prutok):
         ret="PLA"
 
-        with open(FFCONFIG, 'r') as file:
-            config = json.load(file)
-            ret=config["FFMInfo"].get(f"ffmType{prutok}", "PLA")
+        config = self.config_cache.load(FFCONFIG)
+        ret=config["FFMInfo"].get(f"ffmType{prutok}")
+        if ret is None:
+            ret = self.state.variables.get('slot_types', {}).get(str(prutok), "PLA")
         if ret not in self.temp_defaults:
             ret="PLA"
         return ret
 
     # Получить конфиг прутка по номеру прутка
     def get_prutok_config(self, prutok):
-        if prutok < 0 or prutok > 4:
+        if prutok < 0 or prutok > self.slot_count:
             self.print_str(f"Некорректный номер прутка {prutok}" if self.lang == 'ru' else f"Incorrect filament number {prutok}", False)
         filament=self.get_prutok_type_from_config(prutok)
 
-        base_default = {
-            "filament_unload_before_cutting": 0,    # На сколько поднимать филамент ПЕРЕД тем  как отрезать (по умолчанию 0)
-            "filament_unload_after_cutting": 5,     # На сколько поднимать филамент ПОСЛЕ того как отрезали (по умолчанию 5)
-            "filament_unload_after_drop": 3,        # Ретракт после сброса филамента (немного вытащить пруток из сопла, для предотвращения протечки,
-                                                    #   когда смена прутка уже прошла и сопло едет дальше печатать)
-            "filament_load_speed": 300,             # Скорость загрузки филамента (скорость вращения экструдера, 300 мм/м = 5 мм/c)
-            "filament_unload_speed": 600,           # Скорость подъема  филамента (скорость вращения экструдера, 600 мм/м = 10 мм/c)
-                                                    #   IFS работает на скорости 2*filament_unload_speed
-            "filament_tube_length": 1000,           # Длина полной загрузки/выгрузки филамента (длинна тефлоновой трубки от IFS до головы, полезно дял тех у кого не стоковые трубки)
-            "filament_drop_length": 90,             # Длина сброса в какашник (дистанция прутка который будет выдавлен в какашник, то есть дистанция прочистки сопла
-                                                    #   от преведущего филамената и смешения цветов, полезно когда не используется башня для сброса смешанных цветов)
-            "filament_drop_length_add": 90,         # Дополнительная длина сброса в какашник при смене типа филамента (смена разных материаалов, к примеру PETG на композитный PETG)
-            "nozzle_cleaning_length": 60,           # Длина прочистки сопла (дистанция на сколько вытаскивать пруток из экструдера
-                                                    #   (то есть на сколько милиметров доставать пруток из фидера, когда текущая катушка больше не используется)
-            "filament_fan_speed": 102,              # Скорость работы вентилятора при сбросе через какашник (то есть сдувает подтеки из сопла, когда происходит очистка)
-            #"temp": 230,                           # Температура до которой необхоидмо разогреть сопло для смены филамента
-
-            "filament_autoinsert_empty_length": 600,# Сколько мм затягивать при автоматической вставке прутка, если экструдер пустой
-            "filament_autoinsert_full_length": 550, # Сколько мм затягивать при автоматической вставке прутка, если экструдер был занят
-            "filament_autoinsert_ret_length": 90,   # Сколько мм втягивать обратно, если сработал эдатчик экструдера (срабатывает только на пустом экструдере)
-            "filament_autoinsert_speed": 1200       # Скорость вставки прутка
-        }
-
-
-        required_fields = ['temp'] + list(base_default.keys())
-
         try:
-            with open(TYPECONFIG, 'r') as f:
-                data = json.load(f)
+            data = self.config_cache.load(TYPECONFIG)
         except (FileNotFoundError, json.JSONDecodeError):
             data = {}
 
-        changed = False
+        # Только чтение: недостающие поля берутся из значений по умолчанию,
+        # файл дополняется один раз в normalize_prutok_config
+        config = {'temp': self.temp_defaults.get(filament, self.temp_defaults['PLA'])}
+        config.update(FILAMENT_DEFAULTS)
+        config.update(FILAMENT_TYPE_DEFAULTS.get(filament, {}))
+        config.update(data.get(filament, {}))
+        config['filament_type'] = filament
+        return config
 
+    # Дополнить filament.json недостающими типами и полями. Вызывается на klippy:ready,
+    # запись только если что-то действительно добавлено.
+    def normalize_prutok_config(self):
+        try:
+            data = self.config_cache.load(TYPECONFIG)
+        except FileNotFoundError:
+            data = {}
+        except json.JSONDecodeError:
+            logging.warning(f"IFS: {TYPECONFIG} is not valid JSON, not touching it")
+            return
+
+        new_data = dict(data)
         for filament_name, temp_default in self.temp_defaults.items():
-            if filament_name in data:
-                existing = data[filament_name]
-                normalized = {}
-                normalized['temp'] = existing.get('temp', temp_default)
-                for key, default_val in base_default.items():
-                    normalized[key] = existing.get(key, default_val)
-
-                if existing != normalized:
-                    data[filament_name] = normalized
-                    changed = True
+            existing = data.get(filament_name, {})
+            normalized = dict(existing)
+            normalized.setdefault('temp', temp_default)
+            for key, default_val in FILAMENT_TYPE_DEFAULTS.get(filament_name, {}).items():
+                normalized.setdefault(key, default_val)
+            for key, default_val in FILAMENT_DEFAULTS.items():
+                normalized.setdefault(key, default_val)
+            new_data[filament_name] = normalized
+
+        self.config_cache.update(TYPECONFIG, new_data, indent=4)
+        self._schedule_config_flush()
+
+    def _schedule_config_flush(self):
+        if self.config_cache.is_dirty():
+            self.reactor.update_timer(self._config_flush_timer,
+                                      self.reactor.monotonic() + CONFIG_FLUSH_DELAY)
+
+    def _config_flush_event(self, eventtime):
+        try:
+            self.config_cache.flush()
+        except OSError as e:
+            logging.warning("IFS: Error writing config: %s", e)
+        return self.reactor.NEVER
+
+    # Состояние MMU. Запись только в память, на диск - журналом из таймера,
+    # несколько изменений за STATE_FLUSH_DELAY уходят одной записью. Запись и
+    # сжатие журнала с fsync идут в отдельном потоке, реактор не ждет диск.
+    def set_state(self, variable, value):
+        if not self.state.set(variable, value):
+            return
+        if not self._state_flush_pending:
+            self._state_flush_pending = True
+            self.reactor.update_timer(self._state_flush_timer,
+                                      self.reactor.monotonic() + STATE_FLUSH_DELAY)
+
+    def _state_flush_event(self, eventtime):
+        self._state_flush_pending = False
+        if self._state_writer is not None and self._state_writer.is_alive():
+            # Предыдущая запись еще идет
+            self._state_flush_pending = True
+            return eventtime + STATE_FLUSH_DELAY
+        self._state_writer = threading.Thread(target=self._write_state, daemon=True)
+        self._state_writer.start()
+        return self.reactor.NEVER
+
+    def _write_state(self):
+        try:
+            self.state.flush()
+        except OSError as e:
+            logging.warning("IFS: Error writing state: %s", e)
+
+    # Однократный перенос состояния из [save_variables], если своего еще нет
+    def migrate_state(self):
+        save_variables = self.printer.lookup_object('save_variables', None)
+        if save_variables is None:
+            return
+        variables = getattr(save_variables, 'allVariables', {})
+        for name in STATE_VARIABLES:
+            if name in variables and name not in self.state.variables:
+                self.set_state(name, variables[name])
+
+    cmd_IFS_SET_STATE_help = "Set an MMU state variable (journaled, like SAVE_VARIABLE)"
+    def cmd_IFS_SET_STATE(self, gcmd):
+        variable = gcmd.get('VARIABLE')
+        value = gcmd.get('VALUE')
+        try:
+            value = ast.literal_eval(value)
+            json.dumps(value)
+        except (ValueError, SyntaxError, TypeError):
+            raise gcmd.error(f"Не удалось разобрать '{value}'" if self.lang == 'ru' else f"Unable to parse '{value}' as a literal")
+        self.set_state(variable, value)
+
+    # Положение кончика прутка. Двигается по F10/F11, уточняется по датчику экструдера:
+    # на подаче момент срабатывания дает замер длины пути, он запоминается в состоянии.
+    def _init_tips(self):
+        eventtime = self.reactor.monotonic()
+        current = 0
+        if self.get_extruder_sensor():
+            try:
+                current = self.get_current_channel_from_config()
+            except (OSError, ValueError, KeyError, json.JSONDecodeError):
+                current = 0
+        # После старта считаем, что прутки отведены в IFS, а текущий стоит в экструдере
+        self.tips.load(self.state.variables.get('tip_path_lengths'))
+        for prutok in range(1, self.slot_count + 1):
+            if prutok == current:
+                self.tips.set_position(prutok, self.get_path_length(prutok), eventtime, at_sensor=True)
             else:
-                new_config = base_default.copy()
-                new_config['temp'] = temp_default
-                data[filament_name] = new_config
-                changed = True
+                self.tips.set_position(prutok, 0., eventtime)
+        self.add_extruder_callback(self._tip_sensor_event)
+
+    def get_path_length(self, prutok, config=None):
+        """
+        Длина пути от IFS до датчика экструдера: выученная или filament_tube_length.
+        :param prutok: Номер прутка 1-4.
+        :param config: Конфиг прутка, если уже загружен.
+        :return: Длина, мм.
+        """
+        if config is None:
+            config = self.get_prutok_config(prutok)
+        return int(round(self.tips.get_length(prutok, config['filament_tube_length'])))
 
-        if changed:
-            with open(TYPECONFIG, 'w') as f:
-                json.dump(data, f, indent=4)
+    def get_load_length(self, prutok, config=None):
+        """
+        Длина подачи до датчика экструдера. Подача останавливается по датчику, длина -
+        верхняя граница: выученная длина с запасом PATH_APPROACH_MARGIN, пока ее нет -
+        filament_tube_length.
+        :param prutok: Номер прутка 1-4.
+        :param config: Конфиг прутка, если уже загружен.
+        :return: Длина, мм.
+        """
+        if config is None:
+            config = self.get_prutok_config(prutok)
+        if not self.tips.is_learned(prutok):
+            return int(config['filament_tube_length'])
+        return self.get_path_length(prutok, config) + PATH_APPROACH_MARGIN
 
-        config = data.get(filament, {})
-        config['filament_type'] = filament
-        return config
+    def get_load_profile(self, prutok, speed, config=None):
+        """
+        Профиль подачи до датчика экструдера для move_filament. feed_profile из
+        filament.json важнее; без него при выученной длине пути - известная часть
+        на скорости speed и медленный подход PATH_APPROACH_SPEED на последние
+        2 * PATH_APPROACH_MARGIN мм (за PATH_APPROACH_MARGIN до датчика и столько же
+        после), подача останавливается по датчику.
+        :return: 'feed_profile', список отрезков или None (одна скорость).
+        """
+        if config is None:
+            config = self.get_prutok_config(prutok)
+        if config.get('feed_profile'):
+            return 'feed_profile'
+        if self.tips.is_learned(prutok):
+            return [(0, speed), (2 * PATH_APPROACH_MARGIN, PATH_APPROACH_SPEED)]
+        return None
+
+    def _tip_sensor_event(self, state, edge_time=None):
+        # Время фронта по отсчету АЦП, а не по моменту вызова
+        eventtime = self._edge_time if edge_time is None else edge_time
+        prutok = self.tips.get_moving(eventtime)
+        if not prutok:
+            return
+        nominal = self.get_prutok_config(prutok)['filament_tube_length']
+        measured = self.tips.sensor_edge(state, eventtime, nominal)
+        if measured is None:
+            return
+        self.info(f"IFS_TIP: port {prutok} path {measured:.0f} mm, learned {self.tips.get_length(prutok, nominal):.0f} mm")
+        self.set_state('tip_path_lengths', self.tips.dump())
+
+    # Остановка движения: сначала учесть датчик, он мог сработать между опросами
+    def _stop_tips(self, unit=None, eventtime=None):
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        if self.tips.get_moving(eventtime):
+            self._tip_sensor_event(self.get_extruder_sensor(), self.extruder_sensor.edge_time)
+        self.tips.stop(eventtime, unit.index if unit is not None else None)
+
+    def get_tips_status(self, eventtime):
+        return [{
+            'position': round(self.tips.position(prutok, eventtime), 1),
+            'zone': self.tips.zone(prutok, eventtime),
+            'path_length': self.tips.lengths[prutok - 1],
+            'samples': self.tips.samples[prutok - 1],
+        } for prutok in range(1, self.slot_count + 1)]
+
+    cmd_IFS_TIP_help = "Show filament tip positions and learned path lengths"
+    def cmd_IFS_TIP(self, gcmd):
+        prutok = gcmd.get_int('PRUTOK', 0, minval=0, maxval=self.slot_count)
+        if gcmd.get_int('RESET', 0):
+            for i in ([prutok] if prutok else range(1, self.slot_count + 1)):
+                self.tips.forget(i)
+            self.set_state('tip_path_lengths', self.tips.dump())
+        eventtime = self.reactor.monotonic()
+        lines = []
+        for i, tip in enumerate(self.get_tips_status(eventtime), 1):
+            if prutok and i != prutok:
+                continue
+            length = f"{tip['path_length']:.0f} mm ({tip['samples']})" if tip['path_length'] else "-"
+            lines.append(f"{i}: {tip['zone']} {tip['position']:.0f} mm, path {length}")
+        gcmd.respond_info("\n".join(lines))
 
     # Вывод температур
     def cmd_IFS_PRINT_DEFAULTS(self, gcmd):
@@ -421,14 +1366,359 @@ class zmod_ifs:
         self.print_str(msg.strip())
 
     def cmd_IFS_GET_COMMAND(self, gcmd):
-        with self._command_lock:
-            current_command = self._command
-            current_id = self._command_id
-        with self._ret_command_lock:
-            ret_command_data = self._ret_command_data
-            ret_command_id = self._ret_command_id
+        lines = []
+        for unit in self.units:
+            name = f" {unit.name}" if unit.index else ""
+            lines.append(f"IFS_GET_COMMAND{name}: {unit.get_command()}")
+        self.print_str("\n".join(lines))
+
+    cmd_IFS_STATS_help = "Serial link statistics"
+    def cmd_IFS_STATS(self, gcmd):
+        lines = []
+        for unit in self.units:
+            stats = unit.stats.get_stats()
+            lines.append(("Статистика %s за %.0f с" if self.lang == 'ru' else "%s statistics for %.0f s") % (unit.label, stats['uptime']))
+            lines.append(" ".join(f"{key}={value}" for key, value in stats['counters'].items()))
+            recovery = stats['recovery']
+            lines.append("recovery: " + " ".join(f"{key}={value}" for key, value in recovery['steps'].items())
+                         + f" time={recovery['time_s']:.1f}s max={recovery['max_s']:.1f}s"
+                         + f" resumed={recovery['resumed_mm']:.0f}mm wasted={recovery['wasted_mm']:.0f}mm")
+            for name, rtt in sorted(stats['rtt'].items()):
+                hist = " ".join(str(n) for n in rtt['hist'])
+                lines.append(f"{name}: n={rtt['count']} avg={rtt['avg_ms']:.1f}ms max={rtt['max_ms']:.1f}ms hist=[{hist}]")
+        gcmd.respond_info("\n".join(lines))
+        if gcmd.get_int('RESET', 0):
+            for unit in self.units:
+                unit.stats.reset()
+
+    cmd_IFS_TRACE_DUMP_help = "Write the serial traffic trace to the log directory"
+    def cmd_IFS_TRACE_DUMP(self, gcmd):
+        paths = self.dump_trace("IFS_TRACE_DUMP")
+        if not paths:
+            raise gcmd.error("Не удалось записать трассировку" if self.lang == 'ru' else "Failed to write trace")
+        paths = ", ".join(paths)
+        gcmd.respond_info(f"Трассировка записана в {paths}" if self.lang == 'ru' else f"Trace written to {paths}")
+
+    cmd_IFS_LOOKAHEAD_help = "Show upcoming tool changes in the printed file"
+    def cmd_IFS_LOOKAHEAD(self, gcmd):
+        if self.lookahead is None:
+            gcmd.respond_info("Просмотр вперед выключен" if self.lang == 'ru' else "Look-ahead is disabled")
+            return
+        schedule = self.lookahead.get_schedule(self.reactor.monotonic())
+        if not schedule:
+            gcmd.respond_info("Смен инструмента впереди не найдено" if self.lang == 'ru' else "No upcoming tool changes found")
+            return
+        lines = []
+        for change in schedule:
+            lines.append(f"{change['command']} {change['tool']}: {change['distance']:.0f} mm, "
+                         f"{change['time']:.0f} s, pos {change['file_position']}")
+        gcmd.respond_info("\n".join(lines))
+
+    # Подвод прутка к точке слияния, пока печатает другой
+    def take_prestaged(self, prutok):
+        """
+        Забирает подведенную длину порта: дальше пруток ведет загрузка или выгрузка.
+        :return: На сколько мм пруток был подведен заранее.
+        """
+        if not 1 <= prutok <= len(self._prestaged):
+            return 0
+        length = self._prestaged[prutok - 1]
+        self._prestaged[prutok - 1] = 0
+        return length
+
+    def get_tool_prutok(self, command, tool):
+        # T<n> идут через карту file.json, MMU_CHANGE_TOOL - сразу номер слота
+        if command != 'T':
+            return tool
+        try:
+            return int(self.config_cache.load(FILE_CONFIG)[tool])
+        except (OSError, ValueError, IndexError, TypeError):
+            return 0
+
+    def get_next_prutok(self, max_time=None):
+        if self.lookahead is None:
+            return 0
+        cur_prutok = self.get_current_channel_from_config()
+        for change in self.lookahead.get_schedule(self.reactor.monotonic()):
+            if max_time is not None and change['time'] > max_time:
+                break
+            prutok = self.get_tool_prutok(change['command'], change['tool'])
+            if prutok != cur_prutok and 1 <= prutok <= len(self._prestaged):
+                return prutok
+        return 0
+
+    def prestage(self, prutok):
+        """
+        Подводит пруток из IFS на prestage_length мм, до общего пути.
+        Ошибка подвода печать не прерывает.
+        :return: True, если пруток подведен.
+        """
+        if self._prestaged[prutok - 1]:
+            return True
+        if prutok == self.get_current_channel_from_config() and self.get_extruder_sensor():
+            return False
+        if not self.get_port(prutok):
+            self.gcode.respond_info(f"Нет прутка {prutok} в IFS" if self.lang == 'ru' else f"No filament {prutok} in IFS")
+            return False
+        self.gcode.respond_info(f"Подвожу пруток {prutok} на {self.prestage_length} мм" if self.lang == 'ru'
+                                else f"Pre-staging filament {prutok} by {self.prestage_length} mm")
+        gcmd_tmp = self.gcode.create_gcode_command("IFS_F24", "IFS_F24", {'PRUTOK': prutok})
+        self.cmd_IFS_F24(gcmd_tmp)
+        start = self.tips.position(prutok, self.reactor.monotonic())
+        success, ret_code, values = self.move_filament(
+            prutok, 1, self.prestage_length, self.prestage_speed,
+            Port=prutok,
+            FFS_state=FFS_STATUS_ZAGRUZKA,
+            silk={'count': self.silk_count, 'status': False},
+            stall={'count': self.stall_count, 'status': False},
+        )
+        if not success:
+            self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={prutok}")
+        gcmd_tmp = self.gcode.create_gcode_command("IFS_F39", "IFS_F39", {'PRUTOK': prutok})
+        self.cmd_IFS_F39(gcmd_tmp)
+        if success:
+            length = self.prestage_length
+            if self._prestage_cancel:
+                # Остановлен на полпути (wait_prestage) - подведен только пройденный путь
+                length = min(length, int(abs(self.tips.position(prutok, self.reactor.monotonic()) - start)))
+            self._prestaged[prutok - 1] = length
+        else:
+            self.print_result(ret_code, values, prutok)
+        return success
+
+    def wait_prestage(self, prutok, timeout=JOB_TIMEOUT):
+        """
+        Перед загрузкой прутка: подвод на его юните должен закончиться. Подвод этого
+        же прутка доводится до конца (путь все равно нужен), другого - останавливается.
+        Подвод на другом юните не мешает.
+        :param prutok: Какой пруток будет загружаться.
+        """
+        busy = self._prestage_prutok
+        if not busy or self.get_unit(busy)[0] is not self.get_unit(prutok)[0]:
+            return
+        if busy != prutok and not self._prestage_cancel:
+            self._prestage_cancel = True
+            self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={busy}")
+        end_time = self.reactor.monotonic() + timeout
+        while self._prestage_prutok == busy and self.reactor.monotonic() < end_time:
+            completion = self.reactor.completion()
+            self._prestage_waiters.append(completion)
+            completion.wait(end_time)
+
+    def _prestage_done(self):
+        self._prestage_prutok = 0
+        self._prestage_cancel = False
+        waiters = self._prestage_waiters
+        self._prestage_waiters = []
+        for completion in waiters:
+            self._complete(completion, True)
+
+    # Подвод ждет только свободного юнита: пока один юнит загружает
+    # или выгружает, другой может подводить свой пруток. Пруток занимается
+    # сразу, до запуска подвода, чтобы смена инструмента его видела.
+    def _prestage_event(self, eventtime):
+        if self.ifs and not self._prestage_prutok and self._change_state not in CHANGE_PHASES:
+            prutok = self.get_next_prutok(self.prestage_time)
+            if prutok and not self._prestaged[prutok - 1] and self.get_unit(prutok)[0].is_idle():
+                self._prestage_prutok = prutok
+                self.reactor.register_async_callback(
+                    lambda eventtime, p=prutok: self._run_prestage(p))
+        return eventtime + PRESTAGE_CHECK_TIME
+
+    # Ошибка подвода печать не прерывает, но в консоль и трассировку попадает
+    def _run_prestage(self, prutok):
+        try:
+            self.prestage(prutok)
+        except self.gcode.error as e:
+            unit = self.get_unit(prutok)[0]
+            unit.trace.add(TRACE_ERROR, 0, f"prestage {prutok} failed: {e}")
+            self.gcode.respond_info(f"Подвод прутка {prutok} не удался: {e}" if self.lang == 'ru'
+                                    else f"Pre-staging filament {prutok} failed: {e}")
+        finally:
+            self._prestage_done()
+
+    cmd_IFS_PRESTAGE_help = "Park the next filament before the merge point"
+    def cmd_IFS_PRESTAGE(self, gcmd):
+        if not self.ifs:
+            self.gcode.run_script_from_command("_IFS_OFF")
+            return
+
+        prutok = gcmd.get_int('PRUTOK', 0, minval=0, maxval=self.slot_count)
+        if gcmd.get_int('CLEAR', 0):
+            if prutok:
+                self.take_prestaged(prutok)
+            else:
+                self._prestaged = [0] * len(self._prestaged)
+            return
+        if not self.prestage_length:
+            gcmd.respond_info("Подвод выключен (prestage_length: 0)" if self.lang == 'ru' else "Pre-staging is disabled (prestage_length: 0)")
+            return
+        if gcmd.get_int('WAIT', 0):
+            # Перед загрузкой прутка PRUTOK (без него - дождаться текущего подвода)
+            self.wait_prestage(prutok or self._prestage_prutok)
+            return
+        if not prutok:
+            prutok = self.get_next_prutok()
+            if not prutok:
+                gcmd.respond_info("Нет следующей смены прутка" if self.lang == 'ru' else "No upcoming filament change")
+                return
+        self.wait_prestage(self._prestage_prutok)
+        self._prestage_prutok = prutok
+        try:
+            self.prestage(prutok)
+        finally:
+            self._prestage_done()
+
+    # Смена инструмента. Повторяет MMU_CHANGE_TOOL из mmu_ad5x.cfg, но нагрев до
+    # новой температуры идет с начала выгрузки, пруток ведется напрямую F24/F10 на
+    # выученную длину (move_filament с профилем подхода), а вместо G4 и блокирующего
+    # M109 ждем реальные условия: датчик экструдера и температуру.
+    def _wait_temperature(self, temp, timeout=HEAT_TIMEOUT):
+        extruder = self.printer.lookup_object('extruder', None)
+        if extruder is None:
+            self.gcode.run_script_from_command(f"M109 S{temp}")
+            return
+        heater = extruder.get_heater()
+        eventtime = self.reactor.monotonic()
+        end_time = eventtime + timeout
+        while not self.printer.is_shutdown():
+            current, target = heater.get_temp(eventtime)
+            if current >= temp - TEMP_TOLERANCE:
+                return
+            if eventtime > end_time:
+                raise self.gcode.error(f"Не удалось нагреть сопло до {temp}" if self.lang == 'ru'
+                                       else f"Timeout heating the nozzle to {temp}")
+            eventtime = self.reactor.pause(eventtime + HEAT_CHECK_TIME)
+
+    def _wait_extruder_sensor(self, status, timeout=SENSOR_SETTLE_TIME):
+        if self.get_extruder_sensor() == status:
+            return True
+        completion = self.reactor.completion()
+        def watch(state):
+            if state == status:
+                self._complete(completion, True)
+        self.add_extruder_callback(watch)
+        try:
+            completion.wait(self.reactor.monotonic() + timeout)
+        finally:
+            self.remove_extruder_callback(watch)
+        return self.get_extruder_sensor() == status
+
+    def _change_phase(self, phases, name, start_time):
+        eventtime = self.reactor.monotonic()
+        if self._change_state in CHANGE_PHASES:
+            phases[self._change_state] = round(eventtime - start_time, 3)
+        self._change_state = name
+        self.info(f"IFS_CHANGE_TOOL: {name}")
+        return eventtime
+
+    cmd_IFS_CHANGE_TOOL_help = "Tool change with heating overlapped with unload and feed"
+    def cmd_IFS_CHANGE_TOOL(self, gcmd):
+        if not self.ifs:
+            self.gcode.run_script_from_command("_IFS_OFF")
+            return
+
+        new_tool = gcmd.get_int('TOOL', 1, minval=1, maxval=self.slot_count)
+        new_unit = self.get_unit(new_tool, online=True)[0]
+        current_tool = gcmd.get_int('CURRENT', -1)
+        hotend_temp = gcmd.get_int('HOTEND_TEMP', 0)
+        if hotend_temp <= 0:
+            hotend_temp = int(self.get_prutok_config(new_tool)['temp'])
+        insert_speed = gcmd.get_int('INSERT_SPEED', 0) or 1200
+        remove_len = gcmd.get_int('REMOVE_LEN', 0) or 90
+        remove_speed = gcmd.get_int('REMOVE_SPEED', 0) or 1200
+        anti_ooze = gcmd.get_int('ANTI_OOZE', 30, minval=0)
+
+        if current_tool == new_tool:
+            gcmd.respond_info(f"Инструмент {new_tool} уже выбран" if self.lang == 'ru' else f"Tool {new_tool} is already selected")
+            return
+        gcmd.respond_info(f"Смена инструмента: {current_tool} -> {new_tool} ({hotend_temp}°C)" if self.lang == 'ru'
+                          else f"Tool change: {current_tool} -> {new_tool} ({hotend_temp}°C)")
 
-        self.print_str(f"IFS_GET_COMMAND: {current_command} ID: {current_id} RET: {ret_command_data} RET_ID: {ret_command_id}")
+        config = self.get_prutok_config(new_tool)
+        drop_length = int(config['filament_drop_length'])
+        if current_tool >= 1 and self.get_prutok_config(current_tool)['filament_type'] != config['filament_type']:
+            drop_length += int(config['filament_drop_length_add'])
+
+        phases = {}
+        start_time = self.reactor.monotonic()
+        self._change_state = 'start'
+        phase_time = start_time
+        try:
+            # Подвод на юните нового прутка не должен идти одновременно с загрузкой
+            self.wait_prestage(new_tool)
+            if current_tool >= 0:
+                # Обрезка на пониженной температуре (против подтекания)
+                phase_time = self._change_phase(phases, 'cut', phase_time)
+                self.gcode.run_script_from_command(
+                    "G91\nG0 E-20 F300\nG90\n"
+                    f"M104 S{hotend_temp - anti_ooze}\n"
+                    "_MMU_CUT")
+
+            # Сопло уже без прутка - нагрев до новой температуры идет во время выгрузки и подачи
+            self.gcode.run_script_from_command(f"M104 S{hotend_temp}")
+            if current_tool >= 0:
+                phase_time = self._change_phase(phases, 'unload', phase_time)
+                gcmd_tmp = self.gcode.create_gcode_command("IFS_F11", "IFS_F11", {
+                    'PRUTOK': current_tool, 'LEN': remove_len, 'SPEED': remove_speed, 'WAIT': 1, 'CHECK': 0})
+                self.cmd_IFS_F11(gcmd_tmp)
+                if not self._wait_extruder_sensor(False):
+                    raise self.gcode.error("Пруток не извлечен из экструдера" if self.lang == 'ru'
+                                           else "Unload verification failed: filament still in head")
+
+            phase_time = self._change_phase(phases, 'load', phase_time)
+            gcmd_tmp = self.gcode.create_gcode_command("IFS_F24", "IFS_F24", {'PRUTOK': new_tool, 'WAIT': 1})
+            self.cmd_IFS_F24(gcmd_tmp)
+
+            # Подача до датчика экструдера: выученная длина минус подведенное заранее
+            phase_time = self._change_phase(phases, 'feed', phase_time)
+            load_length = self.get_load_length(new_tool, config) - self.take_prestaged(new_tool)
+            success, ret_code, values = self.move_filament(
+                new_tool, 1, load_length, insert_speed, self.get_load_profile(new_tool, insert_speed, config),
+                **self._feed_checks(new_tool, FFS_STATUS_ZAGRUZKA, True))
+            if not success:
+                self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={new_tool}")
+            if not self._wait_extruder_sensor(True):
+                self.print_result(ret_code, values, new_tool, info=False)
+                raise self.gcode.error("Пруток не дошел до экструдера" if self.lang == 'ru'
+                                       else "Load verification failed: no filament in head")
+
+            phase_time = self._change_phase(phases, 'heat', phase_time)
+            self._wait_temperature(hotend_temp)
+
+            # Продавить пруток через сопло и отпустить его в IFS
+            phase_time = self._change_phase(phases, 'verify', phase_time)
+            self.gcode.run_script_from_command(
+                f"G1 E{drop_length} F{config['filament_load_speed']}\n"
+                f"G1 E-{config['filament_unload_after_drop']} F{config['filament_unload_speed']}")
+            for command in ("IFS_F23", "IFS_F39"):
+                gcmd_tmp = self.gcode.create_gcode_command(command, command, {'PRUTOK': new_tool, 'WAIT': 1})
+                getattr(self, f"cmd_{command}")(gcmd_tmp)
+            self.gcode.run_script_from_command("IFS_MOTION")
+            if not self.get_extruder_sensor():
+                raise self.gcode.error("Пруток не дошел до экструдера" if self.lang == 'ru'
+                                       else "Load verification failed: no filament in head")
+            self.set_state('mmu_current_tool', new_tool)
+            self.set_state('mmu_state', 'idle')
+            self.gcode.run_script_from_command("SET_CURRENT_PRUTOK")
+            phase_time = self._change_phase(phases, 'idle', phase_time)
+        except self.gcode.error:
+            if self._change_state == 'feed':
+                # Подача прервана ошибкой - остановить пруток
+                new_unit.queue_command("F112")
+            for unit in {self.get_unit(current_tool)[0], new_unit}:
+                unit.trace.add(TRACE_ERROR, 0, f"IFS_CHANGE_TOOL failed in {self._change_state}")
+            self._change_state = 'error'
+            raise
+        finally:
+            self._last_change = {
+                'from': current_tool,
+                'tool': new_tool,
+                'total': round(self.reactor.monotonic() - start_time, 3),
+                'phases': phases,
+            }
+        gcmd.respond_info(f"Смена инструмента завершена за {self._last_change['total']:.1f} с" if self.lang == 'ru'
+                          else f"Tool change done in {self._last_change['total']:.1f} s")
 
     # Проверить остановился или закончился пруток
     def cmd_IFS_MOTION(self, gcmd):
@@ -452,9 +1742,8 @@ class zmod_ifs:
             n_prutok = self.get_current_channel_from_config()
             if self.get_port(n_prutok):
                 try:
-                    with open(FILE_CONFIG, 'r') as f:
-                        mapping = json.load(f)
-                        cur_prutok = mapping.index(n_prutok)
+                    mapping = self.config_cache.load(FILE_CONFIG)
+                    cur_prutok = mapping.index(n_prutok)
                 except Exception as e:
                     cur_prutok = 98
 
@@ -475,26 +1764,24 @@ class zmod_ifs:
         prutok = 1
         t_prutok = 0
 
-        with open(FFCONFIG, 'r') as file:
-            config = json.load(file)
-            ffm_info = config["FFMInfo"]
-            prutok = ffm_info.get("channel", 1)
-            self.set_cur_port(prutok)
-            filament_type = ffm_info.get(f"ffmType{prutok}", "PLA")
-            filament_color = ffm_info.get(f"ffmColor{prutok}", "#161616")
+        config = self.config_cache.load(FFCONFIG)
+        ffm_info = config["FFMInfo"]
+        prutok = ffm_info.get("channel", 1)
+        self.set_cur_port(prutok)
+        filament_type = ffm_info.get(f"ffmType{prutok}", "PLA")
+        filament_color = ffm_info.get(f"ffmColor{prutok}", "#161616")
 
         if filament_type not in self.temp_defaults:
             filament_type = "PLA"
 
-        with open(FILE_CONFIG, 'r') as f:
-            mapping = json.load(f)
+        mapping = self.config_cache.load(FILE_CONFIG)
 
         try:
             t_prutok = mapping.index(prutok)
         except ValueError:
             t_prutok = 0
 
-        for i in range(1, 5):
+        for i in range(1, self.slot_count + 1):
             if (
                 f"ffmType{i}" not in ffm_info or
                 f"ffmColor{i}" not in ffm_info
@@ -509,8 +1796,7 @@ class zmod_ifs:
             ):
                 new_mapping = [i if x == prutok else x for x in mapping]
 
-                with open(FILE_CONFIG, 'w') as f:
-                    json.dump(new_mapping, f)
+                self.config_cache.store(FILE_CONFIG, new_mapping)
 
                 self.gcode.run_script_from_command("_PRINT_HEAD INFO=1 CHANNEL={t_prutok}")
                 self.gcode.run_script_from_command(f"_A_CHANGE_FILAMENT CHANNEL={t_prutok} RESTORE_POSITION=0 RESTORE_TEMP=1")
@@ -581,6 +1867,10 @@ class zmod_ifs:
             if config['filament_type'] != cur_config['filament_type']:
                 filament_drop_length_add = config['filament_drop_length_add']
 
+        # Подведенный заранее пруток осталось дотянуть на меньшую длину
+        self.wait_prestage(prutok)
+        tube_length = self.get_load_length(prutok, config) - self.take_prestaged(prutok)
+
         self.gcode.run_script_from_command(
             f"_INSERT_PRUTOK_IFS "
             f"PRUTOK={prutok} "
@@ -593,7 +1883,7 @@ class zmod_ifs:
             f"FILAMENT_UNLOAD_BEFORE_CUTTING={config['filament_unload_before_cutting']} "
             f"FILAMENT_UNLOAD_AFTER_CUTTING={config['filament_unload_after_cutting']} "
             f"FILAMENT_UNLOAD_AFTER_DROP={config['filament_unload_after_drop']} "
-            f"FILAMENT_TUBE_LENGTH={config['filament_tube_length']} "
+            f"FILAMENT_TUBE_LENGTH={tube_length} "
             f"FILAMENT_DROP_LENGTH={config['filament_drop_length']} "
             f"FILAMENT_DROP_LENGTH_ADD={filament_drop_length_add} "
             f"FILAMENT_FAN_SPEED={config['filament_fan_speed']} "
@@ -650,10 +1940,12 @@ class zmod_ifs:
             return
 
         prutok = gcmd.get_int('PRUTOK', 1)
+        unit = self.get_unit(prutok)[0]
         config = self.get_prutok_config(prutok)
+        self.take_prestaged(prutok)
 
         self.gcode.respond_info(f"Автоматическая вставка прутка {prutok}" if self.lang == 'ru' else f"Automatic filament insertion {prutok}")
-        self.wait_for_state()
+        self.wait_for_state(unit=unit)
 
         # Прижим прутка
         gcmd_tmp = self.gcode.create_gcode_command("IFS_F24", "IFS_F24", {'PRUTOK': prutok})
@@ -663,33 +1955,27 @@ class zmod_ifs:
         if self.get_extruder_sensor():
             self.gcode.respond_info("В экструдере есть пруток" if self.lang == 'ru' else "There is filament in the extruder")
             # Затягиваем пруток
-            for attempt in range(self.retry_count):
-                response = self._cmd_IFS_F10(prutok, leng=config['filament_autoinsert_full_length'], speed=config['filament_autoinsert_speed'])
-                success, ret_code, values = self.wait_for_state(
-                     Port=prutok,
-                     FFS_state=FFS_STATUS_ZAGRUZKA,
-                     silk={'count': self.silk_count, 'status': False},
-                     stall={'count': self.stall_count, 'status': False},
-                     timeout=120
-                )
-                if ret_code!=RET_RETRY:
-                    break
+            full_length = config['filament_autoinsert_full_length']
+            checks = self._feed_checks(prutok, FFS_STATUS_ZAGRUZKA, True)
+            del checks['extruder']
+            success, ret_code, values = self.move_filament(
+                prutok, 1, full_length, config['filament_autoinsert_speed'], 'feed_profile', **checks)
         else:
             self.gcode.respond_info("В экструдере нет прутка" if self.lang == 'ru' else "No filament in the extruder")
-            for attempt in range(self.retry_count):
-                response = self._cmd_IFS_F10(prutok, leng=config['filament_autoinsert_empty_length'], speed=config['filament_autoinsert_speed'])
-                success, ret_code, values = self.wait_for_state(
-                     Port=prutok,
-                     FFS_state=FFS_STATUS_ZAGRUZKA,
-                     silk={'count': self.silk_count, 'status': False},
-                     stall={'count': self.stall_count, 'status': False},
-                     extruder={'status': True},
-                     timeout=120
-                )
-                if ret_code!=RET_RETRY:
-                    break
+            # Длина пути известна - сразу ставим кончик на filament_autoinsert_ret_length
+            # до датчика, без срабатывания и обратного втягивания
+            empty_length = config['filament_autoinsert_empty_length']
+            if self.tips.is_learned(prutok):
+                remaining = int(self.tips.get_length(prutok, empty_length)
+                                - self.tips.position(prutok, self.reactor.monotonic())
+                                - config['filament_autoinsert_ret_length'])
+                if remaining > 0:
+                    empty_length = remaining
+            checks = self._feed_checks(prutok, FFS_STATUS_ZAGRUZKA, True)
+            success, ret_code, values = self.move_filament(
+                prutok, 1, empty_length, config['filament_autoinsert_speed'], 'feed_profile', **checks)
         if not success:
-            self.gcode.run_script_from_command("IFS_F112")
+            self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={prutok}")
             self.print_result(ret_code, values, prutok)
             if ret_code == RET_EXTRUDER:
                 # Втягиваем пруток
@@ -704,14 +1990,130 @@ class zmod_ifs:
         gcmd_tmp = self.gcode.create_gcode_command("IFS_F39", "IFS_F39", {'PRUTOK': prutok})
         self.cmd_IFS_F39(gcmd_tmp)
 
+    # Условия остановки подачи/выгрузки для wait_for_state
+    def _feed_checks(self, prutok, ffs_state, extruder_status):
+        return {
+            'Port': prutok,
+            'FFS_state': ffs_state,
+            'silk': {'count': self.silk_count, 'status': False},
+            'stall': {'count': self.stall_count, 'status': False},
+            'extruder': {'status': extruder_status},
+        }
+
+    def get_feed_segments(self, prutok, length, profile_name):
+        """
+        Разбивает движение на отрезки по профилю из filament.json.
+        :param prutok: Номер прутка.
+        :param length: Полная длина движения, мм.
+        :param profile_name: 'feed_profile', 'unload_profile' или сам профиль (get_load_profile).
+        :return: Список (длина, скорость), в сумме length; пустой, если профиля нет.
+        """
+        if isinstance(profile_name, str):
+            profile = self.get_prutok_config(prutok).get(profile_name) or []
+        else:
+            profile = profile_name
+        try:
+            profile = [(float(seg_len), int(seg_speed)) for seg_len, seg_speed in profile]
+        except (TypeError, ValueError):
+            logging.warning(f"IFS: bad {profile_name} for filament {prutok}: {profile}")
+            return []
+        if not profile or any(seg_speed <= 0 for seg_len, seg_speed in profile):
+            return []
+        fixed = sum(seg_len for seg_len, seg_speed in profile)
+        rest = max(0., length - fixed)
+        segments = [(seg_len if seg_len > 0 else rest, seg_speed) for seg_len, seg_speed in profile]
+        # Если путь короче профиля, обрезаем с начала: медленный подход важнее
+        excess = sum(seg_len for seg_len, seg_speed in segments) - length
+        result = []
+        for seg_len, seg_speed in segments:
+            cut = min(seg_len, max(0., excess))
+            excess -= cut
+            if seg_len - cut > 0.5:
+                result.append((seg_len - cut, seg_speed))
+        return result
+
+    def move_filament(self, prutok, direction, length, speed, profile=None, **kwargs):
+        """
+        Подача (F10) или выгрузка (F11) с ожиданием. После ошибки драйвера и сброса
+        повторяется только остаток пути по модели кончика прутка.
+        :param direction: 1 - загрузка (F10), -1 - выгрузка (F11).
+        :param profile: 'feed_profile', 'unload_profile' или список отрезков - движение по
+                        отрезкам профиля.
+        :param kwargs: Условия для wait_for_state (_feed_checks), иначе ждем READY.
+        :return: Как у wait_for_state.
+        """
+        send = self._cmd_IFS_F10 if direction > 0 else self._cmd_IFS_F11
+        unit = self.get_unit(prutok)[0]
+        start = self.tips.position(prutok, self.reactor.monotonic())
+        remaining = length
+        try:
+            for attempt in self._attempts(unit):
+                segments = self.get_feed_segments(prutok, remaining, profile) if profile else None
+                if segments:
+                    success, ret_code, values = self.move_profile(prutok, direction, remaining, segments, **kwargs)
+                else:
+                    send(prutok, remaining, speed)
+                    success, ret_code, values = self.wait_for_state(timeout=120, unit=unit, **kwargs)
+                if ret_code != RET_RETRY:
+                    return success, ret_code, values
+                # Пройденное до ошибки не повторяем
+                done = min(length, abs(self.tips.position(prutok, self.reactor.monotonic()) - start))
+                unit.stats.add_recovery_length(resumed=done)
+                remaining = int(round(length - done))
+                self.info(f"IFS: port {prutok} resume {remaining} of {length} mm after driver reset")
+                if remaining < 1:
+                    return True, RET_OK, values
+        except self.gcode.error:
+            # Движение прервано, пройденный путь потерян
+            unit.stats.add_recovery_length(
+                wasted=min(length, abs(self.tips.position(prutok, self.reactor.monotonic()) - start)))
+            raise
+
+    def move_profile(self, prutok, direction, length, segments, **kwargs):
+        """
+        Движение по отрезкам. Каждая следующая команда F10/F11 дается по времени на
+        ходу, с новой скоростью и оставшейся длиной, без ожидания FFS_STATUS_READY.
+        :param direction: 1 - загрузка (F10), -1 - выгрузка (F11).
+        :param kwargs: Условия для wait_for_state (_feed_checks), иначе ждем READY.
+        :return: Как у wait_for_state.
+        """
+        send = self._cmd_IFS_F10 if direction > 0 else self._cmd_IFS_F11
+        unit = self.get_unit(prutok)[0]
+        start = self.tips.position(prutok, self.reactor.monotonic())
+        travel = 0.
+        for i, (seg_len, speed) in enumerate(segments):
+            eventtime = self.reactor.monotonic()
+            done = abs(self.tips.position(prutok, eventtime) - start)
+            remaining = int(round(length - done))
+            if remaining <= 0:
+                break
+            send(prutok, remaining, speed)
+            travel += seg_len
+            until = None
+            if i < len(segments) - 1:
+                until = eventtime + max(0., travel - done) / self.tips.mm_per_second(speed)
+            success, ret_code, values = self.wait_for_state(timeout=120, until=until, unit=unit, **kwargs)
+            if ret_code != RET_SEGMENT:
+                return success, ret_code, values
+            self.info(f"IFS: port {prutok} segment {i + 1}/{len(segments)} done at {travel:.0f} mm")
+        # Путь пройден по модели, дождаться окончания движения
+        return self.wait_for_state(timeout=120, unit=unit, **kwargs)
+
     def _cmd_IFS_F10(self, prutok, leng, speed):
         if not self.ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
+        unit, port = self.get_unit(prutok, online=True)
+        self._stop_jobs(unit)
         self.gcode.respond_info(f"Вставить пруток {prutok} длинной {leng} со скоростью {speed}" if self.lang == 'ru' else f"Insert filament {prutok} with length {leng} at speed {speed}")
-        response = self.send_command_and_wait(f"F10 C{prutok} L{leng} S{speed}", result=f"F10 ok. FFS channel {prutok} feeding.")
-        self.info(f"F10 C{prutok} L{leng} S{speed} > {response}")
+        response = self.send_command_and_wait(f"F10 C{port} L{leng} S{speed}", result=f"F10 ok. FFS channel {port} feeding.", unit=unit)
+        if response == RET_ACCEPTED:
+            self.info(f"F10 C{port} L{leng} S{speed}: response lost, feeding per F13")
+        else:
+            self.info(f"F10 C{port} L{leng} S{speed} > {response}")
+        if response:
+            self.tips.start_move(prutok, 1, leng, speed, self.reactor.monotonic())
         return response
 
     # Загрузить пруток
@@ -720,7 +2122,8 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        prutok = gcmd.get_int('PRUTOK', 1)
+        prutok = gcmd.get_int('PRUTOK', 1, minval=1, maxval=self.slot_count)
+        unit, port = self.get_unit(prutok, online=True)
         leng = gcmd.get_int('LEN', 90)
         speed = gcmd.get_int('SPEED', 1200)
         if speed == 0:
@@ -728,46 +2131,43 @@ class zmod_ifs:
         wait = gcmd.get_int('WAIT', 1)
         check = gcmd.get_int('CHECK', 0)
         sleep = gcmd.get_int('SLEEP', 0)
+        checks = self._feed_checks(prutok, FFS_STATUS_ZAGRUZKA, True) if check == 1 else {}
 
-        for attempt in range(self.retry_count):
+        if sleep == 1 or wait != 1:
             response = self._cmd_IFS_F10(prutok, leng, speed)
             if sleep == 1:
                 # Ждем пока треть прутка пройдет
                 self.reactor.pause(self.reactor.monotonic() + (leng * 20) // speed + 1)
-                return
-            if wait == 1:
-                if check == 1:
-                    success, ret_code, values = self.wait_for_state(
-                        Port=prutok,
-                        FFS_state=FFS_STATUS_ZAGRUZKA,
-                        silk={'count': self.silk_count, 'status': False},
-                        stall={'count': self.stall_count, 'status': False},
-                        extruder={'status': True},
-                        timeout=120
-                    )
-                    if ret_code==RET_RETRY:
-                        continue
-                    if ret_code == RET_EXTRUDER or self.get_extruder_sensor():
-                        self.print_result(RET_EXTRUDER, values, prutok)
-                    else:
-                        self.print_result(ret_code, values, prutok, info=False)
-                    if not success:
-                        self.gcode.run_script_from_command("IFS_F112")
-                else:
-                    success, ret_code, values = self.wait_for_state(timeout=120)
-                if ret_code!=RET_RETRY:
-                    break
+            elif response:
+                self._respond_job(gcmd, self.start_job('F10', prutok, leng, speed, checks))
+            return
+
+        profile = self.get_load_profile(prutok, speed) if gcmd.get_int('PROFILE', 0) else None
+        success, ret_code, values = self.move_filament(prutok, 1, leng, speed, profile, **checks)
+        if check == 1:
+            if ret_code == RET_EXTRUDER or self.get_extruder_sensor():
+                self.print_result(RET_EXTRUDER, values, prutok)
             else:
-                break
+                self.print_result(ret_code, values, prutok, info=False)
+            if not success:
+                self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={prutok}")
 
     def _cmd_IFS_F11(self, prutok, leng, speed):
         if not self.ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
+        self.take_prestaged(prutok)
+        unit, port = self.get_unit(prutok, online=True)
+        self._stop_jobs(unit)
 
         self.gcode.respond_info(f"Извлечь пруток {prutok} длинной {leng} со скоростью {speed}" if self.lang == 'ru' else f"Extract filament {prutok} with length {leng} at speed {speed}")
-        response = self.send_command_and_wait(f"F11 C{prutok} L{leng} S{speed}", result=f"F11 ok. FFS channel {prutok} exiting.")
-        self.info(f"F11 C{prutok} L{leng} S{speed} > {response}")
+        response = self.send_command_and_wait(f"F11 C{port} L{leng} S{speed}", result=f"F11 ok. FFS channel {port} exiting.", unit=unit)
+        if response == RET_ACCEPTED:
+            self.info(f"F11 C{port} L{leng} S{speed}: response lost, unloading per F13")
+        else:
+            self.info(f"F11 C{port} L{leng} S{speed} > {response}")
+        if response:
+            self.tips.start_move(prutok, -1, leng, speed, self.reactor.monotonic())
         return response
 
     # Выгрузить пруток
@@ -776,33 +2176,23 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        prutok = gcmd.get_int('PRUTOK', 1)
+        prutok = gcmd.get_int('PRUTOK', 1, minval=1, maxval=self.slot_count)
+        unit, port = self.get_unit(prutok, online=True)
         leng = gcmd.get_int('LEN', 90)
         speed = gcmd.get_int('SPEED', 1200)
         wait = gcmd.get_int('WAIT', 1)
         check = gcmd.get_int('CHECK', 0)
+        checks = self._feed_checks(prutok, FFS_STATUS_VIGRUZKA, False) if check == 1 else {}
 
-        for attempt in range(self.retry_count):
-            response = self._cmd_IFS_F11(prutok, leng, speed)
-            if wait == 1:
-                if check == 1:
-                    success, ret_code, values = self.wait_for_state(
-                        Port=prutok,
-                        FFS_state=FFS_STATUS_VIGRUZKA,
-                        silk={'count': self.silk_count, 'status': False},
-                        stall={'count': self.stall_count, 'status': False},
-                        extruder={'status': False},
-                        timeout=120
-                    )
-                    if ret_code==RET_RETRY:
-                        continue
-                    self.gcode.run_script_from_command("IFS_F112")
-                else:
-                    success, ret_code, values = self.wait_for_state(timeout=120)
-                if ret_code!=RET_RETRY:
-                    break
-            else:
-                break
+        if wait != 1:
+            if self._cmd_IFS_F11(prutok, leng, speed):
+                self._respond_job(gcmd, self.start_job('F11', prutok, leng, speed, checks))
+            return
+
+        profile = 'unload_profile' if gcmd.get_int('PROFILE', 0) else None
+        self.move_filament(prutok, -1, leng, speed, profile, **checks)
+        if check == 1:
+            self.gcode.run_script_from_command(f"IFS_F112 PRUTOK={prutok}")
 
     # Пометить пруток как вставленный
     def cmd_IFS_F23(self, gcmd):
@@ -810,16 +2200,17 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        prutok = gcmd.get_int('PRUTOK', 1)
+        prutok = gcmd.get_int('PRUTOK', 1, minval=1, maxval=self.slot_count)
+        unit, port = self.get_unit(prutok, online=True)
         wait = gcmd.get_int('WAIT', 1)
 
         self.gcode.respond_info(f"Помечаем пруток {prutok}" if self.lang == 'ru' else f"Marking filament {prutok}")
 
-        for attempt in range(self.retry_count):
-            response = self.send_command_and_wait(f"F23 C{prutok}", result=f"F23 ok. chan {prutok}.")
-            self.info(f"F23 C{prutok} > {response}")
+        for attempt in self._attempts(unit):
+            response = self.send_command_and_wait(f"F23 C{port}", result=f"F23 ok. chan {port}.", unit=unit)
+            self.info(f"F23 C{port} > {response}")
             if wait == 1:
-                success, ret_code, values = self.wait_for_state()
+                success, ret_code, values = self.wait_for_state(unit=unit)
                 if ret_code!=RET_RETRY:
                     break
             else:
@@ -831,15 +2222,16 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        prutok = gcmd.get_int('PRUTOK', 1)
+        prutok = gcmd.get_int('PRUTOK', 1, minval=1, maxval=self.slot_count)
+        unit, port = self.get_unit(prutok, online=True)
         wait = gcmd.get_int('WAIT', 1)
 
         self.gcode.respond_info(f"Блокировка прутка {prutok}" if self.lang == 'ru' else f"Locking filament {prutok}")
-        for attempt in range(self.retry_count):
-            response = self.send_command_and_wait(f"F24 C{prutok}", result=f"F24 ok. chan {prutok}.")
-            self.info(f"F24 C{prutok} > {response}")
+        for attempt in self._attempts(unit):
+            response = self.send_command_and_wait(f"F24 C{port}", result=f"F24 ok. chan {port}.", unit=unit)
+            self.info(f"F24 C{port} > {response}")
             if wait == 1:
-                success, ret_code, values = self.wait_for_state()
+                success, ret_code, values = self.wait_for_state(unit=unit)
                 if ret_code!=RET_RETRY:
                     break
             else:
@@ -851,20 +2243,28 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        prutok = gcmd.get_int('PRUTOK', 1)
+        prutok = gcmd.get_int('PRUTOK', 1, minval=1, maxval=self.slot_count)
+        unit, port = self.get_unit(prutok, online=True)
         wait = gcmd.get_int('WAIT', 1)
 
         self.gcode.respond_info(f"Разблокировка прутка {prutok}" if self.lang == 'ru' else f"Unlocking filament {prutok}")
-        for attempt in range(self.retry_count):
-            response = self.send_command_and_wait(f"F39 C{prutok}", result=f"F39 ok. FFS channel {prutok} release.")
-            self.info(f"F39 C{prutok} > {response}")
+        for attempt in self._attempts(unit):
+            response = self.send_command_and_wait(f"F39 C{port}", result=f"F39 ok. FFS channel {port} release.", unit=unit)
+            self.info(f"F39 C{port} > {response}")
             if wait == 1:
-                success, ret_code, values = self.wait_for_state()
+                success, ret_code, values = self.wait_for_state(unit=unit)
                 if ret_code!=RET_RETRY:
                     break
             else:
                 break
 
+    # Юниты для команд без канала: PRUTOK=N - только юнит этого прутка, иначе все на связи
+    def _command_units(self, gcmd):
+        prutok = gcmd.get_int('PRUTOK', 0, minval=0, maxval=self.slot_count)
+        if prutok:
+            return [self.get_unit(prutok, online=True)[0]]
+        return [unit for unit in self.units if unit.online]
+
     # Сброс драйвера
     def cmd_IFS_F15(self, gcmd):
         if not self.ifs:
@@ -872,8 +2272,11 @@ class zmod_ifs:
             return
 
         self.gcode.respond_info(f"Сброс драйвера" if self.lang == 'ru' else f"Driver reset")
-        response = self.send_command_and_wait("F15 C", result="F15 ok.")
-        self.info(f"F15 > {response}")
+        for unit in self._command_units(gcmd):
+            self._stop_tips(unit)
+            self._stop_jobs(unit)
+            response = self.send_command_and_wait("F15 C", result="F15 ok.", unit=unit)
+            self.info(f"F15 > {response}")
 
     # Разблокировать пруток ALL
     def cmd_IFS_F18(self, gcmd):
@@ -884,15 +2287,18 @@ class zmod_ifs:
         wait = gcmd.get_int('WAIT', 1)
 
         self.gcode.respond_info(f"Разблокировка всех прутков" if self.lang == 'ru' else f"Unlocking all filaments")
-        for attempt in range(self.retry_count):
-            response = self.send_command_and_wait("F18", result=f"F18 ok", timeout=10.0)
-            self.info(f"F18 > {response}")
-            if wait == 1:
-                success, ret_code, values = self.wait_for_state()
-                if ret_code!=RET_RETRY:
+        for unit in self._command_units(gcmd):
+            self._stop_tips(unit)
+            self._stop_jobs(unit)
+            for attempt in self._attempts(unit):
+                response = self.send_command_and_wait("F18", result=f"F18 ok", timeout=10.0, unit=unit)
+                self.info(f"F18 > {response}")
+                if wait == 1:
+                    success, ret_code, values = self.wait_for_state(unit=unit)
+                    if ret_code!=RET_RETRY:
+                        break
+                else:
                     break
-            else:
-                break
 
     # Остановить движение
     def cmd_IFS_F112(self, gcmd):
@@ -903,16 +2309,18 @@ class zmod_ifs:
         wait = gcmd.get_int('WAIT', 0)
 
         self.gcode.respond_info(f"Принудительно останавливаю движение прутка" if self.lang == 'ru' else f"Force stop filament movement")
-
-        for attempt in range(self.retry_count):
-            response = self.send_command_and_wait(f"F112", result=("F112 ok.", "F112 ok. yes."))
-            self.info(f"F112 > {response}")
-            if wait == 1:
-                success, ret_code, values = self.wait_for_state()
-                if ret_code!=RET_RETRY:
+        for unit in self._command_units(gcmd):
+            self._stop_tips(unit)
+            self._stop_jobs(unit)
+            for attempt in self._attempts(unit):
+                response = self.send_command_and_wait(f"F112", result=("F112 ok.", "F112 ok. yes."), unit=unit)
+                self.info(f"F112 > {response}")
+                if wait == 1:
+                    success, ret_code, values = self.wait_for_state(unit=unit)
+                    if ret_code!=RET_RETRY:
+                        break
+                else:
                     break
-            else:
-                break
 
     # Статус
     def cmd_IFS_F13(self, gcmd):
@@ -920,13 +2328,19 @@ class zmod_ifs:
             self.gcode.run_script_from_command("_IFS_OFF")
             return
 
-        response = self.send_command_and_wait("F13")
-        self.print_str(f"F13 > {response}")
+        for unit in self._command_units(gcmd):
+            response = self.send_command_and_wait("F13", unit=unit)
+            name = f" {unit.name}" if unit.index else ""
+            self.print_str(f"F13{name} > {response}")
 
     cmd_IFS_STATUS_help = "Get current IFS status"
     def cmd_IFS_STATUS(self, gcmd):
-        values = self.ifs_data.get_values()
-        gcmd.respond_info(json.dumps(values))
+        lines = []
+        for unit in self._command_units(gcmd):
+            values = unit.ifs_data.get_values()
+            name = f"{unit.name}: " if unit.index else ""
+            lines.append(name + json.dumps(values))
+        gcmd.respond_info("\n".join(lines))
 
     def cmd_IFS_EXTRUDER_SENSOR(self, gcmd):
         info = gcmd.get_int('INFO', 0)
@@ -995,220 +2409,1405 @@ class zmod_ifs:
             self.gcode.run_script_from_command(f"TEMPERATURE_WAIT SENSOR=extruder MINIMUM={config['temp']-2} MAXIMUM={config['temp']+4}")
         self.gcode.run_script_from_command(f"IFS_REMOVE_PRUTOK PRUTOK={prutok} FORCE=0 NEED_TRASH={need_trash}")
 
+# Один IFS на своем последовательном порту: поток чтения, очередь команд,
+# снимки статуса F13, статистика и трассировка обмена. Основной юнит задается
+# секцией [zmod_ifs], дополнительные - секциями [zmod_ifs NAME] в порядке
+# их следования в конфиге. Порты юнита - прутки first_slot+1..first_slot+4.
+class IfsUnit:
+    def __init__(self, config, ifs, index, main=None):
+        self.ifs = ifs
+        self.reactor = ifs.reactor
+        self.index = index
+        self.first_slot = index * IFS_PORTS
+        self.name = config.get_name().split()[-1] if main is not None else 'main'
+        self.label = f"IFS {self.name}" if main is not None else "IFS"
+        if main is None:
+            self.port = config.get('port', PORT)                                        # последовательный порт IFS (или pty симулятора)
+            self.send_ff = config.getboolean('send_ff', True)                           # отправлять 0xFF после команды
+            self.ff_delay = config.getfloat('ff_delay', 0., minval=0.)                  # минимальная пауза перед 0xFF
+            self.command_interval = config.getfloat('command_interval', 0.02, minval=0.)    # минимальный интервал между ответом и следующей командой
+            self.response_timeout = config.getfloat('response_timeout', RESPONSE_TIMEOUT, above=0.) # сколько ждать строку ответа
+            trace_size = config.getint('trace_size', TRACE_SIZE, minval=16)             # сколько событий обмена хранить для IFS_TRACE_DUMP
+            self.poll_intervals = {                                                     # интервалы опроса F13 по режимам
+                POLL_IDLE: config.getfloat('poll_idle_time', 1., above=0.),
+                POLL_ACTIVE: config.getfloat('poll_active_time', 0.1, above=0.),
+                POLL_ERROR: config.getfloat('poll_error_time', HOST_REPORT_TIME, above=0.),
+            }
+        else:
+            # Порт обязателен, остальное по умолчанию как у основного юнита
+            self.port = config.get('port')
+            self.send_ff = config.getboolean('send_ff', main.send_ff)
+            self.ff_delay = config.getfloat('ff_delay', main.ff_delay, minval=0.)
+            self.command_interval = config.getfloat('command_interval', main.command_interval, minval=0.)
+            self.response_timeout = config.getfloat('response_timeout', main.response_timeout, above=0.)
+            trace_size = config.getint('trace_size', main.trace.size, minval=16)
+            self.poll_intervals = {
+                POLL_IDLE: config.getfloat('poll_idle_time', main.poll_intervals[POLL_IDLE], above=0.),
+                POLL_ACTIVE: config.getfloat('poll_active_time', main.poll_intervals[POLL_ACTIVE], above=0.),
+                POLL_ERROR: config.getfloat('poll_error_time', main.poll_intervals[POLL_ERROR], above=0.),
+            }
+
+        self.online = False             # Есть связь с юнитом
+        self.ifs_data = IfsData()
+
+        # Синхронизация потоков
+        self._command_lock = threading.Lock()
+        self._command_cond = threading.Condition(self._command_lock)
+        self._command_queue = []        # Очередь команд (heapq по приоритету и ID)
+        self._command = "F13"           # Команда, отправленная последней
+        self._command_id = 0
+
+        self._ret_command_lock = threading.Lock()
+        self._ret_command_data = ""
+        self._ret_command_id = 0
+
+        self._status_waiters = []       # Ожидающие нового снимка статуса
+        self._poll_mode = POLL_IDLE     # Текущий режим опроса F13
+        self._poll_active_until = 0.    # До какого момента держать частый опрос
+
+        self._rx_buffer = bytearray()   # Принятые, но еще не разобранные байты
+        self._last_rx_time = 0.
+        self.ok_status_time = 0.        # Когда пришел последний снимок без ошибки драйвера (время реактора)
+        self.stats = IfsStats()         # Время ответа и сбои канала
+        self.trace = IfsTrace(trace_size)
+
+        self.stop_thread = False
+        self.sensor_thread = threading.Thread(target=self._sensor_reader)
+        self.sensor_thread.daemon = True
+
+    def get_slots(self):
+        return range(self.first_slot + 1, self.first_slot + IFS_PORTS + 1)
+
+    def start(self):
+        self.sensor_thread.start()
+
+    def close(self):
+        self.stop_thread = True
+        # Разбудить всех, кто ждет ответа
+        with self._command_lock:
+            pending = list(self._command_queue)
+        for cmd in pending:
+            self.ifs._complete(cmd.completion, None)
+        if self.sensor_thread.is_alive():
+            self.sensor_thread.join(timeout=2.0)
+
+    def is_idle(self):
+        return (self.online and not self._status_waiters and not self._command_queue
+                and self.ifs_data.get_state() == FFS_STATUS_READY)
+
+    def get_status(self, eventtime):
+        return {
+            'name': self.name,
+            'port': self.port,
+            'online': self.online,
+            'slots': [self.first_slot + 1, self.first_slot + IFS_PORTS],
+            'state': self.ifs_data.get_state(),
+            'poll_mode': self._poll_mode,
+            'poll_interval': self.poll_intervals[self._poll_mode],
+            'stats': self.stats.get_stats(),
+        }
+
+    def get_command(self):
+        with self._command_lock:
+            current_command = self._command
+            current_id = self._command_id
+            queue_len = len([cmd for cmd in self._command_queue if not cmd.cancelled])
+        with self._ret_command_lock:
+            ret_command_data = self._ret_command_data
+            ret_command_id = self._ret_command_id
+        return (f"{current_command} ID: {current_id} QUEUE: {queue_len} RET: {ret_command_data} "
+                f"RET_ID: {ret_command_id} POLL: {self._poll_mode}")
+
+    def _command_priority(self, command):
+        name = command.split(' ', 1)[0]
+        if name in STOP_COMMANDS:
+            return PRIO_STOP
+        if name == "F13":
+            return PRIO_STATUS
+        return PRIO_NORMAL
+
+    def queue_command(self, command, priority=None):
+        """
+        Ставит команду в очередь на отправку.
+        :param command: Команда для отправки (например, "F13").
+        :param priority: Приоритет, по умолчанию определяется по команде.
+        :return: IfsCommand, в который поток чтения запишет ответ.
+        """
+        if priority is None:
+            priority = self._command_priority(command)
+        if priority != PRIO_STATUS:
+            self._poll_active_until = time.monotonic() + POLL_ACTIVE_HOLD
+            self._poll_mode = POLL_ACTIVE
+        completion = self.reactor.completion()
+        with self._command_cond:
+            self._command_id += 1
+            cmd = IfsCommand(command, self._command_id, priority, completion)
+            heapq.heappush(self._command_queue, cmd)
+            self._command_cond.notify()
+        return cmd
+
+    def cancel_command(self, cmd):
+        with self._command_lock:
+            cmd.cancelled = True
+
+    def _next_command(self):
+        with self._command_lock:
+            while self._command_queue:
+                cmd = heapq.heappop(self._command_queue)
+                if not cmd.cancelled:
+                    return cmd
+        return None
+
+    def _update_poll_mode(self):
+        state = self.ifs_data.get_state()
+        if state == FFS_STATUS_DRV_ERROR:
+            mode = POLL_ERROR
+        elif (self._status_waiters or time.monotonic() < self._poll_active_until
+              or is_moving_state(state)):
+            mode = POLL_ACTIVE
+        else:
+            mode = POLL_IDLE
+        self._poll_mode = mode
+        return self.poll_intervals[mode]
+
+    def _wait_command(self, timeout):
+        with self._command_cond:
+            if not self._command_queue:
+                self._command_cond.wait(timeout)
+
+    def wait_status(self, version, waketime):
+        """
+        Ждет снимок статуса IFS новее указанной версии.
+        :param version: Версия последнего обработанного снимка.
+        :param waketime: Время реактора, до которого ждать.
+        :return: Новая версия или None, если ожидание прервано.
+        """
+        current = self.ifs_data.get_version()
+        if current > version:
+            return current
+        completion = self.reactor.completion()
+        self._status_waiters.append(completion)
+        completion.wait(waketime)
+        current = self.ifs_data.get_version()
+        if current > version:
+            return current
+        return None
+
+    # Вызывается в реакторе после каждого нового снимка статуса
+    def notify_status(self, eventtime=None):
+        waiters = self._status_waiters
+        self._status_waiters = []
+        for completion in waiters:
+            self.ifs._complete(completion, None)
+        self.ifs._wake_jobs()
+
+    # Ошибка в потоке чтения
+    def _error(self, msg):
+        logging.warning(msg)
+        self.trace.add(TRACE_ERROR, 0, msg)
+        self.ifs.dump_trace(msg)
+        self.ifs._respond_info(msg)
+
+    def _write_command(self, ser, command):
+        # Выдерживаем минимальный интервал после предыдущего ответа
+        delay = self._last_rx_time + self.command_interval - time.monotonic()
+        if delay > 0.:
+            time.sleep(delay)
+        # Все, что пришло до отправки, к этой команде не относится
+        if ser.in_waiting:
+            ser.reset_input_buffer()
+        self._rx_buffer.clear()
+        sent_time = time.monotonic()
+        ser.write((command + "\r\n").encode())
+        if self.send_ff:
+            if self.ff_delay:
+                time.sleep(self.ff_delay)
+            ser.write(b'\xFF')
+        return sent_time
+
+    def _read_response(self, ser, command):
+        """
+        Читает строку ответа на команду, как только она пришла целиком.
+        Мусор и ответы на чужие команды пропускаются.
+        :return: Строка ответа или "" при таймауте.
+        """
+        name = command.split(' ', 1)[0]
+        deadline = time.monotonic() + self.response_timeout
+        while True:
+            pos = self._rx_buffer.find(b'\n')
+            if pos >= 0:
+                raw = bytes(self._rx_buffer[:pos])
+                del self._rx_buffer[:pos + 1]
+                line = raw.strip(b'\r\n\x00\xff ').decode('utf-8', errors='ignore').strip()
+                if not line or not line.isprintable():
+                    continue
+                tag = line.split(' ', 1)[0]
+                if tag != name and re.fullmatch(r'F\d+', tag):
+                    # Запоздавший ответ на другую команду
+                    continue
+                self._last_rx_time = time.monotonic()
+                return line
+            if len(self._rx_buffer) > MAX_LINE_LENGTH:
+                self._rx_buffer.clear()
+            if time.monotonic() >= deadline:
+                return ""
+            data = ser.read(1)
+            if data:
+                waiting = ser.in_waiting
+                if waiting:
+                    data += ser.read(waiting)
+                self._rx_buffer += data
+
     def _sensor_reader(self):
+        connects = 0
         while not self.stop_thread:
             ser = None
             logging.info("IFS: Starting connection attempt...")
             try:
-                logging.info(f"IFS: {PORT} opening")
+                logging.info(f"IFS: {self.port} opening")
                 ser = serial.Serial(
-                    port=PORT,
+                    port=self.port,
                     baudrate=BAUDRATE,
                     parity=PARITY,
                     stopbits=STOPBITS,
                     bytesize=BYTESIZE,
                     timeout=TIMEOUT
                 )
-                logging.info(f"IFS: {PORT} open")
+                logging.info(f"IFS: {self.port} open")
+                self.trace.add(TRACE_INFO, 0, f"{self.port} open")
+                if connects:
+                    self.stats.count('reconnects')
+                connects += 1
                 while not self.stop_thread:
-                    with self._command_lock:
-                        current_command = self._command
-                    command_id = -1
-                    if '#' in current_command:
-                        command, command_id = current_command.split('#', 1)
-                        command_id = int(command_id)
+                    cmd = self._next_command()
+                    if cmd is None: # Очередь пуста - опрашиваем состояние
+                        command = "F13"
+                        current_command = command
                     else:
-                        command = current_command
-
-                    ser.write((command + "\r\n").encode())
-                    time.sleep(0.2)
-                    ser.write(b'\xFF')
+                        command = cmd.command
+                        current_command = f"{command}#{cmd.command_id}"
+                    with self._command_lock:
+                        self._command = current_command
 
-                    response = ser.readline().decode('utf-8', errors='ignore').strip()
+                    sent_time = self._write_command(ser, command)
+                    if cmd is not None:
+                        self.trace.add(TRACE_TX, cmd.command_id, command)
+                    response = self._read_response(ser, command)
                     #self._respond_info(f"IN: {response}")
                     if not response:
-                        if self.ifs:
-                            if self.lang == 'ru':
+                        self.stats.count('empty_responses')
+                        self.trace.add(TRACE_ERROR, cmd.command_id if cmd else 0, f"empty response to {command}")
+                        if cmd is not None:
+                            # Команда могла дойти, повторять ли ее - решает восстановление (_recover_command).
+                            # Жива ли связь, покажет следующий опрос F13, порт не переоткрываем.
+                            self.reactor.register_async_callback(
+                                lambda eventtime, c=cmd: self.ifs._complete(c.completion, RET_TIMEOUT))
+                            continue
+                        if self.online:
+                            if self.ifs.lang == 'ru':
                                 logging.warning(f"Пустой ответ от устройства {current_command}")
-                                self._respond_info(f"Пустой ответ от устройства {current_command}")
-                                logging.warning("IFS не доступен")
-                                self._respond_info("IFS не доступен")
+                                self.ifs._respond_info(f"Пустой ответ от устройства {current_command}")
+                                logging.warning(f"{self.label} не доступен")
+                                self.ifs._respond_info(f"{self.label} не доступен")
                             else:
                                 logging.warning(f"Empty response from device {current_command}")
-                                self._respond_info(f"Empty response from device {current_command}")
-                                logging.warning("IFS is not available")
-                                self._respond_info("IFS is not available")
-                            self.reactor.register_async_callback(
-                                lambda eventtime: self._safe_run_script("_IFS_OFF")
-                            )
-                            self.ifs = False
+                                self.ifs._respond_info(f"Empty response from device {current_command}")
+                                logging.warning(f"{self.label} is not available")
+                                self.ifs._respond_info(f"{self.label} is not available")
+                            self.ifs.set_unit_online(self, False)
                         break
-                    if not self.ifs:
-                        if self.lang == 'ru':
-                            logging.warning("IFS доступен")
-                            self._respond_info("IFS доступен")
+                    self.stats.add_rtt(command.split(' ', 1)[0], self._last_rx_time - sent_time)
+                    if not self.online:
+                        if self.ifs.lang == 'ru':
+                            logging.warning(f"{self.label} доступен")
+                            self.ifs._respond_info(f"{self.label} доступен")
                         else:
-                            logging.warning("IFS is available")
-                            self._respond_info("IFS is available")
-                        self.reactor.register_async_callback(
-                            lambda eventtime: self._safe_run_script("_IFS_ON")
-                        )
-                        self.ifs = True
-
-                    if command_id == -1:
-                        self.ifs_data.update_from_string(response)
-                        current_values = self.ifs_data.get_values()
+                            logging.warning(f"{self.label} is available")
+                            self.ifs._respond_info(f"{self.label} is available")
+                        self.ifs.set_unit_online(self, True)
+
+                    if cmd is None:
+                        if response != self.ifs_data.raw:
+                            old_state = self.ifs_data.get_state()
+                            self.trace.add(TRACE_RX, 0, response)
+                            self.ifs_data.update_from_string(response)
+                            state = self.ifs_data.get_state()
+                            if state != old_state:
+                                self.trace.add(TRACE_STATE, 0, f"{old_state} -> {state}")
+                        else:
+                            self.ifs_data.update_from_string(response)
+                        if self.ifs_data.get_state() != FFS_STATUS_DRV_ERROR:
+                            self.ok_status_time = self.reactor.monotonic()
+                        self.reactor.register_async_callback(self.notify_status)
+                        insert = self.ifs_data.get_new_insert()
 
                         #self._respond_info(response)
-                        #self._respond_info(json.dumps(current_values))
 
                         # Безопасная обработка события вставки
-                        if current_values['NeedInsert']:
-                            prutok = current_values['Insert']
+                        if insert:
+                            prutok = self.first_slot + insert
                             self.reactor.register_async_callback(
-                                lambda eventtime, p=prutok: self._safe_run_script(f"_IFS_AUTOINSERT PRUTOK={p}")
+                                lambda eventtime, p=prutok: self.ifs._safe_run_script(f"_IFS_AUTOINSERT PRUTOK={p}")
                             )
+                        # Опрос только в паузах между командами
+                        self._wait_command(self._update_poll_mode())
                     else:
                         #self._respond_info(f"! {command} -> {response}")
                         with self._ret_command_lock:
                             self._ret_command_data = response
-                            self._ret_command_id = command_id
-                            with self._command_lock:
-                                if command_id == self._command_id: # Если текущая команда последняя, то переходим в режим опроса
-                                    self._command = "F13"
-                    time.sleep(HOST_REPORT_TIME)
+                            self._ret_command_id = cmd.command_id
+                        cmd.response = response
+                        self.trace.add(TRACE_RX, cmd.command_id, response)
+                        self.reactor.register_async_callback(
+                            lambda eventtime, c=cmd: self.ifs._complete(c.completion, c)
+                        )
             except serial.SerialException as e:
                 logging.warning("IFS: Serial communication error: %s", e)
-                self._respond_info(f"IFS: sensor error: Serial communication error: {str(e)}")
+                self.trace.add(TRACE_ERROR, 0, f"serial error: {e}")
+                self.ifs._respond_info(f"{self.label}: sensor error: Serial communication error: {str(e)}")
             except Exception as e:
                 logging.exception("IFS: Error data")
-                self._error(f"IFS: sensor error: Error data: {str(e)}")
+                self._error(f"{self.label}: sensor error: Error data: {str(e)}")
             finally:
                 if ser and hasattr(ser, 'is_open') and ser.is_open:
                     try:
                         ser.close()
-                        logging.info(f"IFS: {PORT} closed")
+                        logging.info(f"IFS: {self.port} closed")
                     except Exception as e:
                         logging.warning("IFS: Error closing IFS serial port: %s", e)
                 time.sleep(1)
 
-class IfsData:
+# Кэш разобранных JSON файлов конфигурации. Файл перечитывается,
+# только если у него изменились mtime или размер.
+# Возвращаемые объекты общие, изменять их нельзя.
+class JsonFileCache:
     def __init__(self):
         self.lock = threading.Lock()
-        self.cur_port = 0       # Текущий активный порт
-        self.Port1 = False      # Загрузка порта 1
-        self.Port2 = False      # Загрузка порта 2
-        self.Port3 = False      # Загрузка порта 3
-        self.Port4 = False      # Загрузка порта 4
-        self.Silk = 0           # Загруженные порты
-        self.Chan = 0           # Текущий активный порт
-        self.Insert = 0         # В каком порту появился филамент
-        self.Stall = False      # Движение по любому порту
-        self.Stalls = [False, False, False, False]
-        self.stall_state = 0    # Движение по любому порту RAW
-        self.State = 0          # Состояние IFS
-        self.NeedInsert = False # Нужно ли вставлять пруток
+        self.entries = {}       # path -> ((mtime_ns, size), data)
+        self.dirty = {}         # path -> indent, ждут записи
+        self.hits = 0
+        self.misses = 0
+
+    def _stat_key(self, path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self, path):
+        with self.lock:
+            if path in self.dirty:
+                self.hits += 1
+                return self.entries[path][1]
+        key = self._stat_key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        with open(path, 'r') as f:
+            data = json.load(f)
+        with self.lock:
+            self.entries[path] = (key, data)
+        return data
+
+    # Немедленная атомарная запись, если данные отличаются от текущих
+    def store(self, path, data, indent=None):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[1] == data and path not in self.dirty:
+                return False
+            self.dirty.pop(path, None)
+        self._write(path, data, indent)
+        return True
+
+    # Отложенная запись: изменения копятся в памяти до flush()
+    def update(self, path, data, indent=None):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[1] == data:
+                return False
+            self.entries[path] = (entry[0] if entry is not None else None, data)
+            self.dirty[path] = indent
+        return True
+
+    def is_dirty(self):
+        with self.lock:
+            return bool(self.dirty)
+
+    def flush(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+            pending = [(path, self.entries[path][1], indent) for path, indent in dirty.items()]
+        for path, data, indent in pending:
+            self._write(path, data, indent)
+
+    # Запись через временный файл и rename, файл никогда не бывает записан наполовину
+    def _write(self, path, data, indent):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        key = self._stat_key(path)
+        with self.lock:
+            self.entries[path] = (key, data)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+# Модель положения кончика прутка по портам: мм от выхода из IFS. Текущее
+# движение хранится как (порт, направление, скорость мм/с, старт, длина, время),
+# положение считается по времени и ограничено длиной команды.
+class TipTracker:
+    def __init__(self, ports, unit_ports=IFS_PORTS):
+        self.positions = [0.] * ports
+        self.known = [False] * ports    # Положение известно (иначе замер не учитываем)
+        self.at_sensor = [False] * ports # Кончик дошел до датчика экструдера
+        self.lengths = [None] * ports   # Выученная длина пути до датчика экструдера, мм
+        self.samples = [0] * ports
+        self.unit_ports = unit_ports    # Портов в юните: в каждом юните движется не больше одного прутка
+        self.moves = {}                 # пруток -> (направление, скорость, начало, длина, время начала)
+        self.speed_scale = 1.           # Во сколько раз подача быстрее заданной (симулятор с ускорением)
+
+    def add_ports(self, ports):
+        self.positions.extend([0.] * ports)
+        self.known.extend([False] * ports)
+        self.at_sensor.extend([False] * ports)
+        self.lengths.extend([None] * ports)
+        self.samples.extend([0] * ports)
+
+    def load(self, data):
+        if not data:
+            return
+        for i, entry in enumerate(data[:len(self.lengths)]):
+            if entry and entry[0]:
+                self.lengths[i] = float(entry[0])
+                self.samples[i] = int(entry[1])
+
+    def dump(self):
+        return [[round(length, 1) if length else None, samples]
+                for length, samples in zip(self.lengths, self.samples)]
+
+    def _estimate(self, move, eventtime):
+        direction, speed, start, length, start_time = move
+        travel = min(length, speed * max(0., eventtime - start_time))
+        return max(0., start + direction * travel)
+
+    def position(self, prutok, eventtime):
+        move = self.moves.get(prutok)
+        if move is not None:
+            return self._estimate(move, eventtime)
+        return self.positions[prutok - 1]
+
+    def set_position(self, prutok, position, eventtime, at_sensor=False):
+        self.moves.pop(prutok, None)
+        self.positions[prutok - 1] = position
+        self.known[prutok - 1] = True
+        self.at_sensor[prutok - 1] = at_sensor
+
+    def get_moving(self, eventtime):
+        """
+        Движущийся пруток, к которому относится датчик экструдера: если движутся
+        прутки нескольких юнитов, тот, чей кончик дальше всех от IFS.
+        :return: Номер прутка или 0.
+        """
+        if not self.moves:
+            return 0
+        return max(self.moves, key=lambda prutok: self._estimate(self.moves[prutok], eventtime))
+
+    def _unit(self, prutok):
+        return (prutok - 1) // self.unit_ports
+
+    def start_move(self, prutok, direction, length, speed, eventtime):
+        self.stop(eventtime, self._unit(prutok))
+        self.moves[prutok] = (direction, self.mm_per_second(speed), self.positions[prutok - 1], length, eventtime)
+
+    def mm_per_second(self, speed):
+        return speed / 60. * self.speed_scale
+
+    def stop(self, eventtime, unit=None):
+        """
+        Останавливает движение прутков.
+        :param unit: Номер юнита с 0, None - все юниты.
+        """
+        for prutok in list(self.moves):
+            if unit is None or self._unit(prutok) == unit:
+                self.positions[prutok - 1] = self._estimate(self.moves.pop(prutok), eventtime)
+
+    def sensor_edge(self, state, eventtime, nominal):
+        """
+        Фронт датчика экструдера во время движения: уточняет положение,
+        на подаче из известного положения - учит длину пути.
+        :return: Замеренная длина или None.
+        """
+        prutok = self.get_moving(eventtime)
+        if not prutok:
+            return None
+        direction, speed, start, length, start_time = self.moves[prutok]
+        idx = prutok - 1
+        if state == self.at_sensor[idx]:
+            return None
+        position = self._estimate(self.moves[prutok], eventtime)
+        measured = None
+        if state and direction > 0:
+            if self.known[idx] and self.learn(prutok, position, nominal):
+                measured = position
+        elif state or direction > 0:
+            return None
+        # Кончик сейчас ровно у датчика
+        target = self.lengths[idx] if self.lengths[idx] is not None else nominal
+        self.moves[prutok] = (direction, speed, start + (target - position), length, start_time)
+        self.known[idx] = True
+        self.at_sensor[idx] = state
+        return measured
+
+    def learn(self, prutok, measured, nominal):
+        idx = prutok - 1
+        if abs(measured - nominal) > nominal * PATH_LEARN_TOLERANCE:
+            return False
+        self.samples[idx] += 1
+        if self.lengths[idx] is None:
+            self.lengths[idx] = measured
+        else:
+            n = min(self.samples[idx], PATH_LEARN_SAMPLES)
+            self.lengths[idx] += (measured - self.lengths[idx]) / n
+        return True
+
+    def forget(self, prutok):
+        self.lengths[prutok - 1] = None
+        self.samples[prutok - 1] = 0
+
+    def is_learned(self, prutok):
+        return self.samples[prutok - 1] >= PATH_LEARN_MIN_SAMPLES
+
+    def get_length(self, prutok, nominal):
+        if self.is_learned(prutok):
+            return self.lengths[prutok - 1]
+        return nominal
+
+    def zone(self, prutok, eventtime):
+        if not self.known[prutok - 1]:
+            return TIP_UNKNOWN
+        if self.at_sensor[prutok - 1]:
+            return TIP_EXTRUDER
+        if self.position(prutok, eventtime) <= 0.:
+            return TIP_IFS
+        return TIP_TUBE
+
+# Датчик прутка в экструдере. Подписывается на отсчеты АЦП (вызов из фонового
+# потока mcu после каждого отсчета), так фронт виден через один отсчет, а не через
+# период опроса. Пороги с гистерезисом, смена состояния - после debounce отсчетов
+# подряд, время фронта - по первому из них. Остальные читают кэшированное состояние.
+class ExtruderSensor:
+    def __init__(self, reactor, debounce=EXTRUDER_DEBOUNCE, hysteresis=EXTRUDER_HYSTERESIS):
+        self.reactor = reactor
+        self.debounce = debounce
+        self.hysteresis = hysteresis
+        self.lock = threading.Lock()
+        self.mcu_adc = None
+        self.subscribed = False         # Отсчеты приходят сами, опрашивать АЦП не нужно
+        self.on_edge = None             # on_edge(state, edge_time), вызывается в потоке отсчета
+        self.state = None               # Пруток есть (после антидребезга)
+        self.value = None               # Последнее значение АЦП
+        self.edge_time = 0.             # Время последнего фронта (время реактора)
+        self._read_time = None          # Время последнего учтенного отсчета АЦП
+        self._pending = 0               # Сколько отсчетов подряд за смену состояния
+        self._pending_time = 0.
+        self.samples = self.edges = self.bounces = 0
+
+    def attach(self, mcu_adc):
+        """
+        Подписывается на отсчеты АЦП поверх обработчика датчика температуры.
+        :param mcu_adc: АЦП из query_adc.
+        :return: True, если подписка удалась (иначе нужен опрос update()).
+        """
+        self.mcu_adc = mcu_adc
+        if mcu_adc is None:
+            return False
+        self.update(self.reactor.monotonic())
+        callback = getattr(mcu_adc, '_callback', None)
+        if callback is None:
+            return False
+        # Сигнатура обработчика зависит от версии Klipper, аргументы передаются как есть
+        def adc_callback(*args):
+            callback(*args)
+            self.update(self.reactor.monotonic())
+        mcu_adc._callback = adc_callback
+        self.subscribed = True
+        return True
+
+    def update(self, eventtime):
+        if self.mcu_adc is None:
+            return
+        value, read_time = self.mcu_adc.get_last_value()
+        edge = None
+        with self.lock:
+            if read_time == self._read_time:
+                return
+            self._read_time = read_time
+            edge = self._sample(value, eventtime)
+            edge_time = self.edge_time
+        if edge is not None and self.on_edge is not None:
+            self.on_edge(edge, edge_time)
+
+    def _classify(self, value):
+        if self.state is None:
+            return value <= EXTRUDER_ADC_LOW or value >= EXTRUDER_ADC_HIGH
+        if self.state:
+            return not (EXTRUDER_ADC_LOW + self.hysteresis < value < EXTRUDER_ADC_HIGH - self.hysteresis)
+        return value <= EXTRUDER_ADC_LOW - self.hysteresis or value >= EXTRUDER_ADC_HIGH + self.hysteresis
+
+    # Возвращает новое состояние, если был фронт
+    def _sample(self, value, eventtime):
+        self.samples += 1
+        self.value = value
+        state = self._classify(value)
+        if self.state is None:
+            self.state = state
+            self.edge_time = eventtime
+            return None
+        if state == self.state:
+            if self._pending:
+                self.bounces += 1
+                self._pending = 0
+            return None
+        if not self._pending:
+            self._pending_time = eventtime
+        self._pending += 1
+        if self._pending < self.debounce:
+            return None
+        self._pending = 0
+        self.state = state
+        self.edge_time = self._pending_time
+        self.edges += 1
+        return state
+
+    def get_state(self, eventtime):
+        if not self.subscribed:
+            self.update(eventtime)
+        return self.state
+
+    def get_stats(self):
+        return {
+            'state': self.state,
+            'value': self.value,
+            'edge_time': self.edge_time,
+            'subscribed': self.subscribed,
+            'samples': self.samples,
+            'edges': self.edges,
+            'bounces': self.bounces,
+        }
+
+# Датчики портов и движения IFS проверяются одним таймером: состояние IFS
+# берется один раз за проход, датчики портов вызываются только при изменении
+# их порта, датчики движения - только во время печати, с общим положением экструдера.
+class IfsSensorScheduler:
+    def __init__(self, printer, ifs):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.ifs = ifs
+        self.port_sensors = []
+        self.motion_sensors = []
+        self.timer = None
+        self.printing = False
+        self._version = None            # (версия снимка, есть связь) каждого юнита на прошлой проверке
+        self.ticks = self.events = 0
+        printer.register_event_handler('idle_timeout:printing', self._handle_printing)
+        printer.register_event_handler('idle_timeout:ready', self._handle_not_printing)
+        printer.register_event_handler('idle_timeout:idle', self._handle_not_printing)
+
+    # Вызывается датчиками на klippy:connect: все юниты уже добавлены, а ошибка
+    # конфигурации там остается ошибкой конфигурации, а не аварийной остановкой
+    def check_port(self, sensor):
+        if sensor.port > self.ifs.slot_count:
+            raise self.printer.config_error(
+                f"IFS sensor {sensor.name}: port {sensor.port} > {self.ifs.slot_count}")
+
+    def add_port_sensor(self, sensor):
+        self.port_sensors.append(sensor)
+        self._start()
+
+    def add_motion_sensor(self, sensor):
+        self.motion_sensors.append(sensor)
+        self._start()
+
+    def _start(self):
+        self._version = None
+        if self.timer is None:
+            self.timer = self.reactor.register_timer(self._tick, self.reactor.NOW)
+        else:
+            self.reactor.update_timer(self.timer, self.reactor.NOW)
+
+    def _handle_printing(self, print_time):
+        self.printing = True
+        if self.timer is not None and self.motion_sensors:
+            self.reactor.update_timer(self.timer, self.reactor.NOW)
+
+    def _handle_not_printing(self, print_time):
+        self.printing = False
+
+    def _tick(self, eventtime):
+        self.ticks += 1
+        ifs = self.ifs
+        version = tuple((unit.ifs_data.get_version(), unit.online) for unit in ifs.units)
+        if version != self._version:
+            self._version = version
+            for sensor in self.port_sensors:
+                state = ifs.get_port(sensor.port)
+                if state != sensor.noted:
+                    self.events += 1
+                    sensor.port_event(eventtime, state)
+        if not self.printing or not self.motion_sensors:
+            return eventtime + SENSOR_IDLE_TIME
+        stalls = {}
+        positions = {}
+        for sensor in self.motion_sensors:
+            if sensor.port not in stalls:
+                stalls[sensor.port] = ifs.get_ifs_sensor(sensor.port)
+            if sensor.extruder_name not in positions:
+                positions[sensor.extruder_name] = sensor.get_extruder_pos(eventtime)
+            sensor.motion_event(eventtime, stalls[sensor.port], positions[sensor.extruder_name])
+        return eventtime + SENSOR_MOTION_TIME
+
+    def get_stats(self):
+        return {
+            'port_sensors': len(self.port_sensors),
+            'motion_sensors': len(self.motion_sensors),
+            'ticks': self.ticks,
+            'events': self.events,
+        }
+
+# Переменные состояния MMU в памяти. На диске - снимок (path) и журнал (path.journal):
+# каждое изменение дописывается строкой {"seq", "name", "value"}, при загрузке журнал
+# накатывается поверх снимка. Оборванная последняя строка (пропало питание)
+# отбрасывается и отрезается от журнала, записи с seq не больше seq снимка уже в нем учтены.
+# flush() и compact() блокируют на fsync, из реактора их не вызывают.
+class StateStore:
+    def __init__(self, path, compact_records=STATE_COMPACT_RECORDS):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.compact_records = compact_records
+        self.lock = threading.Lock()
+        self.io_lock = threading.RLock()   # Запись на диск - по одной, в порядке seq
+        self.variables = {}     # Заменяется целиком при изменении, снаружи только чтение
+        self.dirty = {}         # name -> value, ждут записи в журнал
+        self.seq = 0            # Номер последней записи
+        self.journal_records = 0
+        self.journal_writes = 0
+        self.compactions = 0
+
+    def load(self):
+        variables = {}
+        seq = 0
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            variables = dict(snapshot.get('variables', {}))
+            seq = snapshot.get('seq', 0)
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+            logging.warning(f"IFS: {self.path} is not valid, replaying journal only")
+        records = 0
+        good_size = 0           # Конец последней целой записи
+        torn = False
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    # Строка без перевода строки, без seq/name/value (или не объект) -
+                    # оборванная запись
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no newline")
+                        record = json.loads(line)
+                        record_seq, name, value = record['seq'], record['name'], record['value']
+                        newer = record_seq > seq
+                    except (ValueError, KeyError, TypeError):
+                        logging.warning(f"IFS: {self.journal_path}: dropping torn record")
+                        torn = True
+                        break
+                    good_size += len(line)
+                    records += 1
+                    if newer:
+                        variables[name] = value
+                        seq = record_seq
+        except FileNotFoundError:
+            pass
+        if torn:
+            # Отрезать хвост, иначе новые записи допишутся после него и при
+            # следующей загрузке будут отброшены вместе с ним
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_size)
+                f.flush()
+                os.fsync(f.fileno())
+        with self.lock:
+            self.variables = variables
+            self.seq = seq
+            self.journal_records = records
+
+    def set(self, name, value):
+        """
+        Меняет переменную в памяти, на диск она попадет при flush().
+        :param name: Имя переменной.
+        :param value: Значение, сериализуемое в JSON.
+        :return: True, если значение изменилось.
+        """
+        with self.lock:
+            if name in self.variables and self.variables[name] == value:
+                return False
+            variables = dict(self.variables)
+            variables[name] = value
+            self.variables = variables
+            self.dirty[name] = value
+        return True
+
+    def is_dirty(self):
+        with self.lock:
+            return bool(self.dirty)
+
+    def flush(self):
+        with self.io_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+            records = []
+            for name, value in dirty.items():
+                self.seq += 1
+                records.append(json.dumps({'seq': self.seq, 'name': name, 'value': value}))
+        if not records:
+            return
+        try:
+            with open(self.journal_path, 'a') as f:
+                f.write("\n".join(records) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            # Не потерять изменения: записать при следующем flush
+            with self.lock:
+                for name, value in dirty.items():
+                    self.dirty.setdefault(name, value)
+            raise
+        with self.lock:
+            self.journal_records += len(records)
+            self.journal_writes += 1
+            compact = self.journal_records >= self.compact_records
+        if compact:
+            self._compact()
+
+    # Снимок через временный файл и rename, затем журнал обнуляется.
+    # Если питание пропадет между ними, старые записи журнала отсекутся по seq.
+    def compact(self):
+        with self.io_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.lock:
+            snapshot = {'seq': self.seq, 'variables': self.variables}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        with open(self.journal_path, 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            self.journal_records = 0
+            self.compactions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'seq': self.seq, 'journal_records': self.journal_records,
+                    'journal_writes': self.journal_writes, 'compactions': self.compactions}
+
+# Время ответа по типам команд (гистограмма по RTT_BUCKETS) и счетчики сбоев.
+# Пишется из потока чтения и реактора, читается через get_status и IFS_STATS.
+class IfsStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.rtt = {}       # команда -> [count, sum, max, корзины...]
+            self.counters = dict.fromkeys(STATS_COUNTERS, 0)
+            self.recovery_steps = dict.fromkeys(RECOVERY_STEPS, 0)
+            self.recovery_time = 0.     # Сколько секунд ушло на восстановление
+            self.recovery_max = 0.
+            self.resumed_mm = 0.        # Сколько мм не подавали заново благодаря продолжению с остатка
+            self.wasted_mm = 0.         # Сколько мм прутка прошло в прерванных движениях
+            self.start_time = time.monotonic()
+
+    def add_rtt(self, name, rtt):
+        with self.lock:
+            entry = self.rtt.get(name)
+            if entry is None:
+                entry = self.rtt[name] = [0, 0., 0.] + [0] * (len(RTT_BUCKETS) + 1)
+            entry[0] += 1
+            entry[1] += rtt
+            if rtt > entry[2]:
+                entry[2] = rtt
+            entry[3 + bisect.bisect_left(RTT_BUCKETS, rtt)] += 1
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+
+    def add_recovery(self, steps, ok, seconds, accepted=False):
+        with self.lock:
+            for step in steps:
+                self.recovery_steps[step] += 1
+            self.counters['accepted' if accepted else 'recoveries' if ok else 'aborts'] += 1
+            self.recovery_time += seconds
+            self.recovery_max = max(self.recovery_max, seconds)
+
+    def add_recovery_length(self, resumed=0., wasted=0.):
+        with self.lock:
+            self.resumed_mm += resumed
+            self.wasted_mm += wasted
+
+    def get_stats(self):
+        with self.lock:
+            rtt = {}
+            for name, entry in self.rtt.items():
+                rtt[name] = {
+                    'count': entry[0],
+                    'avg_ms': round(entry[1] / entry[0] * 1000., 2),
+                    'max_ms': round(entry[2] * 1000., 2),
+                    'hist': entry[3:],
+                }
+            return {
+                'uptime': round(time.monotonic() - self.start_time, 1),
+                'buckets_ms': [b * 1000. for b in RTT_BUCKETS],
+                'counters': dict(self.counters),
+                'recovery': {
+                    'steps': dict(self.recovery_steps),
+                    'time_s': round(self.recovery_time, 3),
+                    'max_s': round(self.recovery_max, 3),
+                    'resumed_mm': round(self.resumed_mm, 1),
+                    'wasted_mm': round(self.wasted_mm, 1),
+                },
+                'rtt': rtt,
+            }
+
+# Просмотр вперед файла, который печатает virtual_sdcard. Файл читается
+# собственным дескриптором небольшими кусками из таймера реактора, в памяти
+# только окно впереди позиции печати: контрольные точки и найденные смены
+# инструмента (T<n> и MMU_CHANGE_TOOL TOOL=<n>). Для каждой смены известны
+# выдавленная длина и время движений от начала файла, поэтому расстояние
+# до нее от текущей позиции считается без повторного чтения.
+class ToolChangeLookahead:
+    def __init__(self, printer, window=LOOKAHEAD_WINDOW):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.window = window
+        self.sdcard = None
+        self.timer = None
+        self.file = None
+        self._reset(None)
+
+    def start(self):
+        self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if self.sdcard is not None:
+            self.timer = self.reactor.register_timer(self._scan_event, self.reactor.NOW)
+
+    def _reset(self, path, position=0):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.path = path
+        self.eof = False
+        self.scan_pos = position        # До какой позиции файл прочитан
+        self.partial = b''              # Незавершенная строка в конце прочитанного
+        self.skip_line = position > 0   # Начали с середины строки
+        self.extruded = 0.              # Выдавлено от точки начала сканирования, мм
+        self.seconds = 0.               # Время движений от точки начала сканирования, с
+        self.coord = [0., 0., 0.]
+        self.last_e = 0.
+        self.speed = 25.                # Текущая скорость, мм/с
+        self.absolute_coord = True
+        self.absolute_extrude = True
+        self.changes = collections.deque()          # (позиция, команда, инструмент, мм, с)
+        self.checkpoints = collections.deque([(position, 0., 0.)])  # (позиция, мм, с)
+        if path is not None:
+            try:
+                self.file = open(path, 'rb')
+                self.file.seek(position)
+            except OSError as e:
+                logging.warning("IFS: look-ahead cannot open %s: %s", path, e)
+                self.file = None
+                self.eof = True
+
+    def _scan_event(self, eventtime):
+        status = self.sdcard.get_status(eventtime)
+        path = status.get('file_path')
+        print_pos = status.get('file_position', 0)
+        if not path:
+            if self.path is not None:
+                self._reset(None)
+            return eventtime + LOOKAHEAD_IDLE_TIME
+        if path != self.path or print_pos < self.checkpoints[0][0]:
+            # Новый файл или печать перемотана назад
+            self._reset(path, print_pos)
+        elif print_pos > self.scan_pos:
+            # Печать обогнала сканирование - начинаем с текущей позиции
+            self._reset(path, print_pos)
+        while self.changes and self.changes[0][0] < print_pos:
+            self.changes.popleft()
+        while len(self.checkpoints) > 1 and self.checkpoints[1][0] <= print_pos:
+            self.checkpoints.popleft()
+        if (self.eof or self.scan_pos >= print_pos + self.window
+                or len(self.changes) >= LOOKAHEAD_MAX_CHANGES):
+            return eventtime + LOOKAHEAD_IDLE_TIME
+        data = self.file.read(LOOKAHEAD_CHUNK)
+        if not data:
+            self.eof = True
+            return eventtime + LOOKAHEAD_IDLE_TIME
+        self.parse(data)
+        return eventtime + LOOKAHEAD_INTERVAL
+
+    def parse(self, data):
+        line_pos = self.scan_pos - len(self.partial)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        self.scan_pos += len(data)
+        if self.skip_line and lines:
+            line_pos += len(lines[0]) + 1
+            lines = lines[1:]
+            self.skip_line = False
+        for line in lines:
+            pos = line_pos
+            line_pos += len(line) + 1
+            line = line.split(b';', 1)[0].strip()
+            if not line:
+                continue
+            first = line[:1]
+            if first == b'G':
+                self._parse_g(line)
+            elif first == b'T':
+                if line[1:].isdigit():
+                    self.changes.append((pos, 'T', int(line[1:]), self.extruded, self.seconds))
+            elif first == b'M':
+                if line == b'M82':
+                    self.absolute_extrude = True
+                elif line == b'M83':
+                    self.absolute_extrude = False
+                elif line.startswith(b'MMU_CHANGE_TOOL'):
+                    tool = 1
+                    for part in line.split()[1:]:
+                        if part.upper().startswith(b'TOOL='):
+                            try:
+                                tool = int(part[5:])
+                            except ValueError:
+                                pass
+                    self.changes.append((pos, 'MMU_CHANGE_TOOL', tool, self.extruded, self.seconds))
+            if pos >= self.checkpoints[-1][0] + LOOKAHEAD_CHECKPOINT:
+                self.checkpoints.append((pos, self.extruded, self.seconds))
+
+    def _parse_g(self, line):
+        parts = line.split()
+        cmd = parts[0]
+        if cmd == b'G1' or cmd == b'G0':
+            coord = self.coord
+            new = list(coord)
+            e = None
+            for part in parts[1:]:
+                axis = part[:1]
+                try:
+                    value = float(part[1:])
+                except ValueError:
+                    continue
+                if axis == b'X':
+                    new[0] = value if self.absolute_coord else coord[0] + value
+                elif axis == b'Y':
+                    new[1] = value if self.absolute_coord else coord[1] + value
+                elif axis == b'Z':
+                    new[2] = value if self.absolute_coord else coord[2] + value
+                elif axis == b'E':
+                    e = value
+                elif axis == b'F':
+                    if value > 0.:
+                        self.speed = value / 60.
+            distance = math.sqrt((new[0] - coord[0]) ** 2 + (new[1] - coord[1]) ** 2
+                                 + (new[2] - coord[2]) ** 2)
+            self.coord = new
+            if e is not None:
+                if self.absolute_coord and self.absolute_extrude:
+                    de = e - self.last_e
+                    self.last_e = e
+                else:
+                    de = e
+                if de > 0.:
+                    self.extruded += de
+                if not distance:
+                    distance = abs(de)
+            self.seconds += distance / self.speed
+        elif cmd == b'G90':
+            self.absolute_coord = True
+        elif cmd == b'G91':
+            self.absolute_coord = False
+        elif cmd == b'G92':
+            for part in parts[1:]:
+                axis = part[:1]
+                try:
+                    value = float(part[1:])
+                except ValueError:
+                    continue
+                if axis == b'E':
+                    self.last_e = value
+                elif axis in (b'X', b'Y', b'Z'):
+                    self.coord[b'XYZ'.index(axis)] = value
+        elif cmd == b'G4':
+            for part in parts[1:]:
+                try:
+                    if part[:1] == b'P':
+                        self.seconds += float(part[1:]) / 1000.
+                    elif part[:1] == b'S':
+                        self.seconds += float(part[1:])
+                except ValueError:
+                    pass
+
+    def get_schedule(self, eventtime):
+        """
+        Смены инструмента впереди позиции печати.
+        :return: Список словарей: command, tool, file_position,
+                 distance (выдавить до смены, мм), time (оценка, с).
+        """
+        if self.sdcard is None or self.path is None:
+            return []
+        print_pos = self.sdcard.get_status(eventtime).get('file_position', 0)
+        base_pos, base_mm, base_s = self.checkpoints[0]
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] > print_pos:
+                break
+            base_pos, base_mm, base_s = checkpoint
+        schedule = []
+        for pos, command, tool, extruded, seconds in self.changes:
+            if pos < print_pos:
+                continue
+            schedule.append({'command': command, 'tool': tool, 'file_position': pos,
+                             'distance': max(0., extruded - base_mm),
+                             'time': max(0., seconds - base_s)})
+        return schedule
+
+    def get_status(self, eventtime):
+        schedule = self.get_schedule(eventtime)
+        next_change = schedule[0] if schedule else None
+        return {
+            'file_path': self.path,
+            'scan_position': self.scan_pos,
+            'complete': self.eof,
+            'changes': len(schedule),
+            'next_tool': next_change['tool'] if next_change else None,
+            'next_distance': round(next_change['distance'], 1) if next_change else None,
+            'next_time': round(next_change['time'], 1) if next_change else None,
+        }
+
+# Кольцевой буфер последних событий обмена. Место выделено заранее, запись -
+# одно присваивание в список без блокировок: номер события берется из
+# itertools.count, который атомарен под GIL.
+class IfsTrace:
+    def __init__(self, size=TRACE_SIZE):
+        self.size = size
+        self.events = [None] * size
+        self.counter = itertools.count()
+
+    def add(self, kind, command_id, text):
+        n = next(self.counter)
+        self.events[n % self.size] = (n, time.monotonic(), kind, command_id, text)
+
+    def get_events(self):
+        events = [event for event in list(self.events) if event is not None]
+        events.sort()
+        return events
+
+    def dump(self, path, reason):
+        events = self.get_events()
+        now = time.monotonic()
+        lines = [f"# IFS trace {time.strftime('%Y-%m-%d %H:%M:%S')}: {reason}",
+                 f"# {len(events)} events, time relative to dump"]
+        for n, eventtime, kind, command_id, text in events:
+            lines.append(f"{eventtime - now:12.6f} {kind:5s} #{command_id} {text}")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+# Сумма get_stats() нескольких юнитов для printer.zmod_ifs.stats
+def merge_stats(stats_list):
+    if len(stats_list) == 1:
+        return stats_list[0]
+    total = {
+        'uptime': max(stats['uptime'] for stats in stats_list),
+        'buckets_ms': stats_list[0]['buckets_ms'],
+        'counters': dict.fromkeys(STATS_COUNTERS, 0),
+        'recovery': {'steps': dict.fromkeys(RECOVERY_STEPS, 0), 'time_s': 0., 'max_s': 0.,
+                     'resumed_mm': 0., 'wasted_mm': 0.},
+        'rtt': {},
+    }
+    rtt_sums = {}
+    for stats in stats_list:
+        for key, value in stats['counters'].items():
+            total['counters'][key] += value
+        recovery = stats['recovery']
+        for step, count in recovery['steps'].items():
+            total['recovery']['steps'][step] += count
+        for key in ('time_s', 'resumed_mm', 'wasted_mm'):
+            total['recovery'][key] += recovery[key]
+        total['recovery']['max_s'] = max(total['recovery']['max_s'], recovery['max_s'])
+        for name, rtt in stats['rtt'].items():
+            entry = total['rtt'].setdefault(name, {'count': 0, 'avg_ms': 0., 'max_ms': 0.,
+                                                   'hist': [0] * len(rtt['hist'])})
+            entry['count'] += rtt['count']
+            entry['max_ms'] = max(entry['max_ms'], rtt['max_ms'])
+            entry['hist'] = [a + b for a, b in zip(entry['hist'], rtt['hist'])]
+            rtt_sums[name] = rtt_sums.get(name, 0.) + rtt['avg_ms'] * rtt['count']
+    for name, entry in total['rtt'].items():
+        entry['avg_ms'] = round(rtt_sums[name] / entry['count'], 2)
+    for key in ('time_s', 'resumed_mm', 'wasted_mm'):
+        total['recovery'][key] = round(total['recovery'][key], 3 if key == 'time_s' else 1)
+    return total
+
+# Идет подача или выгрузка прутка в одном из портов
+def is_moving_state(state):
+    for base in (FFS_STATUS_ZAGRUZKA, FFS_STATUS_VIGRUZKA):
+        delta = state - base
+        if delta >= 0 and delta % FFS_STATUS_DELTA == 0 and delta // FFS_STATUS_DELTA < IFS_PORTS:
+            return True
+    return False
+
+# Снимок ответа F13 одного IFS. Маски прутков, движения и вставки хранятся один раз
+# как пришли, признаки отдельных портов вычисляются при чтении, число портов любое.
+# Аксессоры для горячих путей (ожидание статуса, фоновые задания, датчики) не
+# создают словарей, get_values() - только для вывода и итогов ожидания.
+class IfsData:
+    __slots__ = ('lock', 'ports', 'cur_port', 'state', 'silk', 'chan', 'insert', 'stall',
+                 'need_insert', 'version', 'changes', 'raw')
+
+    def __init__(self, ports=IFS_PORTS):
+        self.lock = threading.Lock()
+        self.ports = ports
+        self.cur_port = 0           # Текущий активный порт
+        self.state = 0              # FFS_state
+        self.silk = 0               # Маска портов с прутком
+        self.chan = 0               # Текущий активный порт по IFS
+        self.insert = 0             # В каком порту появился пруток (номер, не маска)
+        self.stall = 0              # Маска портов, где пруток движется
+        self.need_insert = False    # Нужно ли вставлять пруток
+        self.version = 0            # Номер снимка, растет с каждым ответом F13
+        self.changes = 0            # Растет, только когда ответ F13 отличается от прошлого
+        self.raw = None             # Последний разобранный ответ F13
 
     def update_from_string(self, data_str):
         if data_str is None:
             return
 
-        silk_state = 0
-        silk = 0
-        chan = 0
-        insert = 0
-        stall_state = 0
-        state = 0
-
-        state_match = re.search(r'FFS_state:\s*(\d+)', data_str)
-        if state_match:
-            state = int(state_match.group(1))
-
-        silk_match = re.search(r'silk_state:\s*(\d+)', data_str)
-        if silk_match:
-            silk_state = int(silk_match.group(1))
-        port1 = (silk_state >> 0) & 1 == 1
-        port2 = (silk_state >> 1) & 1 == 1
-        port3 = (silk_state >> 2) & 1 == 1
-        port4 = (silk_state >> 3) & 1 == 1
-
-        chan_match = re.search(r'chan:\s*(\d+)', data_str)
-        if chan_match:
-            chan = int(chan_match.group(1))
-
-        insert_match = re.search(r'ffs_channels_insert:\s*(\d+)', data_str)
-        if insert_match:
-            insert = int(insert_match.group(1))
-            insert = insert.bit_length()
-
-        stall_match = re.search(r'stall_state:\s*(\d+)', data_str)
-        if stall_match:
-            stall_state = int(stall_match.group(1))
+        with self.lock:
+            if data_str == self.raw:
+                # Состояние не изменилось, только отмечаем новый снимок
+                self.need_insert = False
+                self.version += 1
+                return
+
+        # Все поля "имя: число" за один проход, неизвестные поля игнорируются
+        fields = dict(F13_FIELD_RE.findall(data_str))
+        state = int(fields.get('FFS_state', 0))
+        silk = int(fields.get('silk_state', 0))
+        chan = int(fields.get('chan', 0))
+        insert = int(fields.get('ffs_channels_insert', 0)).bit_length()
+        stall = int(fields.get('stall_state', 0))
 
         with self.lock:
-            self.Port1 = port1
-            self.Port2 = port2
-            self.Port3 = port3
-            self.Port4 = port4
-            self.stall_state = stall_state
-            if self.cur_port == 0:
-                self.Stall = stall_state != 0
-            else:
-                self.Stall = (stall_state >> (self.cur_port - 1) ) & 1 == 1
-            self.Stalls[0] = (stall_state >> 0 ) & 1 == 1
-            self.Stalls[1] = (stall_state >> 1 ) & 1 == 1
-            self.Stalls[2] = (stall_state >> 2 ) & 1 == 1
-            self.Stalls[3] = (stall_state >> 3 ) & 1 == 1
-            self.Silk = silk_state
-            self.State = state
-            self.Chan = chan
-            self.NeedInsert = insert != 0 and insert != self.Insert and state == FFS_STATUS_READY
-            self.Insert = insert
+            self.raw = data_str
+            self.state = state
+            self.silk = silk
+            self.chan = chan
+            self.stall = stall
+            self.need_insert = insert != 0 and insert != self.insert and state == FFS_STATUS_READY
+            self.insert = insert
+            self.version += 1
+            self.changes += 1
+
+    def get_version(self):
+        with self.lock:
+            return self.version
+
+    def get_changes(self):
+        with self.lock:
+            return self.changes
+
+    def get_state(self):
+        with self.lock:
+            return self.state
+
+    def get_masks(self):
+        """
+        Состояние и маски одного снимка для проверок StateCheck.
+        :return: (FFS_state, маска прутков, маска движения).
+        """
+        with self.lock:
+            return self.state, self.silk, self.stall
+
+    def get_chan(self):
+        with self.lock:
+            return self.chan
+
+    def get_insert(self):
+        with self.lock:
+            return self.insert
+
+    # Порт, куда только что вставили пруток, или 0
+    def get_new_insert(self):
+        with self.lock:
+            return self.insert if self.need_insert else 0
 
     def set_cur_port(self, port):
         with self.lock:
-            if port < 0 or port > 4:
+            if port < 0 or port > self.ports:
                 self.cur_port = 0
             else:
                 self.cur_port = port
 
+    # Движение прутка в порту, для 0 - в текущем порту, а без него - в любом
     def get_stall(self, port):
         with self.lock:
             if port == 0:
-                return self.Stall
-            else:
-                return self.Stalls[port-1]
+                port = self.cur_port
+                if port == 0:
+                    return self.stall != 0
+            return 0 < port <= self.ports and (self.stall >> (port - 1)) & 1 == 1
 
     # Возвращает статус конкретного порта
     def get_port(self, port):
         with self.lock:
-            if port == 1:
-                return self.Port1
-            if port == 2:
-                return self.Port2
-            if port == 3:
-                return self.Port3
-            if port == 4:
-                return self.Port4
-            return False
+            return 0 < port <= self.ports and (self.silk >> (port - 1)) & 1 == 1
 
     def get_values(self):
         with self.lock:
-            return {
-                'State':  self.State,
-                'Port1':  self.Port1,
-                'Port2':  self.Port2,
-                'Port3':  self.Port3,
-                'Port4':  self.Port4,
-                'Silk':   self.Silk,
-                'Chan':   self.Chan,
-                'Insert': self.Insert,
-                'NeedInsert': self.NeedInsert,
-                'Stall':  self.Stall,
-                'stall_state': self.stall_state
-            }
+            values = {'State': self.state}
+            for i in range(self.ports):
+                values[f'Port{i + 1}'] = (self.silk >> i) & 1 == 1
+            if self.cur_port:
+                stall = (self.stall >> (self.cur_port - 1)) & 1 == 1
+            else:
+                stall = self.stall != 0
+            values.update(Silk=self.silk, Chan=self.chan, Insert=self.insert,
+                          NeedInsert=self.need_insert, Stall=stall, stall_state=self.stall)
+            return values
 
 
 def load_config(config):
     return zmod_ifs(config)
 
+# [zmod_ifs NAME] - дополнительный юнит IFS на своем последовательном порту
+def load_config_prefix(config):
+    ifs = config.get_printer().load_object(config, 'zmod_ifs')
+    return ifs.add_unit(config)
+
@@ -21,7 +21,8 @@ class ZmodIfsMotionSensor:
         # Get printer objects
         self.reactor = self.printer.get_reactor()
         self.runout_helper = filament_switch_sensor.RunoutHelper(config)
-        self.port = config.getint('port', 0, minval=0, maxval=4)
+        self.port = config.getint('port', 0, minval=0)   # Общий номер прутка, проверяется при подключении к zmod_ifs
+        self.noted = None               # Последнее состояние, переданное в runout_helper
         sig = inspect.signature(self.runout_helper.note_filament_present)
 
         self.zmod_color = self.printer.lookup_object('zmod_color', None)
@@ -37,7 +38,11 @@ class ZmodIfsMotionSensor:
         self.estimated_print_time = None
         # Initialise internal state
         self.filament_runout_pos = None
+        self.timer = None               # Свой таймер, только если нет общего таймера zmod_ifs
         # Register commands and event handlers
+        # Проверку во время печати запускает общий таймер zmod_ifs
+        self.printer.register_event_handler('klippy:connect',
+                self._handle_connect)
         self.printer.register_event_handler('klippy:ready',
                 self._handle_ready)
         self.printer.register_event_handler('idle_timeout:printing',
@@ -56,76 +61,75 @@ class ZmodIfsMotionSensor:
     def cmd_IFS_MOTION_ON(self, gcmd):
         eventtime = self.reactor.monotonic()
         self._update_filament_runout_pos(eventtime)
-        if self.new:
-            self.runout_helper.note_filament_present(eventtime, True)
-        else:
-            self.runout_helper.note_filament_present(True)
+        self._note_filament_present(eventtime, True)
 
     def cmd_IFS_MOTION_OFF(self, gcmd):
+        self._note_filament_present(self.reactor.monotonic(), False)
+
+    def _note_filament_present(self, eventtime, is_filament_present):
+        if is_filament_present == self.noted:
+            return
+        self.noted = is_filament_present
         if self.new:
-            eventtime = self.reactor.monotonic()
-            self.runout_helper.note_filament_present(eventtime, False)
+            self.runout_helper.note_filament_present(eventtime, is_filament_present)
         else:
-            self.runout_helper.note_filament_present(False)
+            self.runout_helper.note_filament_present(is_filament_present)
 
     def _update_filament_runout_pos(self, eventtime=None):
         if eventtime is None:
             eventtime = self.reactor.monotonic()
         self.filament_runout_pos = (
-                self._get_extruder_pos(eventtime) +
+                self.get_extruder_pos(eventtime) +
                 self.detection_length)
 
+    def _handle_connect(self):
+        sensors = getattr(self.printer.lookup_object('zmod_ifs', None), 'sensors', None)
+        if sensors is not None:
+            sensors.check_port(self)
+
     def _handle_ready(self):
-        self.ifs = self.printer.lookup_object('zmod_ifs')
-        if self.new:
-            self.runout_helper.note_filament_present(self.reactor.monotonic(), True)
-        else:
-            self.runout_helper.note_filament_present(True)
+        self.ifs = self.printer.lookup_object('zmod_ifs', None)
+        self._note_filament_present(self.reactor.monotonic(), True)
         self.extruder = self.printer.lookup_object(self.extruder_name)
         self.estimated_print_time = (
                 self.printer.lookup_object('mcu').estimated_print_time)
         self._update_filament_runout_pos()
-        self._extruder_pos_update_timer = self.reactor.register_timer(
-                self._extruder_pos_update_event)
+        sensors = getattr(self.ifs, 'sensors', None)
+        if sensors is not None:
+            sensors.add_motion_sensor(self)
+        else:
+            self.timer = self.reactor.register_timer(self._motion_timer_event)
     def _handle_printing(self, print_time):
-        self.reactor.update_timer(self._extruder_pos_update_timer,
-                self.reactor.NOW)
+        if self.timer is not None:
+            self.reactor.update_timer(self.timer, self.reactor.NOW)
     def _handle_not_printing(self, print_time):
-        self.reactor.update_timer(self._extruder_pos_update_timer,
-                self.reactor.NEVER)
-    def _get_extruder_pos(self, eventtime=None):
+        if self.timer is not None:
+            self.reactor.update_timer(self.timer, self.reactor.NEVER)
+    def _motion_timer_event(self, eventtime):
+        try:
+            moving = self.ifs.get_ifs_sensor(self.port)
+        except Exception:
+            # Состояние IFS недоступно - считаем, что пруток идет
+            moving = True
+        self.motion_event(eventtime, moving, self.get_extruder_pos(eventtime))
+        return eventtime + CHECK_RUNOUT_TIMEOUT
+    def get_extruder_pos(self, eventtime=None):
         if eventtime is None:
             eventtime = self.reactor.monotonic()
         print_time = self.estimated_print_time(eventtime)
         return self.extruder.find_past_position(print_time)
-    def _extruder_pos_update_event(self, eventtime):
+    # Вызывается общим таймером zmod_ifs во время печати
+    def motion_event(self, eventtime, moving, extruder_pos):
         # Получаем статус филамента из zmod_ifs
-        if self.ifs.get_ifs_sensor(self.port):
-            self._update_filament_runout_pos(eventtime)
-
-            extruder_pos = self._get_extruder_pos(eventtime)
-            #logging.info(f"MS: ON {extruder_pos} {self.filament_runout_pos} True")
-
+        if moving:
+            self.filament_runout_pos = extruder_pos + self.detection_length
             # Check for filament insertion
             # Filament is always assumed to be present on an encoder event
-            if self.new:
-                self.runout_helper.note_filament_present(eventtime, True)
-            else:
-                self.runout_helper.note_filament_present(True)
+            self._note_filament_present(eventtime, True)
         else:
-            extruder_pos = self._get_extruder_pos(eventtime)
-
-            #logging.info(f"MS: OF {extruder_pos} {self.filament_runout_pos} {extruder_pos < self.filament_runout_pos}")
-
             # Check for filament runout
-            if self.new:
-                self.runout_helper.note_filament_present(eventtime,
-                    extruder_pos < self.filament_runout_pos)
-            else:
-                self.runout_helper.note_filament_present(
+            self._note_filament_present(eventtime,
                     extruder_pos < self.filament_runout_pos)
 
-        return eventtime + CHECK_RUNOUT_TIMEOUT
-
 def load_config_prefix(config):
     return ZmodIfsMotionSensor(config)
@@ -14,6 +14,7 @@ class ZmodIfsSwitchSensor:
         self.printer.add_object(f"filament_switch_sensor {self.name}", self)
 
         self.reactor = self.printer.get_reactor()
+        self.extruder_sensor = None
         sig = inspect.signature(self.runout_helper.note_filament_present)
         if 'eventtime' in sig.parameters:
             self.new = True
@@ -27,9 +28,20 @@ class ZmodIfsSwitchSensor:
 
     def _handle_ready(self):
         self.query_adc = self.printer.lookup_object('query_adc')
+        # Если IFS включен, датчик уже отслеживает zmod_ifs: берем его состояние и фронты
+        ifs = self.printer.lookup_object('zmod_ifs', None)
+        self.extruder_sensor = getattr(ifs, 'extruder_sensor', None)
+        if self.extruder_sensor is not None:
+            ifs.add_extruder_callback(self._extruder_event)
         self.timer = self.reactor.register_timer(self.check_state, self.reactor.NOW)
         self.check_state(self.reactor.NOW)
 
+    def _extruder_event(self, state):
+        if self.new:
+            self.runout_helper.note_filament_present(self.reactor.monotonic(), state)
+        else:
+            self.runout_helper.note_filament_present(state)
+
     def cmd_IFS_SWITCH_ON(self, gcmd):
         if self.new:
             eventtime = self.reactor.monotonic()
@@ -51,28 +63,34 @@ class ZmodIfsSwitchSensor:
             self.gcode.respond_info(f"Error reading filament sensor: {e}")
             new_state = True
 
-        sig = inspect.signature(self.runout_helper.note_filament_present)
         if self.new:
             self.runout_helper.note_filament_present(eventtime, new_state)
         else:
             self.runout_helper.note_filament_present(new_state)
 
+        # Фронты приходят через _extruder_event, опрос не нужен
+        if self.extruder_sensor is not None and self.extruder_sensor.subscribed:
+            return self.reactor.NEVER
         return eventtime + 0.5
 
     def get_filament(self):
+        if self.extruder_sensor is not None and self.extruder_sensor.state is not None:
+            return self.extruder_sensor.get_state(self.reactor.monotonic())
         value, _ = self.query_adc.adc["temperature_sensor filamentValue"].get_last_value()
         return value >= 0.72 if value > 0.3 else True
 
 
 # ZmodIfsPortSensor
 
+CHECK_PORT_TIME = 0.5
+
 class ZmodIfsPortSensor:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name().split()[-1]
 
         self.runout_helper = RunoutHelper(config)
-        self.port = config.getint('port', 0, minval=0, maxval=4)
+        self.port = config.getint('port', 0, minval=0)   # Общий номер прутка, проверяется при подключении к zmod_ifs
         self.get_status = self.runout_helper.get_status
         self.printer.add_object(f"filament_switch_sensor {self.name}", self)
 
@@ -81,14 +99,27 @@ class ZmodIfsPortSensor:
         self.new = 'eventtime' in sig.parameters
 
         self.last_state = True
-        self.timer = self.reactor.register_timer(self.check_state, self.reactor.NOW)
+        self.noted = None               # Последнее состояние, переданное в runout_helper
+        self.timer = None
 
+        self.printer.register_event_handler("klippy:connect", self._handle_connect)
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
         self.gcode = self.printer.lookup_object('gcode')
 
+    def _handle_connect(self):
+        sensors = getattr(self.printer.lookup_object('zmod_ifs', None), 'sensors', None)
+        if sensors is not None:
+            sensors.check_port(self)
+
     def _handle_ready(self):
         self.ifs = self.printer.lookup_object('zmod_ifs')
-        self.check_state(self.reactor.NOW)
+        self.print_stats = self.printer.lookup_object('print_stats')
+        # Порты проверяет общий таймер zmod_ifs, свой таймер - только если IFS выключен
+        sensors = getattr(self.ifs, 'sensors', None)
+        if sensors is not None:
+            sensors.add_port_sensor(self)
+        else:
+            self.timer = self.reactor.register_timer(self.check_state, self.reactor.NOW)
 
     def check_state(self, eventtime):
         try:
@@ -96,22 +127,25 @@ class ZmodIfsPortSensor:
         except Exception as e:
             self.gcode.respond_info(f"Error reading filament sensor: {e}")
             new_state = True
+        if new_state != self.noted:
+            self.port_event(eventtime, new_state)
+        return eventtime + CHECK_PORT_TIME
 
-        print_state = self.printer.lookup_object('print_stats').get_status(eventtime)['state']
+    # Состояние порта изменилось
+    def port_event(self, eventtime, new_state):
+        print_state = self.print_stats.get_status(eventtime)['state']
         is_printing = print_state in ('printing')
 
-        if not is_printing and hasattr(self, "last_state") and self.last_state and not new_state:
+        if not is_printing and self.last_state and not new_state:
             self.runout_helper._exec_gcode("", self.runout_helper.runout_gcode)
         self.last_state = new_state
 
-        sig = inspect.signature(self.runout_helper.note_filament_present)
+        self.noted = new_state
         if self.new:
             self.runout_helper.note_filament_present(eventtime, new_state)
         else:
             self.runout_helper.note_filament_present(new_state)
 
-        return eventtime + 0.5
-
     def get_filament(self):
         return self.ifs.get_port(self.port)
 